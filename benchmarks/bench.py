@@ -0,0 +1,231 @@
+#!/usr/bin/python3
+"""
+Offline benchmarks for Engine turns, Planbot lookups and the matching
+paths, run against the stand-ins in standins.py:
+
+    $ PYTHONPATH=src/components python3 benchmarks/bench.py
+    $ PYTHONPATH=src/components python3 benchmarks/bench.py \\
+          --save benchmarks/baseline.json
+    $ PYTHONPATH=src/components python3 benchmarks/bench.py \\
+          --compare benchmarks/baseline.json
+
+Each scenario reports latency percentiles over --iterations runs, then
+the peak and retained memory allocated per run, traced in a separate pass
+so tracemalloc does not skew the timings. A comparison run exits non-zero
+if any scenario's p50, p90 or peak allocation exceeds its baseline by more
+than --tolerance. Baselines only compare on the machine that saved them.
+"""
+
+import argparse
+import gc
+import json
+import logging
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import OrderedDict
+
+from engine import Engine
+from planbot import Planbot
+from session import MemorySessionStore
+from standins import Fixtures
+from tasks import semantic_analysis, spell_check
+
+SEED = 1
+INPUTS = 50
+COMPARED = ['p50_us', 'p90_us', 'peak_kib']
+
+
+def typo(text, rng):
+    """Return text with one character dropped, swapped or doubled."""
+
+    if len(text) < 4:
+        return text + text[-1:]
+    pos = rng.randrange(1, len(text) - 2)
+    edit = rng.choice(['drop', 'swap', 'double'])
+    if edit == 'drop':
+        return text[:pos] + text[pos + 1:]
+    elif edit == 'swap':
+        return text[:pos] + text[pos + 1] + text[pos] + text[pos + 2:]
+    return text[:pos] + text[pos] + text[pos:]
+
+
+def sample(items, rng, n=INPUTS):
+    items = sorted(set(items))
+    return [rng.choice(items) for _ in range(n)]
+
+
+def cycle(inputs):
+    return lambda i: inputs[i % len(inputs)]
+
+
+def turn(context, messages, **state):
+    """An Engine turn taking each message from a session in context."""
+
+    store = MemorySessionStore()
+    bot = Engine(store=store)
+
+    def prepare(i):
+        store.save('bench', dict(state, context=context))
+        return ('bench', messages[i % len(messages)])
+
+    return prepare, bot.response
+
+
+def lookup(action, queries):
+    """A Planbot.run_task call for each query, or (query, sector) pair."""
+
+    pb = Planbot()
+
+    def run(query, sector=None):
+        return pb.run_task(action=action, query=query, sector=sector)
+
+    return cycle([q if isinstance(q, tuple) else (q,) for q in queries]), run
+
+
+def scenarios(fixtures):
+    rng = random.Random(SEED)
+    keys = fixtures.keys
+    terms = sample(keys['definitions'], rng)
+    typos = [typo(term, rng) for term in terms]
+    sections = sorted({(r[1], r[2]) for r in fixtures.reports})
+    locations = sorted({loc for loc, _ in sections})
+    pages = sample([(loc, sec) for loc, sec in sections], rng)
+    misses = [(typo(key, rng), table)
+              for table in ['definitions', 'projects', 'documents']
+              for key in sample(keys[table], rng, INPUTS // 3)]
+
+    suite = OrderedDict()
+    suite['engine.get_started'] = turn(None, ['GET_STARTED_PAYLOAD'])
+    suite['engine.enter_branch'] = turn(None, ['DEFINE_PAYLOAD'])
+    suite['engine.define_hit'] = turn('DEFINE_PAYLOAD_CALL', terms)
+    suite['engine.define_miss'] = turn('DEFINE_PAYLOAD_CALL', typos)
+    suite['engine.cancel'] = turn('DEFINE_PAYLOAD_CALL', ['Cancel'])
+    suite['engine.report_sectors'] = turn('REPORT_PAYLOAD_SECTOR',
+                                          [loc.title() for loc in locations])
+    suite['engine.report_page'] = turn('REPORT_PAYLOAD_CALL',
+                                       ['Residential', 'Commercial'],
+                                       location='london')
+
+    suite['planbot.definitions'] = lookup('definitions', [
+        q for pair in zip(terms, typos) for q in pair])
+    suite['planbot.use_classes'] = lookup('use_classes', [
+        'list all'] + [key.split()[0] for key in keys['use_classes']])
+    suite['planbot.local_plans'] = lookup('local_plans', [
+        q for pair in zip(sample(keys['local_plans'], rng),
+                          sample(fixtures.postcodes, rng)) for q in pair])
+    suite['planbot.reports'] = lookup('reports', pages)
+
+    suite['matching.semantic_analysis'] = (cycle(misses),
+                                           semantic_analysis)
+    suite['matching.spell_check'] = (cycle(misses), spell_check)
+    return suite
+
+
+def percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def measure(prepare, run, iterations, allocations, warmup):
+    for i in range(warmup):
+        run(*prepare(i))
+
+    gc.collect()
+    times = []
+    for i in range(iterations):
+        args = prepare(i)
+        start = time.perf_counter()
+        run(*args)
+        times.append(time.perf_counter() - start)
+
+    peaks, retained = [], []
+    tracemalloc.start()
+    for i in range(allocations):
+        args = prepare(i)
+        tracemalloc.clear_traces()
+        run(*args)
+        current, peak = tracemalloc.get_traced_memory()
+        peaks.append(peak)
+        retained.append(current)
+    tracemalloc.stop()
+
+    times.sort()
+    return OrderedDict([
+        ('iterations', iterations),
+        ('p50_us', round(percentile(times, 0.5) * 1e6, 1)),
+        ('p90_us', round(percentile(times, 0.9) * 1e6, 1)),
+        ('p99_us', round(percentile(times, 0.99) * 1e6, 1)),
+        ('mean_us', round(sum(times) / len(times) * 1e6, 1)),
+        ('peak_kib', round(sum(peaks) / max(len(peaks), 1) / 1024, 1)),
+        ('retained_kib', round(sum(retained) / max(len(retained), 1) / 1024,
+                               1))])
+
+
+def compare(results, baseline, tolerance):
+    """Return a line for every metric that regressed past tolerance."""
+
+    regressions = []
+    for name, stats in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        for metric in COMPARED:
+            limit = base[metric] * (1 + tolerance)
+            if stats[metric] > limit:
+                regressions.append('{}: {} {} > baseline {}'.format(
+                    name, metric, stats[metric], base[metric]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-k', dest='match', default='',
+                        help='only run scenarios containing this')
+    parser.add_argument('--iterations', type=int, default=300)
+    parser.add_argument('--allocations', type=int, default=30)
+    parser.add_argument('--warmup', type=int, default=20)
+    parser.add_argument('--save', help='write results as a baseline')
+    parser.add_argument('--compare', help='baseline to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    # eager Celery tasks still warn about the unused broker url
+    logging.getLogger('kombu').setLevel(logging.ERROR)
+    with tempfile.TemporaryDirectory() as workdir:
+        suite = scenarios(Fixtures(workdir))
+        results = OrderedDict()
+        print('{:28} {:>9} {:>9} {:>9} {:>9} {:>9}'.format(
+            'scenario', 'p50 us', 'p90 us', 'p99 us', 'peak KiB',
+            'kept KiB'))
+        for name, (prepare, run) in suite.items():
+            if args.match not in name:
+                continue
+            stats = measure(prepare, run, args.iterations,
+                            args.allocations, args.warmup)
+            results[name] = stats
+            print('{:28} {:>9} {:>9} {:>9} {:>9} {:>9}'.format(
+                name, stats['p50_us'], stats['p90_us'], stats['p99_us'],
+                stats['peak_kib'], stats['retained_kib']))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'python': platform.python_version(),
+                       'machine': platform.machine(),
+                       'scenarios': results}, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['scenarios']
+        regressions = compare(results, baseline, args.tolerance)
+        for line in regressions:
+            print('REGRESSION ' + line)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,552 @@
+#!/usr/bin/python3
+"""
+Load generator and traffic replay for the Messenger, Slack and API apps:
+
+    $ export PYTHONPATH=src/components:src
+    $ python3 benchmarks/loadgen.py synth --users 500 \\
+          --out conversations.jsonl
+    $ python3 benchmarks/loadgen.py convert recorded.jsonl \\
+          --out conversations.jsonl
+    $ python3 benchmarks/loadgen.py run conversations.jsonl \\
+          --concurrency 50 --rounds 2
+
+synth writes seeded conversations built from the data dump: Messenger
+postbacks, quick replies, free text with and without nlp entities and
+pinned locations, plus Slack slash commands and API lookups. convert
+groups a recording made with PLANBOT_RECORD (see traffic.py) into one
+conversation per sender.
+
+run replays the conversations through --concurrency virtual users. Each
+plays one conversation's turns in order, waiting for every reply, and
+moves on to the next conversation as soon as it finishes. Every round
+replays the whole set under fresh user ids. Without --facebook, --slack
+or --api urls the apps are served in process against the stand-ins in
+standins.py, with the Graph API and Slack's response_url stubbed by
+fakegraph.py: as three WSGI apps, or with --gateway as the single asyncio
+gateway. It reports throughput and p50/p95/p99 latency per turn type
+and exits non-zero if any turn failed.
+"""
+
+import argparse
+import asyncio
+import copy
+import json
+import logging
+import queue
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import quote
+from wsgiref.simple_server import make_server
+
+import requests
+
+import fakegraph
+import pack
+from bench import percentile, typo
+from standins import DUMP, Fixtures, councils, postcode_rows
+
+SEED = 1
+PAGE_ID = 'loadgen-page'
+SLACK_TOKEN = 'loadgen'
+TIMEOUT = 30
+
+# share of synthesised conversations per app
+MIX = {'facebook': 0.8, 'slack': 0.1, 'api': 0.1}
+
+# Messenger flows and how often a conversation picks each
+FLOWS = OrderedDict([('define', 5), ('use', 2), ('project', 2),
+                     ('document', 1), ('local_plan', 3), ('reports', 2),
+                     ('cancel', 1), ('contact', 1)])
+
+NLP = {'greetings': ['Hi', 'Hello', 'Hey there', 'Good morning'],
+       'thanks': ['Thanks', 'Thank you!', 'Cheers'],
+       'bye': ['Bye', 'See you']}
+STRAY = ['help', 'what can you do?', 'planning permission',
+         'is anyone there', 'ok']
+
+SLACK_COMMANDS = OrderedDict([('define', 'definitions'),
+                              ('use', 'use_classes'),
+                              ('project', 'projects'),
+                              ('doc', 'documents'),
+                              ('lp', 'local_plans')])
+
+
+def webhook(user, event, clock):
+    """Wrap a messaging event in a Messenger webhook body."""
+
+    event = dict(event, sender={'id': user}, recipient={'id': PAGE_ID},
+                 timestamp=clock)
+    return {'object': 'page',
+            'entry': [{'id': PAGE_ID, 'time': clock, 'messaging': [event]}]}
+
+
+def postback(payload):
+    return 'postback', {'postback': {'payload': payload, 'title': payload}}
+
+
+def quick_reply(text):
+    return 'quick_reply', {'message': {
+        'text': text, 'quick_reply': {'payload': 'empty'},
+        'nlp': {'entities': {}}}}
+
+
+def text(words, entity=None, nlp=True):
+    """A free-text message, with built-in NLP entities unless nlp is
+       False, as when the page has NLP switched off."""
+
+    message = {'text': words}
+    if entity:
+        message['nlp'] = {'entities': {entity: [
+            {'confidence': 0.99, 'value': 'true', '_entity': entity}]}}
+        return 'nlp', {'message': message}
+    if nlp:
+        message['nlp'] = {'entities': {}}
+    return 'text', {'message': message}
+
+
+def location(lat, long):
+    return 'location', {'message': {'attachments': [{
+        'title': 'Pinned Location', 'type': 'location',
+        'url': 'https://www.bing.com/maps/default.aspx?where1={},{}'.format(
+            lat, long),
+        'payload': {'coordinates': {'lat': lat, 'long': long}}}]}}
+
+
+def classify(body):
+    """Return the turn type of a recorded Messenger webhook body."""
+
+    try:
+        event = body['entry'][0]['messaging'][0]
+    except (KeyError, IndexError, TypeError):
+        return 'other'
+    if 'postback' in event:
+        return 'postback'
+    message = event.get('message') or {}
+    if message.get('attachments'):
+        return 'location'
+    if message.get('quick_reply'):
+        return 'quick_reply'
+    entities = (message.get('nlp') or {}).get('entities') or {}
+    if any(entity in NLP for entity in entities):
+        return 'nlp'
+    return 'text'
+
+
+class Synthesiser():
+    """Builds seeded conversations from the keys, report sections and
+       made-up postcodes the stand-ins serve."""
+
+    def __init__(self, seed=SEED, mix=MIX):
+        self.rng = random.Random(seed)
+        self.mix = mix
+        dump = pack.read_dump(DUMP)
+        self.keys = {table: sorted(row[0] for row in rows)
+                     for table, (columns, rows) in dump.items()
+                     if columns[:2] == ['key', 'value']}
+        columns, rows = dump['reports']
+        self.sections = sorted({
+            (row[columns.index('location')], row[columns.index('sector')])
+            for row in rows if row[columns.index('sector')]})
+        self.places = postcode_rows(councils(self.keys['local_plans']))
+
+    def term(self, table, typos=0.2):
+        key = self.rng.choice(self.keys[table])
+        if self.rng.random() < typos:
+            key = typo(key, self.rng)
+        return key if self.rng.random() < 0.5 else key.capitalize()
+
+    def flow(self, name):
+        rng = self.rng
+        if name == 'define':
+            turns = [postback('DEFINE_PAYLOAD'),
+                     text(self.term('definitions'))]
+            if rng.random() < 0.3:
+                turns.append(text(self.term('definitions')))
+        elif name == 'use':
+            turns = [postback('USE_PAYLOAD'),
+                     quick_reply('List all') if rng.random() < 0.4
+                     else text(self.term('use_classes'))]
+        elif name == 'project':
+            turns = [postback('PD_PAYLOAD'), text(self.term('projects'))]
+        elif name == 'document':
+            turns = [postback('DOC_PAYLOAD'), text(self.term('documents'))]
+        elif name == 'local_plan':
+            postcode, council, lat, long = rng.choice(self.places)
+            pick = rng.random()
+            turns = [postback('LP_PAYLOAD'),
+                     text(council) if pick < 0.4 else
+                     text(postcode) if pick < 0.7 else
+                     location(round(lat + rng.uniform(-0.001, 0.001), 6),
+                              round(long + rng.uniform(-0.001, 0.001), 6))]
+        elif name == 'reports':
+            loc, sector = rng.choice(self.sections)
+            turns = [postback('REPORT_PAYLOAD'),
+                     quick_reply('UK' if loc == 'uk' else loc.capitalize()),
+                     quick_reply(sector.title())]
+            if rng.random() < 0.3:
+                turns.append(quick_reply('More'))
+        elif name == 'cancel':
+            turns = [postback(rng.choice(['DEFINE_PAYLOAD', 'PD_PAYLOAD',
+                                          'LP_PAYLOAD', 'REPORT_PAYLOAD'])),
+                     quick_reply('Cancel')]
+        else:
+            turns = [postback('CONTACT_PAYLOAD')]
+        return turns
+
+    def messenger(self, user):
+        rng = self.rng
+        events = []
+        if rng.random() < 0.3:
+            events.append(postback('GET_STARTED_PAYLOAD'))
+        elif rng.random() < 0.5:
+            events.append(text(rng.choice(NLP['greetings']), 'greetings'))
+
+        names, weights = list(FLOWS), list(FLOWS.values())
+        for name in rng.choices(names, weights, k=rng.randint(1, 3)):
+            events.extend(self.flow(name))
+            if rng.random() < 0.1:
+                events.append(text(rng.choice(STRAY),
+                                   nlp=rng.random() < 0.5))
+
+        if rng.random() < 0.4:
+            entity = rng.choice(['thanks', 'bye'])
+            events.append(text(rng.choice(NLP[entity]), entity))
+        elif rng.random() < 0.3:
+            events.append(quick_reply('Thanks, bye!'))
+
+        return [{'app': 'facebook', 'kind': kind,
+                 'body': webhook(user, event, 1000 * i)}
+                for i, (kind, event) in enumerate(events)]
+
+    def slack(self, user):
+        turns = []
+        for _ in range(self.rng.randint(1, 3)):
+            cmd = self.rng.choice(list(SLACK_COMMANDS))
+            query = self.term(SLACK_COMMANDS[cmd])
+            if cmd == 'lp' and self.rng.random() < 0.5:
+                query = self.rng.choice(self.places)[0]
+            turns.append({'app': 'slack', 'kind': 'slack:' + cmd,
+                          'body': {'command': '/' + cmd, 'text': query,
+                                   'user_id': user}})
+        return turns
+
+    def api(self, user):
+        turns = []
+        for _ in range(self.rng.randint(1, 5)):
+            action = self.rng.choice(list(SLACK_COMMANDS))
+            if self.rng.random() < 0.05:
+                path = '/' + action
+            else:
+                query = self.term(SLACK_COMMANDS[action], typos=0.1)
+                path = '/{}/{}'.format(action, quote(
+                    query.replace(' ', '-'), safe='-'))
+            turns.append({'app': 'api', 'kind': 'api:' + action,
+                          'path': path})
+        return turns
+
+    def conversation(self, n):
+        user = 'user-{:05}'.format(n)
+        apps, weights = list(self.mix), list(self.mix.values())
+        app = self.rng.choices(apps, weights)[0]
+        return {'user': user, 'turns': getattr(
+            self, 'messenger' if app == 'facebook' else app)(user)}
+
+
+def convert(lines):
+    """Group recorded webhook bodies into one conversation per sender, in
+       the order they arrived."""
+
+    conversations = OrderedDict()
+    records = sorted((json.loads(line) for line in lines if line.strip()),
+                     key=lambda record: record['time'])
+    for record in records:
+        body = record['body']
+        try:
+            user = body['entry'][0]['messaging'][0]['sender']['id']
+        except (KeyError, IndexError, TypeError):
+            continue
+        conversations.setdefault(user, []).append(
+            {'app': 'facebook', 'kind': classify(body), 'body': body})
+    return [{'user': user, 'turns': turns}
+            for user, turns in conversations.items()]
+
+
+def with_sender(body, user):
+    body = copy.deepcopy(body)
+    for entry in body.get('entry') or []:
+        for event in entry.get('messaging') or []:
+            event['sender'] = {'id': user}
+    return body
+
+
+class Target():
+    """Sends turns to the apps at urls, a dict of app name to base url.
+       Slack answers are posted to stub, a running fakegraph.py."""
+
+    def __init__(self, urls, stub=None, slack_token=SLACK_TOKEN):
+        self.urls = urls
+        self.stub = stub
+        self.slack_token = slack_token
+
+    def send(self, session, turn, user):
+        url = self.urls[turn['app']]
+        if turn['app'] == 'facebook':
+            return session.post(url + '/facebook',
+                                json=with_sender(turn['body'], user),
+                                timeout=TIMEOUT)
+        elif turn['app'] == 'slack':
+            form = dict(turn['body'], token=self.slack_token, user_id=user,
+                        response_url='{}/slack/{}'.format(self.stub, user))
+            return session.post(url + '/slack', data=form, timeout=TIMEOUT)
+        return session.get(url + turn['path'], timeout=TIMEOUT)
+
+
+def run(conversations, target, concurrency, rounds=1, think=0):
+    """Play conversations through concurrent virtual users and return
+       (kind, seconds, ok) for every turn, and the wall time taken."""
+
+    jobs = queue.Queue()
+    for r in range(rounds):
+        for conversation in conversations:
+            turns = [turn for turn in conversation['turns']
+                     if turn['app'] in target.urls]
+            jobs.put(('{}-{}'.format(conversation['user'], r), turns))
+
+    samples = []
+    lock = threading.Lock()
+
+    def virtual_user():
+        session = requests.Session()
+        while True:
+            try:
+                user, turns = jobs.get_nowait()
+            except queue.Empty:
+                return
+            for turn in turns:
+                start = time.perf_counter()
+                try:
+                    ok = target.send(session, turn, user).status_code < 400
+                except requests.RequestException as err:
+                    logging.warning('{} turn failed: {}'.format(
+                        turn['kind'], err))
+                    ok = False
+                seconds = time.perf_counter() - start
+                with lock:
+                    samples.append((turn['kind'], seconds, ok))
+                if think:
+                    time.sleep(think)
+
+    threads = [threading.Thread(target=virtual_user, daemon=True)
+               for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples, time.perf_counter() - start
+
+
+def summarise(samples, elapsed):
+    kinds = OrderedDict()
+    for kind, seconds, ok in sorted(samples):
+        kinds.setdefault(kind, []).append((seconds, ok))
+    kinds['all'] = sorted((seconds, ok) for _, seconds, ok in samples)
+
+    results = OrderedDict()
+    for kind, rows in kinds.items():
+        times = sorted(seconds for seconds, _ in rows)
+        results[kind] = OrderedDict([
+            ('turns', len(rows)),
+            ('errors', sum(1 for _, ok in rows if not ok)),
+            ('per_second', round(len(rows) / elapsed, 1) if elapsed else 0),
+            ('p50_ms', round(percentile(times, 0.5) * 1000, 2)),
+            ('p95_ms', round(percentile(times, 0.95) * 1000, 2)),
+            ('p99_ms', round(percentile(times, 0.99) * 1000, 2))])
+    return results
+
+
+def serve(app):
+    server = make_server('localhost', 0, app,
+                         server_class=fakegraph.ThreadingServer,
+                         handler_class=fakegraph.QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return 'http://localhost:{}'.format(server.server_port)
+
+
+def serve_apps(workdir):
+    """Serve the three apps in process against the stand-ins. Returns a
+       Target for them and the in-process Messenger dispatcher."""
+
+    Fixtures(workdir)
+    stub = fakegraph.serve()
+
+    import api
+    import facebook
+    import session
+    import slack
+
+    session.SESSION_STORE = 'memory'
+    facebook.dispatcher.url = stub + '/v2.9/me/messages'
+    slack.VERIFY_TOKEN = SLACK_TOKEN
+    urls = {'facebook': serve(facebook.app), 'slack': serve(slack.app),
+            'api': serve(api.app)}
+    return Target(urls, stub), facebook.dispatcher.join
+
+
+def serve_gateway(workdir):
+    """Serve the three apps from one asyncio gateway on its own thread,
+       against the stand-ins. Returns a Target for it and a function that
+       waits for its Messenger dispatcher."""
+
+    Fixtures(workdir)
+    stub = fakegraph.serve()
+
+    from aiohttp import web
+
+    import gateway
+    import session
+    import slack
+
+    session.SESSION_STORE = 'memory'
+    slack.VERIFY_TOKEN = SLACK_TOKEN
+    gw = gateway.Gateway(graph_url=stub + '/v2.9/me/messages')
+    loop = asyncio.new_event_loop()
+    runner = web.AppRunner(gateway.make_app(gw), access_log=None)
+
+    async def start():
+        await runner.setup()
+        await web.TCPSite(runner, 'localhost', 0).start()
+
+    loop.run_until_complete(start())
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    host, port = runner.addresses[0][:2]
+    url = 'http://{}:{}'.format(host, port)
+
+    def join():
+        asyncio.run_coroutine_threadsafe(gw.dispatcher.join(), loop).result()
+    return Target({app: url for app in MIX}, stub), join
+
+
+def read_conversations(path):
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def write_conversations(conversations, path):
+    with open(path, 'w', encoding='utf-8') as f:
+        for conversation in conversations:
+            f.write(json.dumps(conversation) + '\n')
+    turns = sum(len(c['turns']) for c in conversations)
+    print('Wrote {} conversations, {} turns to {}'.format(
+        len(conversations), turns, path))
+
+
+def report(results, elapsed, concurrency):
+    print('{:20} {:>7} {:>7} {:>8} {:>9} {:>9} {:>9}'.format(
+        'turn type', 'turns', 'errors', 'turns/s', 'p50 ms', 'p95 ms',
+        'p99 ms'))
+    for kind, stats in results.items():
+        print('{:20} {:>7} {:>7} {:>8} {:>9} {:>9} {:>9}'.format(
+            kind, *stats.values()))
+    print('{} turns in {:.1f}s from {} virtual users'.format(
+        results['all']['turns'], elapsed, concurrency))
+
+
+def parse_mix(value):
+    mix = OrderedDict()
+    for part in value.split(','):
+        app, _, share = part.partition('=')
+        if app not in MIX:
+            raise argparse.ArgumentTypeError('unknown app ' + app)
+        mix[app] = float(share)
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    commands = parser.add_subparsers(dest='command')
+
+    synth = commands.add_parser('synth', help='synthesise conversations')
+    synth.add_argument('--users', type=int, default=200)
+    synth.add_argument('--seed', type=int, default=SEED)
+    synth.add_argument('--mix', type=parse_mix, default=MIX,
+                       help='app shares, e.g. facebook=0.8,slack=0.1,api=0.1')
+    synth.add_argument('--out', required=True)
+
+    conv = commands.add_parser('convert', help='convert a recording')
+    conv.add_argument('recording')
+    conv.add_argument('--out', required=True)
+
+    play = commands.add_parser('run', help='replay conversations')
+    play.add_argument('conversations')
+    play.add_argument('--concurrency', type=int, default=20)
+    play.add_argument('--rounds', type=int, default=1)
+    play.add_argument('--think', type=float, default=0,
+                      help='seconds each user waits between turns')
+    play.add_argument('--facebook', help='base url of the Messenger app')
+    play.add_argument('--slack', help='base url of the Slack app')
+    play.add_argument('--api', help='base url of the API app')
+    play.add_argument('--stub', help='base url of a fakegraph.py that '
+                      'Slack answers are posted to')
+    play.add_argument('--slack-token', default=SLACK_TOKEN)
+    play.add_argument('--gateway', action='store_true',
+                      help='serve the apps in process from gateway.py')
+    play.add_argument('--json', help='write results to this file')
+    args = parser.parse_args()
+
+    if args.command == 'synth':
+        synthesiser = Synthesiser(args.seed, args.mix)
+        write_conversations([synthesiser.conversation(n)
+                             for n in range(args.users)], args.out)
+        return 0
+    elif args.command == 'convert':
+        with open(args.recording, encoding='utf-8') as f:
+            write_conversations(convert(f), args.out)
+        return 0
+    elif args.command != 'run':
+        parser.print_help()
+        return 2
+
+    conversations = read_conversations(args.conversations)
+    urls = {app: getattr(args, app) for app in MIX if getattr(args, app)}
+    join = None
+    with tempfile.TemporaryDirectory() as workdir:
+        if urls:
+            if 'slack' in urls and not args.stub:
+                parser.error('--slack needs --stub for Slack answers')
+            target = Target(urls, args.stub, args.slack_token)
+        elif args.gateway:
+            target, join = serve_gateway(workdir)
+        else:
+            target, join = serve_apps(workdir)
+        logging.getLogger().setLevel(logging.WARNING)
+        # eager Celery tasks still warn about the unused broker url
+        logging.getLogger('kombu').setLevel(logging.ERROR)
+
+        samples, elapsed = run(conversations, target, args.concurrency,
+                               args.rounds, args.think)
+        if join is not None:
+            join()
+            print('Graph stub received {} requests'.format(
+                len(fakegraph.received)))
+
+    if not samples:
+        print('No turns to send to ' + ', '.join(sorted(urls)))
+        return 1
+    results = summarise(samples, elapsed)
+    report(results, elapsed, args.concurrency)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'concurrency': args.concurrency,
+                       'rounds': args.rounds,
+                       'seconds': round(elapsed, 3),
+                       'turn_types': results}, f, indent=2)
+    return 1 if results['all']['errors'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,227 @@
+"""
+Local stand-ins for the services planbot talks to, seeded from the dump in
+src/components/data so that benchmarks run offline and reproducibly:
+
+* Postgres: the reference tables are served from a knowledge pack built
+  from the dump, and reports from an in-memory SQLite copy installed
+  behind ConnectDB's connection pool and AsyncConnectDB's.
+* Redis: Engine is given the in-memory session store, Celery tasks run
+  eagerly in process and the suggestion cache is off, so every miss
+  takes the full similarity path.
+* Word vectors: deterministic pseudo-random vectors for every word in the
+  data stand in for the spaCy model.
+* Postcodes.io: a local postcode index of made-up postcodes placed in
+  real council areas.
+"""
+
+import csv
+import os
+import random
+import re
+import sqlite3
+import threading
+import zlib
+
+import numpy
+
+import asyncdb
+import connectdb
+import pack
+import postcodes
+import suggestions
+import tasks
+import vectors
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                    '..', 'src', 'components', 'data')
+DUMP = os.path.join(DATA, 'planbot.SQL')
+VECTOR_WIDTH = 50
+
+
+class SqliteCursor():
+    """The subset of a psycopg2 cursor that ConnectDB's report queries
+       use, over SQLite. Rows are fetched as the query runs, under the
+       connection's lock, so one connection can serve many threads."""
+
+    def __init__(self, conn, lock):
+        self.conn, self.lock = conn, lock
+        self.rows = []
+
+    def execute(self, query, params=None):
+        if not isinstance(query, str):
+            raise NotImplementedError('Composed SQL is not supported')
+        with self.lock:
+            self.rows = self.conn.execute(query.replace('%s', '?'),
+                                          params or []).fetchall()
+
+    def fetchone(self):
+        return self.rows.pop(0) if self.rows else None
+
+    def fetchall(self):
+        rows, self.rows = self.rows, []
+        return rows
+
+    def close(self):
+        self.rows = []
+
+
+class SqliteConnection():
+
+    closed = 0
+    autocommit = True
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.lock = threading.Lock()
+
+    def cursor(self, cursor_factory=None):
+        return SqliteCursor(self.conn, self.lock)
+
+    def rollback(self):
+        return None
+
+
+class SqlitePool():
+    """Stands in for connectdb.ConnectionPool with one shared SQLite
+       connection."""
+
+    def __init__(self, conn):
+        self.conn = SqliteConnection(conn)
+        self.pid = os.getpid()
+
+    def getconn(self):
+        return self.conn
+
+    def putconn(self, conn):
+        return None
+
+    def closeall(self):
+        return None
+
+
+class AsyncSqlitePool():
+    """Stands in for an asyncpg pool in asyncdb over a shared SQLite
+       connection, translating $n placeholders."""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def acquire(self):
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return None
+
+    async def fetch(self, query, *args):
+        cursor = self.conn.cursor()
+        cursor.execute(re.sub(r'\$(\d+)', r'?\1', query), args)
+        return cursor.fetchall()
+
+    async def close(self):
+        return None
+
+
+def reports_db(rows):
+    """Return an in-memory SQLite database holding the reports rows, with
+       the index and sector view of data/reports.SQL and the reports row
+       of the data_versions table from data/notify.SQL."""
+
+    conn = sqlite3.connect(':memory:', check_same_thread=False)
+    conn.executescript('''
+        CREATE TABLE reports (date text, location text, sector text,
+                              title text, url text);
+        CREATE INDEX reports_location_sector_date
+            ON reports (location, sector, date DESC, title DESC, url DESC);
+        CREATE VIEW report_sectors AS
+            SELECT location, sector, count(*) AS reports FROM reports
+            WHERE location IS NOT NULL AND sector IS NOT NULL
+            GROUP BY location, sector;
+        CREATE TABLE data_versions (table_name text, version integer);
+        INSERT INTO data_versions VALUES ('reports', 1);''')
+    conn.executemany('INSERT INTO reports VALUES (?, ?, ?, ?, ?)', rows)
+    return conn
+
+
+def word_vectors(texts, path, width=VECTOR_WIDTH):
+    """Write a vector table for every word in texts, each word's vector
+       seeded from its crc32 so the table is the same on every run."""
+
+    words = sorted({token for text in texts
+                    for token in vectors.TOKEN.findall(text)
+                    if len(token.encode('utf-8')) <= vectors.WORD_WIDTH})
+    table = numpy.vstack([
+        numpy.random.RandomState(zlib.crc32(word.encode('utf-8')))
+        .standard_normal(width).astype(numpy.float32) for word in words])
+    vectors.write_table(path, words, table)
+    return path
+
+
+def postcode_rows(councils, seed=0):
+    """Return a made-up (postcode, council, lat, long) row per council,
+       the same on every run."""
+
+    rng = random.Random(seed)
+    return [('ZX{} {}AB'.format(i % 100, i // 100 + 1), council,
+             rng.uniform(50.5, 55.5), rng.uniform(-4.5, 1.5))
+            for i, council in enumerate(councils)]
+
+
+def councils(keys):
+    return [re.sub(r'\s+', ' ', key).strip() for key in keys]
+
+
+def postcode_index(rows, path):
+    """Build a postcode index from postcode_rows and return the
+       postcodes."""
+
+    source = os.path.join(path, 'postcodes.csv')
+    os.makedirs(path, exist_ok=True)
+    with open(source, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(['pcds', 'laua', 'lat', 'long', 'doterm'])
+        for row in rows:
+            writer.writerow(list(row) + [''])
+    postcodes.build(source, os.path.join(path, 'index'))
+    return [row[0] for row in rows]
+
+
+class Fixtures():
+    """Builds the stand-ins under workdir and installs them in the
+       planbot modules. Keeps the dump's rows for choosing inputs."""
+
+    def __init__(self, workdir):
+        self.dump = pack.read_dump(DUMP)
+        self.keys = {table: [row[0] for row in rows]
+                     for table, (columns, rows) in self.dump.items()
+                     if columns[:2] == ['key', 'value']}
+        columns, rows = self.dump['reports']
+        self.reports = [tuple(row[columns.index(c)] for c in
+                              ['date', 'location', 'sector', 'title', 'url'])
+                        for row in rows]
+
+        pack_path = os.path.join(workdir, 'planbot.pack')
+        pack.build(DUMP, pack_path)
+        connectdb.PACK_PATH, connectdb._pack = pack_path, None
+
+        texts = [key for keys in self.keys.values() for key in keys]
+        tasks.VECTORS = word_vectors(texts, os.path.join(workdir, 'words'))
+        tasks.app.conf.task_always_eager = True
+        suggestions.SIZE = 0
+        tasks.warm()
+
+        rows = postcode_rows(councils(self.keys['local_plans']))
+        self.postcodes = postcode_index(rows,
+                                        os.path.join(workdir, 'postcodes'))
+        postcodes.index = postcodes.PostcodeIndex(
+            os.path.join(workdir, 'postcodes', 'index'))
+        postcodes.REMOTE = False
+
+        # installed after warm(), which closes the pool before forking
+        connectdb._pool = SqlitePool(reports_db(self.reports))
+
+        async def create_pool():
+            return AsyncSqlitePool(connectdb._pool.conn)
+        asyncdb.create_pool = create_pool
@@ -0,0 +1,119 @@
+#!/usr/bin/python3
+"""
+Cold-start cost of each entry point: the time to import it in a fresh
+interpreter, the resident memory it adds, and which heavy dependencies it
+pulls in on the way:
+
+    $ python3 benchmarks/startup.py
+    $ python3 benchmarks/startup.py --save benchmarks/startup.json
+    $ python3 benchmarks/startup.py --compare benchmarks/startup.json
+
+Every entry point is imported --runs times, each in a new process, and the
+median is reported. RSS is the process's resident memory after the import
+less that of a bare interpreter. A comparison exits non-zero if an entry
+point's import time or RSS exceeds its baseline by more than --tolerance,
+or if it loads a heavy module its baseline did not.
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+from collections import OrderedDict
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+ENTRY_POINTS = ['api', 'slack', 'facebook', 'gateway', 'engine', 'tasks']
+HEAVY = ['spacy', 'numpy', 'Levenshtein', 'celery', 'redis', 'requests',
+         'psycopg2', 'bottle', 'aiohttp', 'asyncpg']
+COMPARED = ['import_ms', 'rss_kib']
+
+PROBE = '''
+import json, os, sys, time
+start = time.perf_counter()
+if sys.argv[1]:
+    __import__(sys.argv[1])
+elapsed = time.perf_counter() - start
+with open('/proc/self/statm') as f:
+    rss = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+print(json.dumps({'seconds': elapsed, 'rss': rss,
+                  'loaded': [m for m in sys.argv[2:] if m in sys.modules]}))
+'''
+
+
+def probe(module):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        [os.path.join(ROOT, 'components'), ROOT]))
+    out = subprocess.run([sys.executable, '-c', PROBE, module] + HEAVY,
+                         env=env, stdout=subprocess.PIPE,
+                         stderr=subprocess.DEVNULL, check=True)
+    return json.loads(out.stdout.decode().strip().splitlines()[-1])
+
+
+def measure(module, runs, bare_rss):
+    samples = [probe(module) for _ in range(runs)]
+    return OrderedDict([
+        ('import_ms', round(statistics.median(
+            s['seconds'] for s in samples) * 1000, 1)),
+        ('rss_kib', round((statistics.median(
+            s['rss'] for s in samples) - bare_rss) / 1024)),
+        ('loaded', samples[-1]['loaded'])])
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, stats in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        for metric in COMPARED:
+            if stats[metric] > base[metric] * (1 + tolerance):
+                regressions.append('{}: {} {} > baseline {}'.format(
+                    name, metric, stats[metric], base[metric]))
+        added = sorted(set(stats['loaded']) - set(base['loaded']))
+        if added:
+            regressions.append('{}: now loads {}'.format(
+                name, ', '.join(added)))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('entry_points', nargs='*', default=ENTRY_POINTS)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--save', help='write results as a baseline')
+    parser.add_argument('--compare', help='baseline to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    args = parser.parse_args()
+
+    bare_rss = statistics.median(probe('')['rss'] for _ in range(args.runs))
+    results = OrderedDict()
+    print('{:12} {:>10} {:>10}  {}'.format('entry point', 'import ms',
+                                           'RSS KiB', 'heavy modules'))
+    for name in args.entry_points:
+        stats = measure(name, args.runs, bare_rss)
+        results[name] = stats
+        print('{:12} {:>10} {:>10}  {}'.format(
+            name, stats['import_ms'], stats['rss_kib'],
+            ', '.join(stats['loaded']) or '-'))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'python': platform.python_version(),
+                       'machine': platform.machine(),
+                       'entry_points': results}, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['entry_points']
+        regressions = compare(results, baseline, args.tolerance)
+        for line in regressions:
+            print('REGRESSION ' + line)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
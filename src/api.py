@@ -3,77 +3,305 @@
 Handle GET requests to api.planbot.co domain. Returns 'result' key if
 'success' key is true, or 'reason' key if 'success' is false. The result
 value is simply the response from the relevant planbot api call.
+
+Answers are cached per (action, query) for a per-action TTL and carry a
+strong ETag derived from the table's data version, so repeat requests with
+If-None-Match get a 304 without a database lookup. Failed lookups, and
+answers made by the in-process spell checker while Celery was slow, are
+not cached.
 """
 
+import csv
+import hashlib
+import io
 import json
 import logging
+import os
+import re
+import time
+import zlib
+from collections import namedtuple
+from email.utils import formatdate
 
-from bottle import Bottle, response
+from bottle import Bottle, request, response
 
 from planbot import Planbot
-from connectdb import ConnectDB
+from connectdb import ConnectDB, known_version
+from dbcache import LRUCache
+import metrics
+
+CACHE_SIZE = int(os.environ.get('PLANBOT_API_CACHE', 4096))
+MAX_BATCH = int(os.environ.get('PLANBOT_API_MAX_BATCH', 1000))
+MAX_PAGE = int(os.environ.get('PLANBOT_API_MAX_PAGE', 1000))
+# seconds a lookup or batch has to answer
+DEADLINE = float(os.environ.get('PLANBOT_API_DEADLINE', 5))
 
 logging.basicConfig(level=logging.INFO)
 app = application = Bottle()
 
-if __name__ == '__main__':
-    app.run()
+CachedResponse = namedtuple('CachedResponse',
+                            'body etag version modified expires')
+cache = LRUCache(CACHE_SIZE)
+# an entity tag in an If-None-Match list, with its weakness prefix
+ENTITY_TAG = re.compile(r'(?:W/)?("[^"]*")')
+
+
+@app.get('/export/<action>')
+def export(action):
+    """Stream a whole table as NDJSON (default) or CSV, optionally gzipped.
+       Rows come from a server-side cursor, so memory use stays flat."""
+
+    table = export_switch.get(action)
+    fmt = request.query.get('format', 'ndjson')
+    if not table or fmt not in ['ndjson', 'csv']:
+        response.status = 404
+        response.headers['Content-Type'] = 'application/json'
+        return json.dumps({'success': False,
+                           'error': 'Export \'{}\' not found'.format(
+                               action if not table else fmt)})
+
+    values = request.query.get('values') == '1'
+    response.headers['Content-Type'] = 'text/csv' if fmt == 'csv' \
+        else 'application/x-ndjson'
+    chunks = encode_rows(table, values, fmt)
+    if request.query.get('gzip') == '1':
+        response.headers['Content-Encoding'] = 'gzip'
+        chunks = gzipped(chunks)
+    return chunks
+
+
+def encode_rows(table, values, fmt, chunk_size=65536):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    with ConnectDB(table) as db:
+        columns = db.columns(values)
+        if fmt == 'csv':
+            writer.writerow(columns)
+        for row in db.stream_rows(values=values):
+            if fmt == 'csv':
+                writer.writerow(row)
+            else:
+                buf.write(json.dumps(dict(zip(columns, row))) + '\n')
+            if buf.tell() > chunk_size:
+                yield buf.getvalue().encode('utf-8')
+                buf.seek(0)
+                buf.truncate()
+    yield buf.getvalue().encode('utf-8')
+
+
+def gzipped(chunks):
+    compressor = zlib.compressobj(wbits=31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
 
 
 @app.get('/<path:path>')
 def process_params(path):
     response.headers['Content-Type'] = 'application/json'
+    after = request.query.get('after')
+    limit = request.query.get('limit')
+    params, key = request_key(path, after, limit)
+    table = switch.get(key[0])
+    entry = cache.get(key, None)
+    if entry is None or not fresh(entry, table):
+        metrics.cache_requests.inc(cache='api', result='miss')
+        version = data_version(table)
+        entry = cache_response(key, version, answer(params, after, limit))
+    else:
+        metrics.cache_requests.inc(cache='api', result='hit')
+
+    response.headers.update(entry_headers(entry))
+    if etag_matches(entry.etag, request.headers.get('If-None-Match')):
+        response.status = 304
+        return ''
+    return entry.body
+
+
+def request_key(path, after=None, limit=None):
+    """Return the parameters of a lookup path and its cache key."""
+
     path = path.replace('-', ' ').replace('_', ' ').replace('%20', ' ')
-    params = path.strip('/').split('/')
+    params = [param.strip().lower() for param in path.strip('/').split('/')]
+    key = tuple(params)
+    if after is not None or limit is not None:
+        key += ('after', after, 'limit', limit)
+    return params, key
+
+
+def etag_matches(etag, header):
+    """Return True if an If-None-Match header matches etag: it is * or
+       lists the same entity tag, compared weakly as RFC 7232 asks."""
+
+    if not header:
+        return False
+    if header.strip() == '*':
+        return True
+    return etag in ENTITY_TAG.findall(header)
+
+
+def entry_headers(entry):
+    return {'ETag': entry.etag,
+            'Last-Modified': formatdate(entry.modified, usegmt=True),
+            'Cache-Control': 'public, max-age={}'.format(
+                max(int(entry.expires - time.time()), 0))}
+
+
+@app.post('/batch')
+def process_batch():
+    """Answer many queries at once. Takes a JSON list of [action, query]
+       pairs, or {"queries": [...]}, and returns a list of answers in the
+       same order, each shaped like a single /<action>/<query> answer."""
+
+    response.headers['Content-Type'] = 'application/json'
+    try:
+        data = request.json
+    except ValueError:
+        data = None
+    pairs = data.get('queries') if isinstance(data, dict) else data
+
+    if not isinstance(pairs, list) or \
+            not all(isinstance(p, list) and len(p) == 2 for p in pairs):
+        resp = {'success': False,
+                'error': 'Expected a list of [action, query] pairs'}
+    elif len(pairs) > MAX_BATCH:
+        resp = {'success': False,
+                'error': 'At most {} queries per batch'.format(MAX_BATCH)}
+    else:
+        resp = {'success': True, 'result': answer_batch(pairs)}
+
+    return json.dumps(resp)
+
+
+def answer_batch(pairs):
+    answers = [None] * len(pairs)
+    tasks, positions = [], []
+    for pos, (action, param) in enumerate(pairs):
+        if action not in switch:
+            answers[pos] = {'success': False,
+                            'error': 'Action \'{}\' not found'.format(action)}
+        elif not isinstance(param, str) or not param:
+            answers[pos] = {'success': False,
+                            'error': 'Invalid query \'{}\''.format(param)}
+        else:
+            tasks.append((switch[action], param))
+            positions.append(pos)
 
+    pb = Planbot()
+    results = pb.run_batch(tasks, time.time() + DEADLINE)
+    for i, (pos, (result, options)) in enumerate(zip(positions, results)):
+        answers[pos] = format_answer(pairs[pos][1], result, options,
+                                     pb.sources[i])
+
+    return answers
+
+
+def answer(params, after=None, limit=None):
     if len(params) == 1:
-        resp = return_all_data(params[0])
+        resp = return_all_data(params[0], after=after, limit=limit)
     elif len(params) == 2:
         resp = answer_query(params)
     else:
         resp = {'success': False, 'error': 'Invalid number of parameters'}
 
-    return json.dumps(resp)
+    return resp
 
 
-def return_all_data(action):
-    resp = dict()
+def data_version(table):
+    """Return the data version of a table, or None for an unknown table."""
+
+    if not table:
+        return None
+
+    version = known_version(table)
+    if version is None:
+        with ConnectDB(table) as db:
+            version = db.data_version()
+    return version
+
+
+def fresh(entry, table):
+    if entry.expires < time.time():
+        return False
+    # with no cheap version check, rely on the TTL alone
+    version = known_version(table) if table else None
+    return version is None or entry.version == version
 
+
+def cache_response(key, version, resp):
+    """Return an entry for a response, cached unless the lookup failed or
+       was answered by the spell check fallback, so the next request may
+       do better."""
+
+    body = json.dumps(resp)
+    digest = hashlib.sha1('{}:{}'.format(version, body).encode('utf-8'))
+    now = time.time()
+    keep = resp.get('success') and resp.get('source') != 'spell_check'
+    life = ttl.get(key[0], 60) if keep else 0
+    entry = CachedResponse(body=body,
+                           etag='"{}"'.format(digest.hexdigest()),
+                           version=version,
+                           modified=now,
+                           expires=now + life)
+    if keep:
+        cache.put(key, entry)
+    return entry
+
+
+def return_all_data(action, after=None, limit=None):
+    """Return every key for an action, or one page of keys in key order
+       if after or limit is given. A full page includes a 'next' key to
+       pass as after for the following page."""
+
+    paged = after is not None or limit is not None
     try:
-        db = ConnectDB(switch[action])
-        res = db.query_keys()
-    except KeyError:
-        resp['success'] = False
-        resp['error'] = 'Action \'{}\' not found'.format(action)
-    else:
-        resp['success'] = True
-        resp['result'] = res
-        db.close()
-    finally:
-        return resp
+        size = min(max(int(limit or MAX_PAGE), 1), MAX_PAGE)
+    except ValueError:
+        return {'success': False,
+                'error': 'Invalid limit \'{}\''.format(limit)}
+    if action not in switch:
+        return {'success': False,
+                'error': 'Action \'{}\' not found'.format(action)}
+
+    with ConnectDB(switch[action]) as db:
+        if paged:
+            res = [row[0] for row in db.query_page(after, size)]
+        else:
+            res = db.query_keys()
+
+    resp = {'success': True, 'result': res}
+    if paged and len(res) == size:
+        resp['next'] = res[-1]
+    return resp
 
 
 def answer_query(params):
     action, param = params
-    resp = dict()
+    if action not in switch:
+        return {'success': False,
+                'error': 'Action \'{}\' not found'.format(action)}
 
-    try:
-        pb = Planbot()
-        result, options = pb.run_task(action=switch[action], query=param)
-    except KeyError:
+    pb = Planbot()
+    result, options = pb.run_task(action=switch[action], query=param,
+                                  deadline=time.time() + DEADLINE)
+    return format_answer(param, result, options, pb.source)
+
+
+def format_answer(param, result, options, source=None):
+    resp = dict()
+    if not result and not options:
         resp['success'] = False
-        resp['error'] = 'Action \'{}\' not found'.format(action)
+        resp['error'] = 'No result found for \'{}\''.format(param)
     else:
-        if not result and not options:
-            resp['success'] = False
-            resp['error'] = 'No result found for \'{}\''.format(param)
-        else:
-            resp['success'] = True
-            resp['result'] = {
-                'value': result,
-                'options': options}
-    finally:
-        return resp
+        resp['success'] = True
+        resp['result'] = {
+            'value': result,
+            'options': options}
+        if source:
+            resp['source'] = source
+    return resp
 
 
 switch = {
@@ -82,3 +310,19 @@ switch = {
     'project': 'projects',
     'doc': 'documents',
     'lp': 'local_plans'}
+
+export_switch = dict(switch, report='reports')
+
+# seconds an answer may be cached, per action
+ttl = {
+    'define': 86400,
+    'use': 86400,
+    'project': 3600,
+    'doc': 3600,
+    'lp': 3600}
+
+metrics.instrument(app, 'api')
+
+
+if __name__ == '__main__':
+    app.run()
@@ -0,0 +1,276 @@
+"""
+Coroutine versions of the ConnectDB reads a conversation turn or API
+lookup makes, for the asyncio gateway (see gateway.py). Tables held in a
+knowledge pack are answered from memory exactly as ConnectDB answers them.
+Other reads go to Postgres through one asyncpg pool per event loop, so a
+turn waiting on the database does not hold a thread. Results share
+ConnectDB's query cache and substring indexes.
+"""
+
+import asyncio
+import copy
+import functools
+import os
+
+import metrics
+from connectdb import (DSN, POOL_MIN, SUBSTRING_INDEX, ConnectDB,
+                       known_version, memoize_sectors, memoized_sectors,
+                       query_cache, substring_indexes)
+from dbcache import MISSING
+from substrings import SubstringIndex
+from titles import titlecase
+
+POOL_MAX = int(os.environ.get('PLANBOT_ASYNC_DB_POOL_MAX', 20))
+
+_pools = {}
+
+
+def connect_args(dsn=DSN):
+    """Translate a libpq DSN into asyncpg.create_pool keyword arguments."""
+
+    from psycopg2.extensions import parse_dsn
+
+    names = {'dbname': 'database', 'user': 'user', 'password': 'password',
+             'host': 'host', 'port': 'port'}
+    args = {names[k]: v for k, v in parse_dsn(dsn).items() if k in names}
+    if 'port' in args:
+        args['port'] = int(args['port'])
+    return args
+
+
+async def create_pool():
+    import asyncpg
+
+    return await asyncpg.create_pool(min_size=POOL_MIN, max_size=POOL_MAX,
+                                     **connect_args())
+
+
+def async_pool():
+    """Return an awaitable for the running loop's connection pool, which
+       is created by the first caller and shared by every later one."""
+
+    loop = asyncio.get_event_loop()
+    if loop not in _pools:
+        _pools[loop] = loop.create_task(create_pool())
+    return _pools[loop]
+
+
+async def close_pools():
+    """Close the running loop's connection pool."""
+
+    pool = _pools.pop(asyncio.get_event_loop(), None)
+    if pool is not None:
+        await (await pool).close()
+
+
+def missing_table(err):
+    # asyncpg.UndefinedTableError, without importing asyncpg for packs
+    return type(err).__name__ == 'UndefinedTableError'
+
+
+def cached(method):
+    """Serve an AsyncConnectDB read from the query cache when it is
+       enabled. Keys match ConnectDB's, so both share entries."""
+
+    @functools.wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        cache = query_cache()
+        if cache is None:
+            return await method(self, *args, **kwargs)
+
+        key = (method.__name__, args, tuple(sorted(kwargs.items())))
+        version = cache.version(self.table)
+        value = cache.get(self.table, key)
+        if value is MISSING:
+            metrics.cache_requests.inc(cache='query', result='miss')
+            value = await method(self, *args, **kwargs)
+            cache.put(self.table, key, copy.copy(value), version=version)
+        else:
+            metrics.cache_requests.inc(cache='query', result='hit')
+        return copy.copy(value)
+
+    return wrapper
+
+
+class AsyncConnectDB():
+    """Read a table of the planbot database from a coroutine. Each query
+       borrows a pooled connection for as long as it runs. Tables held in
+       a knowledge pack are read through a ConnectDB, which never opens a
+       connection for them."""
+
+    def __init__(self, table):
+        self.local = ConnectDB(table)
+        self.table = table
+        self.pack = self.local.pack
+        self.name = '"{}"'.format(table)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.local.close()
+
+    async def fetch(self, query, *args):
+        pool = await async_pool()
+        with metrics.timed('db', action=self.table):
+            async with pool.acquire() as conn:
+                rows = await conn.fetch(query, *args)
+        return [tuple(row) for row in rows]
+
+    async def fetchrow(self, query, *args):
+        rows = await self.fetch(query, *args)
+        return rows[0] if rows else None
+
+    @cached
+    async def data_version(self):
+        """Return the version of the table, as ConnectDB.data_version."""
+
+        if self.pack:
+            return self.pack.version
+
+        try:
+            res = await self.fetchrow('''SELECT version FROM data_versions
+                                         WHERE table_name=$1''', self.table)
+        except Exception as err:
+            if not missing_table(err):
+                raise
+            return 0
+        return res[0] if res else 0
+
+    @cached
+    async def query_response(self, context):
+        """Return response given message/context."""
+
+        assert self.table == 'responses'
+        if self.pack:
+            return self.local.query_response(context)
+
+        res = await self.fetchrow('''SELECT response, quickreplies
+                                     FROM responses WHERE context=$1''',
+                                  context)
+        if not res:
+            return await self.query_response('NO_PAYLOAD')
+        return {'text': res[0], 'quickreplies': res[1]}
+
+    @cached
+    async def query_keys(self):
+        """Return all keys from a table."""
+
+        assert self.table not in ['reports', 'responses']
+        if self.pack:
+            return self.local.query_keys()
+
+        rows = await self.fetch('SELECT key FROM {}'.format(self.name))
+        return [k[0] for k in rows]
+
+    @cached
+    async def query_titles(self):
+        """Return the titlecased keys of a table in sorted order."""
+
+        if self.pack:
+            return self.local.query_titles()
+        return sorted([titlecase(key) for key in await self.query_keys()])
+
+    async def substring_index(self):
+        cache = query_cache()
+        version = cache.version(self.table) if cache else 0
+        built = substring_indexes.get(self.table)
+        if built is None or built[0] != version:
+            built = (version, SubstringIndex(await self.query_keys()))
+            substring_indexes[self.table] = built
+        return built[1]
+
+    @cached
+    async def query_spec(self, phrase, spec=None):
+        """Look up a phrase, as ConnectDB.query_spec."""
+
+        assert self.table not in ['reports', 'responses']
+        assert spec in ['EQL', 'LIKE']
+        if self.pack:
+            return self.local.query_spec(phrase, spec=spec)
+
+        wildcard = any(char in phrase for char in '%_\\')
+        if spec == 'EQL':
+            return await self.fetchrow(
+                'SELECT * FROM {} WHERE key=$1'.format(self.name), phrase)
+        elif SUBSTRING_INDEX == 'memory' and not wildcard:
+            index = await self.substring_index()
+            return [(key,) for key in index.search(phrase)]
+        return await self.fetch(
+            'SELECT key FROM {} WHERE key LIKE $1'.format(self.name),
+            '%{}%'.format(phrase))
+
+    async def query_page(self, after=None, limit=100):
+        """Return up to limit keys in key order, starting after the given
+           key, as ConnectDB.query_page."""
+
+        assert self.table not in ['reports', 'responses']
+        if self.pack:
+            return self.local.query_page(after, limit)
+
+        if after is None:
+            return await self.fetch(
+                'SELECT key FROM {} ORDER BY key LIMIT $1'.format(self.name),
+                limit)
+        return await self.fetch(
+            'SELECT key FROM {} WHERE key > $1 ORDER BY key LIMIT $2'.format(
+                self.name), after, limit)
+
+    async def sector_map(self):
+        """Return {location: sorted sectors} for every report location,
+           kept until the reports version changes as ConnectDB.sector_map."""
+
+        assert self.table == 'reports'
+        version = known_version(self.table)
+        if version is None:
+            version = await self.data_version()
+        sectors = memoized_sectors(version)
+        if sectors is not None:
+            return sectors
+
+        try:
+            rows = await self.fetch('SELECT location, sector '
+                                    'FROM report_sectors')
+        except Exception as err:
+            if not missing_table(err):
+                raise
+            rows = await self.fetch('SELECT DISTINCT location, sector '
+                                    'FROM reports')
+
+        sectors = {}
+        for location, sector in rows:
+            sectors.setdefault(location, []).append(sector)
+        return memoize_sectors(version, {loc: sorted(secs)
+                                         for loc, secs in sectors.items()})
+
+    async def distinct_locations(self):
+        return sorted(await self.sector_map())
+
+    async def distinct_sectors(self, loc):
+        return list((await self.sector_map()).get(loc.lower(), []))
+
+    async def query_reports(self, loc=None, sec=None, limit=None,
+                            after=None):
+        """Return reports for a location and sector, as
+           ConnectDB.query_reports."""
+
+        assert self.table == 'reports'
+
+        if not loc:
+            return await self.fetch('''SELECT location, sector, title, date,
+                                       url FROM reports''')
+        elif not sec:
+            return await self.fetch('''SELECT sector, title, url FROM reports
+                                       WHERE location=$1''', loc)
+
+        query = '''SELECT title, url, date FROM reports
+                   WHERE location=$1 AND sector=$2'''
+        args = [loc, sec]
+        if after:
+            query += ' AND (date, title, url) < ($3, $4, $5)'
+            args.extend(after)
+        query += ' ORDER BY date DESC, title DESC, url DESC'
+        if limit:
+            args.append(limit)
+            query += ' LIMIT ${}'.format(len(args))
+        return await self.fetch(query, *args)
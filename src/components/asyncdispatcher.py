@@ -0,0 +1,107 @@
+import asyncio
+import logging
+
+import aiohttp
+
+import metrics
+from dispatcher import GRAPH_URL, retry_delay
+
+
+class AsyncDispatcher():
+    """Dispatcher for the asyncio gateway. Requests go out as tasks on the
+       event loop over a shared aiohttp session, each recipient's chained
+       behind its previous request so they arrive in order, with the same
+       typing and retry policy as Dispatcher. A backoff only delays the
+       recipient's own chain."""
+
+    def __init__(self, session, token=None, url=GRAPH_URL, retries=4,
+                 backoff=0.5, timeout=10):
+        self.session = session
+        self.token = token
+        self.url = url
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.last = {}
+        self.typing_pending = set()
+
+    def typing(self, recipient):
+        """Queue a typing_on action unless one is already queued."""
+
+        if recipient in self.typing_pending:
+            return None
+        self.typing_pending.add(recipient)
+        self.queue(recipient, self.send_typing(recipient))
+        return None
+
+    def message(self, recipient, message):
+        """Queue a message for a recipient."""
+
+        data = {'recipient': {'id': recipient}, 'message': message}
+        self.queue(recipient, self.post(data))
+        return None
+
+    def queue(self, recipient, request):
+        task = asyncio.ensure_future(self.after(self.last.get(recipient),
+                                                request))
+        self.last[recipient] = task
+
+        def done(task):
+            if self.last.get(recipient) is task:
+                del self.last[recipient]
+        task.add_done_callback(done)
+        return task
+
+    @staticmethod
+    async def after(previous, request):
+        if previous is not None:
+            await asyncio.wait([previous])
+        return await request
+
+    async def send_typing(self, recipient):
+        self.typing_pending.discard(recipient)
+        data = {'recipient': {'id': recipient}, 'sender_action': 'typing_on'}
+        return await self.post(data)
+
+    async def post(self, data):
+        with metrics.timed('graph_send'):
+            return await self.send(data)
+
+    async def send(self, data):
+        params = {'access_token': self.token or ''}
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        for attempt in range(self.retries + 1):
+            delay = self.backoff * 2 ** attempt
+            try:
+                async with self.session.post(self.url, params=params,
+                                             json=data,
+                                             timeout=timeout) as resp:
+                    body = await resp.read()
+                    delay = retry_delay(resp.status, resp.headers, delay)
+                    if delay is None:
+                        if resp.status >= 400:
+                            logging.info('Graph rejected request: {}'.format(
+                                body))
+                        return resp.status
+            except (aiohttp.ServerTimeoutError, asyncio.TimeoutError) as err:
+                # the Graph API may have acted on it, so it is not resent
+                logging.info('Graph request timed out: {}'.format(err))
+                return None
+            except aiohttp.ClientConnectionError as err:
+                logging.info('Graph connection failed: {}'.format(err))
+            except aiohttp.ClientError as err:
+                logging.info('Graph request failed: {}'.format(err))
+                return None
+
+            if attempt < self.retries:
+                await asyncio.sleep(delay)
+
+        logging.info('Giving up on Graph request: {}'.format(data))
+        return None
+
+    async def join(self):
+        """Wait until every queued request has been sent."""
+
+        while self.last:
+            await asyncio.wait(list(self.last.values()))
+        return None
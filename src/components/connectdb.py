@@ -1,43 +1,383 @@
+import bisect
+import copy
+import functools
+import os
+import re
+import threading
+import time
+
 import psycopg2
+import psycopg2.extensions
+from psycopg2.pool import PoolError, ThreadedConnectionPool
 from psycopg2.sql import SQL, Identifier
 
+import metrics
+from dbcache import MISSING, QueryCache
+from substrings import SubstringIndex
+from titles import titlecase
+
+DSN = os.environ.get('PLANBOT_DSN', 'dbname=planbot')
+POOL_MIN = int(os.environ.get('PLANBOT_DB_POOL_MIN', 1))
+POOL_MAX = int(os.environ.get('PLANBOT_DB_POOL_MAX', 10))
+POOL_TIMEOUT = float(os.environ.get('PLANBOT_DB_POOL_TIMEOUT', 10))
+POOL_CHECK = float(os.environ.get('PLANBOT_DB_POOL_CHECK', 30))
+CACHE_SIZE = int(os.environ.get('PLANBOT_DB_CACHE', 0))
+# 'memory' answers LIKE lookups from in-process indexes of the table keys
+SUBSTRING_INDEX = os.environ.get('PLANBOT_SUBSTRING_INDEX', 'database')
+# compiled pack (see pack.py) that serves reads of the tables it holds
+PACK_PATH = os.environ.get('PLANBOT_PACK')
+
+
+class ConnectionPool():
+    """Bounded pool of database connections shared by a process. Callers
+       wait up to timeout seconds for a free connection rather than opening
+       more than maxconn. Connections idle for longer than check_after
+       seconds are pinged before reuse and replaced if they fail."""
+
+    def __init__(self, dsn=DSN, minconn=POOL_MIN, maxconn=POOL_MAX,
+                 timeout=POOL_TIMEOUT, check_after=POOL_CHECK):
+        self.pool = ThreadedConnectionPool(minconn, maxconn, dsn)
+        self.slots = threading.BoundedSemaphore(maxconn)
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.check_after = check_after
+        self.last_used = {}
+        self.pid = os.getpid()
+
+    def getconn(self):
+        if not self.slots.acquire(timeout=self.timeout):
+            raise PoolError('Connection pool exhausted')
+
+        try:
+            for _ in range(self.maxconn + 1):
+                conn = self.pool.getconn()
+                if self.healthy(conn):
+                    conn.autocommit = True
+                    return conn
+                self.discard(conn)
+        except Exception:
+            self.slots.release()
+            raise
+
+        self.slots.release()
+        raise psycopg2.OperationalError('No healthy database connection')
+
+    def putconn(self, conn):
+        if conn.closed:
+            self.discard(conn)
+        else:
+            self.last_used[id(conn)] = time.time()
+            self.pool.putconn(conn)
+        self.slots.release()
+
+    def discard(self, conn):
+        self.last_used.pop(id(conn), None)
+        self.pool.putconn(conn, close=True)
+
+    def healthy(self, conn):
+        if conn.closed:
+            return False
+
+        last_used = self.last_used.get(id(conn))
+        if last_used is None or time.time() - last_used < self.check_after:
+            return True
+
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute('SELECT 1')
+        except psycopg2.Error:
+            return False
+        return True
+
+    def closeall(self):
+        self.last_used.clear()
+        self.pool.closeall()
+
+
+_pool = None
+_lock = threading.Lock()
+_inherited = []
+
+
+def connection_pool():
+    """Return the pool for this process, creating it on first use. A pool
+       inherited across fork is kept alive but never used, so the child
+       does not close sockets that still belong to its parent."""
+
+    global _pool
+    if _pool is None or _pool.pid != os.getpid():
+        with _lock:
+            if _pool is not None and _pool.pid != os.getpid():
+                _inherited.append(_pool)
+                _pool = None
+            if _pool is None:
+                _pool = ConnectionPool()
+    return _pool
+
+
+def close_pool():
+    """Close every pooled connection, e.g. before forking workers."""
+
+    global _pool
+    with _lock:
+        if _pool is not None and _pool.pid == os.getpid():
+            _pool.closeall()
+        _pool = None
+
+
+_cache = None
+_cache_size = CACHE_SIZE
+
+
+def enable_cache(maxsize=1024):
+    """Serve repeat reads from an in-process cache. Also enabled by setting
+       PLANBOT_DB_CACHE to the maximum number of cached results."""
+
+    global _cache_size
+    _cache_size = maxsize
+    return query_cache()
+
+
+def query_cache():
+    """Return this process's query cache, or None if caching is off."""
+
+    global _cache
+    if _cache_size <= 0:
+        return None
+    if _cache is None or _cache.pid != os.getpid():
+        with _lock:
+            if _cache is None or _cache.pid != os.getpid():
+                _cache = QueryCache(DSN, maxsize=_cache_size)
+                _cache.listen()
+    return _cache
+
+
+def cached(method):
+    """Serve a ConnectDB read from the query cache when it is enabled."""
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        cache = query_cache()
+        if cache is None:
+            return method(self, *args, **kwargs)
+
+        key = (method.__name__, args, tuple(sorted(kwargs.items())))
+        version = cache.version(self.table)
+        value = cache.get(self.table, key)
+        if value is MISSING:
+            metrics.cache_requests.inc(cache='query', result='miss')
+            value = method(self, *args, **kwargs)
+            cache.put(self.table, key, copy.copy(value), version=version)
+        else:
+            metrics.cache_requests.inc(cache='query', result='hit')
+        return copy.copy(value)
+
+    return wrapper
+
+
+_pack = None
+# (data version, {location: sorted sectors}) of the reports table
+_sectors = (None, None)
+
+
+def knowledge_pack():
+    """Return the pack named by PLANBOT_PACK, opening it on first use."""
+
+    global _pack
+    if _pack is None and PACK_PATH:
+        with _lock:
+            if _pack is None:
+                from pack import KnowledgePack
+
+                _pack = KnowledgePack(PACK_PATH)
+    return _pack
+
+
+def known_version(table):
+    """Return the data version of a table if it is known without a
+       database query, from a knowledge pack or the query cache."""
+
+    pack = knowledge_pack()
+    if pack is not None and table in pack.tables:
+        return pack.version
+    queries = query_cache()
+    if queries is not None:
+        return queries.version(table)
+    return None
+
+
+def memoized_sectors(version):
+    """Return the sector map read at a reports data version, or None.
+       Nothing is memoized while versions are untracked (version 0)."""
+
+    memo_version, sectors = _sectors
+    return sectors if version and version == memo_version else None
+
+
+def memoize_sectors(version, sectors):
+    """Keep the sector map read at a reports data version."""
+
+    global _sectors
+    if version:
+        _sectors = (version, sectors)
+    return sectors
+
+
+def display_name(table, key):
+    """Return the display name of a key, precomputed in a knowledge
+       pack when the table is in one and titlecased otherwise."""
+
+    pack = knowledge_pack()
+    if pack is not None and table in pack.tables:
+        name = pack.display(table, key)
+        if name is not None:
+            return name
+    return titlecase(key)
+
+
+def like(phrase, keys):
+    """Emulate key LIKE '%phrase%' over keys, wildcards included."""
+
+    pattern, chars = '', iter(phrase)
+    for char in chars:
+        if char == '\\':
+            pattern += re.escape(next(chars, '\\'))
+        else:
+            pattern += '.*' if char == '%' else '.' if char == '_' \
+                else re.escape(char)
+    pattern = re.compile('.*{}.*'.format(pattern), re.S)
+    return [key for key in keys if pattern.fullmatch(key)]
+
+
+substring_indexes = {}
+
+
+def substring_index(db):
+    """Return the substring index for a table, rebuilding it whenever the
+       query cache sees the table's version change."""
+
+    cache = query_cache()
+    version = db.pack.version if db.pack else \
+        cache.version(db.table) if cache else 0
+    built = substring_indexes.get(db.table)
+    if built is None or built[0] != version:
+        built = (version, SubstringIndex(db.query_keys()))
+        substring_indexes[db.table] = built
+    return built[1]
+
+
+class TimedCursor(psycopg2.extensions.cursor):
+    """Cursor that times each query as a db stage of its table."""
+
+    table = ''
+
+    def execute(self, query, vars=None):
+        with metrics.timed('db', action=self.table):
+            return super().execute(query, vars)
+
 
 class ConnectDB():
-    """Connect to the planbot database and access a table."""
+    """Access a table of the planbot database. A pooled connection is
+       checked out on first query and returned by close(), or on leaving
+       a with block. Tables held in a knowledge pack are read from it
+       without touching the database."""
 
     tables = ['definitions', 'use_classes', 'projects', 'documents',
               'local_plans', 'reports', 'responses']
 
     def __init__(self, table):
-        self.conn = psycopg2.connect('dbname=planbot')
-        self.cursor = self.conn.cursor()
         if table not in self.tables:
             raise Exception('Invalid table: {}'.format(table))
         else:
             self.table = table
+        self.conn = self._cursor = None
+
+        pack = knowledge_pack()
+        self.pack = pack if pack and table in pack.tables else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def cursor(self):
+        if self._cursor is None:
+            self.conn = connection_pool().getconn()
+            self._cursor = self.conn.cursor(cursor_factory=TimedCursor)
+            self._cursor.table = self.table
+        return self._cursor
+
+    @cached
+    def data_version(self):
+        """Return the version of the table, which is bumped on every write
+           once data/notify.SQL is applied, or 0 without it. Tables read
+           from a pack take the pack's version."""
+
+        if self.pack:
+            return self.pack.version
 
+        try:
+            self.cursor.execute('''SELECT version FROM data_versions
+                                   WHERE table_name=%s''', [self.table])
+        except psycopg2.ProgrammingError:
+            return 0
+
+        res = self.cursor.fetchone()
+        return res[0] if res else 0
+
+    @cached
     def query_response(self, context):
         """Return response given message/context."""
 
         assert self.table == 'responses'
-        self.cursor.execute('''SELECT response, quickreplies FROM responses
-                               WHERE context=%s''', [context])
+        if self.pack:
+            res = self.pack.lookup('responses', context)
+            res = res[1:] if res else None
+        else:
+            self.cursor.execute('''SELECT response, quickreplies FROM responses
+                                   WHERE context=%s''', [context])
+            res = self.cursor.fetchone()
 
-        res = self.cursor.fetchone()
         if not res:
             return self.query_response('NO_PAYLOAD')
         else:
             response = {'text': res[0], 'quickreplies': res[1]}
         return response
 
+    def query_responses(self):
+        """Return every (context, response, quickreplies) row."""
+
+        assert self.table == 'responses'
+        if self.pack:
+            return list(self.pack.rows('responses'))
+
+        self.cursor.execute('''SELECT context, response, quickreplies
+                               FROM responses''')
+        return self.cursor.fetchall()
+
+    @cached
     def query_keys(self):
         """Return all keys from a table."""
 
         assert self.table not in ['reports', 'responses']
+        if self.pack:
+            return self.pack.keys(self.table)
+
         self.cursor.execute(SQL("SELECT key FROM {}").format(
             Identifier(self.table)))
         return [k[0] for k in self.cursor.fetchall()]
 
+    @cached
+    def query_titles(self):
+        """Return the titlecased keys of a table in sorted order."""
+
+        if self.pack:
+            return self.pack.titles(self.table)
+        return sorted([titlecase(key) for key in self.query_keys()])
+
+    @cached
     def query_spec(self, phrase, spec=None):
         """Submit a database lookup. The spec kwarg takes one of 'EQL' or
            'LIKE' for respective lookup types. EQL returns a sole key-value
@@ -46,11 +386,22 @@ class ConnectDB():
         res = None
         assert self.table not in ['reports', 'responses']
         assert spec in ['EQL', 'LIKE']
-        if spec == 'EQL':
+        wildcard = any(char in phrase for char in '%_\\')
+        if spec == 'EQL' and self.pack:
+            res = self.pack.lookup(self.table, phrase)
+
+        elif spec == 'LIKE' and self.pack and wildcard:
+            res = [(key,) for key in like(phrase, self.query_keys())]
+
+        elif spec == 'EQL':
             self.cursor.execute(SQL("SELECT * FROM {} WHERE key=%s").format(
                 Identifier(self.table)), [phrase])
             res = self.cursor.fetchone()
 
+        elif spec == 'LIKE' and not wildcard and \
+                (self.pack or SUBSTRING_INDEX == 'memory'):
+            res = [(key,) for key in substring_index(self).search(phrase)]
+
         elif spec == 'LIKE':
             phrase = '%{}%'.format(phrase)
             self.cursor.execute(SQL(
@@ -60,49 +411,156 @@ class ConnectDB():
 
         return res
 
+    def query_many(self, phrases):
+        """Return (key, value) rows for every phrase that is a key."""
+
+        assert self.table not in ['reports', 'responses']
+        if self.pack:
+            rows = (self.pack.lookup(self.table, p) for p in set(phrases))
+            return [row for row in rows if row]
+
+        self.cursor.execute(SQL(
+            "SELECT key, value FROM {} WHERE key = ANY(%s)").format(
+            Identifier(self.table)), [list(phrases)])
+        return self.cursor.fetchall()
+
+    def columns(self, values=False):
+        """Return the columns of the table used by pages and exports."""
+
+        if self.table == 'reports':
+            return ['location', 'sector', 'title', 'date', 'url']
+        elif self.table == 'responses':
+            return ['context', 'response', 'quickreplies']
+        return ['key', 'value'] if values else ['key']
+
+    def query_page(self, after=None, limit=100, values=False):
+        """Return up to limit rows in key order, starting after the given
+           key, for paging through a table."""
+
+        assert self.table not in ['reports', 'responses']
+        if self.pack:
+            keys = self.pack.keys(self.table)
+            start = 0 if after is None else bisect.bisect_right(keys, after)
+            if values:
+                return [self.pack.lookup(self.table, key)
+                        for key in keys[start:start + limit]]
+            return [(key,) for key in keys[start:start + limit]]
+
+        columns = SQL(', ').join(map(Identifier, self.columns(values)))
+        if after is None:
+            self.cursor.execute(SQL(
+                "SELECT {} FROM {} ORDER BY key LIMIT %s").format(
+                columns, Identifier(self.table)), [limit])
+        else:
+            self.cursor.execute(SQL(
+                "SELECT {} FROM {} WHERE key > %s "
+                "ORDER BY key LIMIT %s").format(
+                columns, Identifier(self.table)), [after, limit])
+        return self.cursor.fetchall()
+
+    def stream_rows(self, values=False, itersize=2000):
+        """Yield every row of the table through a server-side cursor, so
+           only itersize rows are held in memory at a time."""
+
+        columns = self.columns(values)
+        if self.pack:
+            for row in self.pack.rows(self.table):
+                yield row[:len(columns)]
+            return None
+
+        query = SQL("SELECT {} FROM {} ORDER BY {}").format(
+            SQL(', ').join(map(Identifier, columns)),
+            Identifier(self.table), Identifier(columns[0]))
+
+        conn = self.cursor.connection
+        # named cursors only live inside a transaction
+        conn.autocommit = False
+        try:
+            with conn.cursor(name='planbot_export') as cursor:
+                cursor.itersize = itersize
+                cursor.execute(query)
+                for row in cursor:
+                    yield row
+        finally:
+            conn.rollback()
+            conn.autocommit = True
+
+    def sector_map(self):
+        """Return {location: sorted sectors} for every report location,
+           from the report_sectors view where data/reports.SQL has been
+           applied. The map is kept until the reports version changes."""
+
+        assert self.table == 'reports'
+        version = known_version(self.table)
+        if version is None:
+            version = self.data_version()
+        sectors = memoized_sectors(version)
+        if sectors is not None:
+            return sectors
+
+        try:
+            self.cursor.execute('''SELECT location, sector
+                                   FROM report_sectors''')
+        except psycopg2.ProgrammingError:
+            self.cursor.execute('''SELECT DISTINCT location, sector
+                                   FROM reports''')
+
+        sectors = {}
+        for location, sector in self.cursor.fetchall():
+            sectors.setdefault(location, []).append(sector)
+        return memoize_sectors(version, {loc: sorted(secs)
+                                         for loc, secs in sectors.items()})
+
     def distinct_locations(self):
         """Returns only unique report locations."""
 
-        assert self.table == 'reports'
-        self.cursor.execute("SELECT DISTINCT location FROM reports")
-        res = self.cursor.fetchall()
-        return [r[0] for r in res]
+        return sorted(self.sector_map())
 
     def distinct_sectors(self, loc):
         """Returns only unique report sectors for a given location."""
 
-        assert self.table == 'reports'
-        self.cursor.execute('''SELECT DISTINCT sector FROM reports
-                               WHERE location=%s''', [loc.lower()])
+        return list(self.sector_map().get(loc.lower(), []))
 
-        res = self.cursor.fetchall()
-        return [r[0] for r in res]
+    def query_reports(self, loc=None, sec=None, limit=None, after=None):
+        """Returns report table query given a location and sector.
 
-    def query_reports(self, loc=None, sec=None):
-        """Returns report table query given a location and sector,
-           sorted by date."""
+           Reports for a location and sector come newest first, at most
+           limit at a time, as (title, url, date) rows. Pass the (date,
+           title, url) of the last report seen as after to continue."""
 
         assert self.table == 'reports'
 
         if not loc:
             # no location / sector ignored -> return everything
             self.cursor.execute('''SELECT location, sector, title, date, url
-                                   FROM reports''', [loc])
+                                   FROM reports''')
+            return self.cursor.fetchall()
 
         elif not sec:
             # location but no sector -> return all given location
             self.cursor.execute('''SELECT sector, title, url FROM reports
                                    WHERE location=%s''', [loc])
+            return self.cursor.fetchall()
 
-        else:
-            # location and sector -> return date-ordered reports
-            self.cursor.execute('''SELECT title, url FROM reports
-                                   WHERE location=%s AND sector=%s
-                                   ORDER BY date DESC''', (loc, sec))
+        # location and sector -> one date-ordered page of reports
+        query = '''SELECT title, url, date FROM reports
+                   WHERE location=%s AND sector=%s'''
+        params = [loc, sec]
+        if after:
+            query += ' AND (date, title, url) < (%s, %s, %s)'
+            params.extend(after)
+        query += ' ORDER BY date DESC, title DESC, url DESC'
+        if limit:
+            query += ' LIMIT %s'
+            params.append(limit)
 
+        self.cursor.execute(query, params)
         return self.cursor.fetchall()
 
     def close(self):
-        """Close connection to database."""
+        """Return the connection to the pool."""
 
-        self.conn.close()
+        if self.conn is not None:
+            self._cursor.close()
+            connection_pool().putconn(self.conn)
+            self.conn = self._cursor = None
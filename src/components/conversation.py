@@ -0,0 +1,240 @@
+#!/usr/bin/python3
+"""
+Planbot's conversation flow as an explicit state machine, compiled once
+from the responses table so that a turn is resolved with dictionary
+lookups rather than database queries.
+
+States are the contexts kept in a user's session:
+
+    None                    idle
+    REPORT_PAYLOAD_SECTOR   waiting for a report location
+    <PAYLOAD>_CALL          waiting for a query (or a report sector)
+    <PAYLOAD>               a query has been answered
+
+Messages are classified as events: an action payload, 'Cancel',
+'Thanks, bye!', 'More', BACK for anything else starting 'Try again',
+'More' or 'Go back', or TEXT for anything else. 'More' pages through
+reports once they are shown and otherwise acts as BACK. Every
+(state, event) pair maps to a Transition. Check the graph compiled from a
+dump with:
+
+    $ python3 conversation.py data/planbot.SQL
+"""
+
+import sys
+from collections import namedtuple
+
+from connectdb import ConnectDB, known_version
+
+ACTIONS = {
+    'GET_STARTED_PAYLOAD': None,
+    'CONTACT_PAYLOAD': None,
+    'DEFINE_PAYLOAD': 'definitions',
+    'USE_PAYLOAD': 'use_classes',
+    'PD_PAYLOAD': 'projects',
+    'DOC_PAYLOAD': 'documents',
+    'LP_PAYLOAD': 'local_plans',
+    'REPORT_PAYLOAD': 'reports'}
+
+BACK = 'BACK'
+TEXT = 'TEXT'
+MORE = 'More'
+BACK_PREFIXES = ('Try again', 'More', 'Go back')
+CLOSERS = ('Cancel', 'Thanks, bye!')
+
+SECTOR = 'REPORT_PAYLOAD_SECTOR'
+CONTACT_LINKS = {
+    'title': ['My website', 'My Facebook page'],
+    'text': 'https://planbot.co https://fb.me/planbotco'}
+
+# step is one of 'reply', 'sectors', 'call' or 'page'. replies is the list
+# of messages to send, or None to reply with the template named by the
+# message itself. A call's outcomes map 'result', 'options' and 'failure'
+# to the reply transition taken once Planbot has answered, plus 'more'
+# for a page of reports with another to follow. A page also has
+# 'restart', taken when there is no further page.
+Transition = namedtuple('Transition',
+                        ['step', 'replies', 'context', 'action', 'outcomes'])
+
+
+def reply(replies, context):
+    return Transition('reply', replies, context, None, None)
+
+
+class ConversationGraph():
+    """Transition table compiled from (context, response, quickreplies)
+       rows of the responses table. Quick replies are split once here and
+       templates missing from the rows fall back to NO_PAYLOAD."""
+
+    def __init__(self, rows, actions=ACTIONS, version=None):
+        self.actions = actions
+        self.version = version
+        self.templates = {}
+        for context, text, quickreplies in rows:
+            self.templates.setdefault(context, {
+                'text': text,
+                'quickreplies': quickreplies.split('/')
+                if quickreplies else None})
+
+        self.required = set()
+        self.states = [None, SECTOR]
+        for payload, action in sorted(actions.items()):
+            if action is None:
+                continue
+            for state in [payload + '_CALL', payload]:
+                if state not in self.states:
+                    self.states.append(state)
+
+        self.transitions = {}
+        for state in self.states:
+            events = list(actions) + [BACK, TEXT, MORE] + list(CLOSERS)
+            for event in events:
+                self.transitions[state, event] = self.compile(state, event)
+
+    def template(self, context):
+        """Return the response template for a context as a new dict."""
+
+        template = self.templates.get(context) or \
+            self.templates.get('NO_PAYLOAD') or \
+            {'text': '', 'quickreplies': None}
+        return dict(template)
+
+    def fixed(self, context):
+        self.required.add(context)
+        return self.template(context)
+
+    def enter(self, payload):
+        """The transition into the branch of an action payload."""
+
+        action = self.actions[payload]
+        first = self.fixed(payload)
+        if payload == 'CONTACT_PAYLOAD':
+            return reply([first, dict(first, **CONTACT_LINKS)], None)
+        elif action is None:
+            return reply([first], None)
+        elif action == 'reports':
+            return reply([first], SECTOR)
+        return reply([first], payload + '_CALL')
+
+    def call(self, payload):
+        """The transition that passes a query to Planbot."""
+
+        action = self.actions[payload]
+        success = self.fixed('Success')
+        success['quickreplies'] = ['More ' + action.replace('_', ' '),
+                                   'Thanks, bye!']
+        outcomes = {
+            'result': reply([success], payload),
+            'options': reply([self.fixed('Options')], payload + '_CALL'),
+            'failure': reply([self.fixed('Failure')], payload)}
+        if action == 'reports':
+            more = dict(success)
+            more['quickreplies'] = [MORE] + success['quickreplies']
+            outcomes['more'] = reply([more], payload)
+        return Transition('call', None, payload + '_CALL', action, outcomes)
+
+    def page(self, payload):
+        """The transition that fetches the next page of reports."""
+
+        step = self.call(payload)
+        outcomes = dict(step.outcomes, restart=self.enter(payload))
+        return Transition('page', None, payload, step.action, outcomes)
+
+    def compile(self, state, event):
+        if event in self.actions:
+            return self.enter(event)
+        elif state is None:
+            return reply(None, None)
+        elif state == SECTOR:
+            if event == 'Cancel':
+                return reply([self.fixed('Cancel')], None)
+            return Transition('sectors', [self.fixed(SECTOR)],
+                              'REPORT_PAYLOAD_CALL', 'reports', None)
+
+        payload = state[:-len('_CALL')] if state.endswith('_CALL') else state
+        if event == MORE and state == 'REPORT_PAYLOAD':
+            return self.page(payload)
+        elif event in [BACK, MORE]:
+            return self.enter(payload)
+        elif event in CLOSERS and (event == 'Cancel' or state == payload):
+            return reply([self.fixed(event)], None)
+        elif state != payload:
+            return self.call(payload)
+        return reply(None, state)
+
+    def event(self, message):
+        """Classify a message as the event it triggers."""
+
+        if message in self.actions or message in CLOSERS + (MORE,):
+            return message
+        elif isinstance(message, str) and message.startswith(BACK_PREFIXES):
+            return BACK
+        return TEXT
+
+    def transition(self, state, message):
+        """Return the transition a message triggers in a state. Unknown
+           states are treated as idle."""
+
+        event = self.event(message)
+        step = self.transitions.get((state, event))
+        return step if step is not None else self.transitions[None, event]
+
+    def validate(self):
+        """Return a list of problems: templates the graph needs but the
+           responses table lacks, and fixed quick replies that lead to a
+           NO_PAYLOAD reply."""
+
+        problems = ['missing response: {}'.format(context)
+                    for context in sorted(self.required)
+                    if context not in self.templates]
+        if 'NO_PAYLOAD' not in self.templates:
+            problems.append('missing response: NO_PAYLOAD')
+
+        dead = set()
+        for step in self.transitions.values():
+            for done in [step] + list((step.outcomes or {}).values()):
+                if done.step != 'reply' or not done.replies:
+                    continue
+                for qr in done.replies[-1]['quickreplies'] or []:
+                    target = self.transition(done.context, qr)
+                    if target.step == 'reply' and target.replies is None \
+                            and qr not in self.templates:
+                        dead.add((str(done.context), qr))
+        problems.extend('dead quick reply: {!r} in {}'.format(qr, state)
+                        for state, qr in sorted(dead))
+        return problems
+
+
+_graph = None
+
+
+def conversation_graph():
+    """Return the graph compiled from the responses table, recompiling it
+       when the table's version is seen to change. Without a knowledge
+       pack or query cache the version is unknown and the graph is kept
+       until restart."""
+
+    global _graph
+    version = known_version('responses')
+    if _graph is None or (version is not None and version != _graph.version):
+        with ConnectDB('responses') as db:
+            _graph = ConversationGraph(db.query_responses(), version=version)
+    return _graph
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        from pack import read_dump
+        columns, rows = read_dump(sys.argv[1])['responses']
+        graph = ConversationGraph(rows)
+    else:
+        graph = conversation_graph()
+
+    for (state, event), step in sorted(graph.transitions.items(),
+                                       key=lambda item: str(item[0])):
+        print('{!s:24} {:20} -> {:8} {}'.format(state, event, step.step,
+                                                step.context))
+    problems = graph.validate()
+    for problem in problems:
+        print(problem)
+    sys.exit(1 if problems else 0)
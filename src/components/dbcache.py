@@ -0,0 +1,149 @@
+import logging
+import os
+import select
+import threading
+import time
+from collections import OrderedDict
+
+import psycopg2
+
+CHANNEL = 'planbot_data'
+MISSING = object()
+
+
+class LRUCache():
+    """Thread-safe mapping that evicts the least recently used entry once
+       it holds more than maxsize items."""
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=MISSING):
+        with self.lock:
+            try:
+                self.entries.move_to_end(key)
+            except KeyError:
+                return default
+            return self.entries[key]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class QueryCache():
+    """In-process cache of ConnectDB reads. Entries are keyed by the
+       version of their table, so a version bump makes older entries
+       unreachable and they age out of the LRU.
+
+       Versions mirror the data_versions table, which a statement trigger
+       bumps on every write before sending a NOTIFY on the planbot_data
+       channel (see data/notify.SQL). A background thread LISTENs on that
+       channel and applies each bump as it arrives."""
+
+    def __init__(self, dsn, maxsize=1024):
+        self.dsn = dsn
+        self.entries = LRUCache(maxsize)
+        self.versions = {}
+        self.listener = None
+        self.pid = os.getpid()
+
+    def version(self, table):
+        return self.versions.get(table, 0)
+
+    def get(self, table, key):
+        return self.entries.get((table, self.version(table), key))
+
+    def put(self, table, key, value, version=None):
+        """Store a value read at the given table version, so a result that
+           raced with an invalidation is never filed under the new one."""
+
+        if version is None:
+            version = self.version(table)
+        self.entries.put((table, version, key), value)
+
+    def invalidate(self, table, version=None):
+        if version is None:
+            version = self.version(table) + 1
+        if version != self.version(table):
+            logging.info('Cache invalidated: {} v{}'.format(table, version))
+            self.versions[table] = version
+
+    def listen(self):
+        """Start the notification listener thread if not yet running."""
+
+        if self.listener is None:
+            self.listener = threading.Thread(target=self.run_listener,
+                                             name='planbot-cache-listener',
+                                             daemon=True)
+            self.listener.start()
+        return None
+
+    def run_listener(self):
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(self.dsn)
+                conn.autocommit = True
+                cursor = conn.cursor()
+                cursor.execute('LISTEN {}'.format(CHANNEL))
+                # catch up on anything missed while disconnected
+                self.load_versions(cursor)
+                self.wait_for_notifies(conn)
+            except Exception as err:
+                # anything ending the listener would leave entries stale
+                # for good, so log it and reconnect
+                level = logging.INFO if isinstance(err, psycopg2.Error) \
+                    else logging.WARNING
+                logging.log(level, 'Cache listener error: {}'.format(err))
+                # notifications may have been lost, so start afresh
+                self.entries.clear()
+            finally:
+                if conn is not None:
+                    conn.close()
+            time.sleep(1)
+
+    def wait_for_notifies(self, conn):
+        while True:
+            if select.select([conn], [], [], 60) == ([], [], []):
+                continue
+            conn.poll()
+            while conn.notifies:
+                self.invalidate(*parse_notify(conn.notifies.pop(0).payload))
+
+    def load_versions(self, cursor):
+        try:
+            cursor.execute('SELECT table_name, version FROM data_versions')
+        except psycopg2.ProgrammingError as err:
+            logging.info('No data versions available: {}'.format(err))
+            return None
+
+        for table, version in cursor.fetchall():
+            self.invalidate(table, version)
+        return None
+
+
+def parse_notify(payload):
+    """Return the (table, version) of a 'table:version' notification. A
+       version that is missing or unreadable is returned as None, which
+       bumps the table's version rather than trusting the payload."""
+
+    table, _, version = payload.partition(':')
+    try:
+        return table, int(version)
+    except ValueError:
+        if version:
+            logging.warning('Bad cache notification: {!r}'.format(payload))
+        return table, None
@@ -0,0 +1,185 @@
+import logging
+import os
+import queue
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+from workers import KeyedWorkerPool
+
+GRAPH_URL = os.environ.get('FB_GRAPH_URL',
+                           'https://graph.facebook.com/v2.9/me/messages')
+
+
+def retry_delay(status, headers, delay):
+    """Return the seconds to wait before retrying a Graph response, or
+       None if it is final. Only 429 and 503 are retried: the Graph API
+       has not acted on those, while a retried 500 or timeout could send
+       a message twice."""
+
+    if status not in (429, 503):
+        return None
+    logging.info('Graph returned {}'.format(status))
+    retry_after = headers.get('Retry-After', '')
+    if retry_after.isdigit():
+        delay = max(delay, int(retry_after))
+    return delay
+
+
+class Dispatcher():
+    """Send Messenger requests to the Graph API from background threads
+       over one keep-alive session. Requests for a recipient are sent in
+       the order they were queued, a typing indicator is dropped while
+       another is still waiting to go out, and connection errors, 429 and
+       503 responses are retried with exponential backoff. A request
+       waiting to be retried holds back its recipient's later requests on
+       a timer, leaving the sending thread free for other recipients.
+       Requests that find the queue full are dropped, logged and counted,
+       rather than failing the turn that queued them."""
+
+    def __init__(self, token=None, url=GRAPH_URL, workers=8, retries=4,
+                 backoff=0.5, timeout=10):
+        self.token = token
+        self.url = url
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self.pool = KeyedWorkerPool(workers, name='planbot-dispatch')
+        self.typing_pending = set()
+        # requests held back, per recipient with a retry waiting
+        self.held = {}
+        self.lock = threading.Lock()
+
+    def typing(self, recipient):
+        """Queue a typing_on action unless one is already queued."""
+
+        with self.lock:
+            if recipient in self.typing_pending:
+                return None
+            self.typing_pending.add(recipient)
+
+        if not self.submit('typing', recipient, self.send_typing, recipient):
+            with self.lock:
+                self.typing_pending.discard(recipient)
+        return None
+
+    def message(self, recipient, message):
+        """Queue a message for a recipient."""
+
+        data = {'recipient': {'id': recipient}, 'message': message}
+        self.submit('message', recipient, self.post, data, recipient)
+        return None
+
+    def submit(self, kind, recipient, func, *args):
+        """Queue a request, returning False if it was dropped."""
+
+        try:
+            self.pool.submit(recipient, self.run, recipient, func, *args)
+        except queue.Full:
+            metrics.graph_dropped.inc(kind=kind)
+            logging.warning('Graph queue full, dropped {} for {}'.format(
+                kind, recipient))
+            return False
+        return True
+
+    def run(self, recipient, func, *args):
+        """Send a request now, or hold it behind a retry for the same
+           recipient."""
+
+        with self.lock:
+            held = self.held.get(recipient)
+            if held is not None:
+                held.append((func, args))
+                return None
+        return func(*args)
+
+    def send_typing(self, recipient):
+        with self.lock:
+            self.typing_pending.discard(recipient)
+        data = {'recipient': {'id': recipient}, 'sender_action': 'typing_on'}
+        return self.post(data, recipient)
+
+    def post(self, data, recipient, attempt=0):
+        """Send a request. One that may be retried is sent again after a
+           backoff, with the recipient's later requests held until then."""
+
+        with metrics.timed('graph_send'):
+            resp, delay = self.send(data, attempt)
+        if delay is None:
+            return resp
+        if attempt >= self.retries:
+            logging.info('Giving up on Graph request: {}'.format(data))
+            return None
+
+        with self.lock:
+            self.held.setdefault(recipient, [])
+        timer = threading.Timer(delay, self.retry, (recipient, data,
+                                                    attempt + 1))
+        timer.daemon = True
+        timer.start()
+        return None
+
+    def retry(self, recipient, data, attempt):
+        """Queue a retry and the requests held behind it."""
+
+        try:
+            self.pool.submit_within(self.timeout, recipient, self.release,
+                                    recipient, data, attempt)
+        except queue.Full:
+            with self.lock:
+                held = self.held.pop(recipient, [])
+            metrics.graph_dropped.inc(len(held) + 1, kind='retry')
+            logging.warning('Graph queue full, dropped retry for {}'.format(
+                recipient))
+        return None
+
+    def release(self, recipient, data, attempt):
+        with self.lock:
+            held = self.held.pop(recipient, [])
+        self.post(data, recipient, attempt)
+        # a failed retry holds the recipient again, keeping these in order
+        for func, args in held:
+            self.run(recipient, func, *args)
+        return None
+
+    def send(self, data, attempt=0):
+        """Send a request once, returning the response and None, or None
+           and the seconds to wait before it may be retried."""
+
+        params = {'access_token': self.token}
+        delay = self.backoff * 2 ** attempt
+        try:
+            resp = self.session.post(self.url, params=params, json=data,
+                                     timeout=self.timeout)
+        except requests.ConnectionError as err:
+            logging.info('Graph connection failed: {}'.format(err))
+            return None, delay
+        except requests.RequestException as err:
+            logging.info('Graph request failed: {}'.format(err))
+            return None, None
+
+        delay = retry_delay(resp.status_code, resp.headers, delay)
+        if delay is not None:
+            return None, delay
+        if resp.status_code >= 400:
+            logging.info('Graph rejected request: {}'.format(resp.content))
+        return resp, None
+
+    def join(self):
+        """Block until every queued request has been sent or given up."""
+
+        while True:
+            self.pool.join()
+            with self.lock:
+                if not self.held:
+                    return None
+            time.sleep(self.backoff)
@@ -1,165 +1,201 @@
+import json
 import logging
 
-import redis
-
-from planbot import Planbot, titlecase
+import metrics
+from planbot import AsyncPlanbot, Planbot
 from connectdb import ConnectDB
+from conversation import ACTIONS, conversation_graph
+from session import SessionConflict, default_async_store, default_store
+from titles import titlecase
+
+# times a turn is rerun after losing a race to save the session
+SAVE_RETRIES = 3
 
 
 class Engine:
 
-    actions = {
-        'GET_STARTED_PAYLOAD': None,
-        'CONTACT_PAYLOAD': None,
-        'DEFINE_PAYLOAD': 'definitions',
-        'USE_PAYLOAD': 'use_classes',
-        'PD_PAYLOAD': 'projects',
-        'DOC_PAYLOAD': 'documents',
-        'LP_PAYLOAD': 'local_plans',
-        'REPORT_PAYLOAD': 'reports'}
-
-    def __init__(self):
+    actions = ACTIONS
+
+    def __init__(self, store=None, graph=None):
+        self.store = store if store is not None else default_store()
+        self.graph = graph
         self.context = self.user = self.message = self.resp = None
+        self.location = self.sector = self.page = None
+        # time by which Planbot lookups should answer, or None
+        self.deadline = None
         self.resp_array = []
 
-    def response(self, user=None, message=None):
-        context = self.get_context(user)
-        self.context = None if context == 'None' else context
+    def response(self, user=None, message=None, deadline=None):
+        self.deadline = deadline
+        with metrics.span('engine.turn'):
+            return self.turn(user, message)
+
+    def turn(self, user, message):
+        """Load the session, run the turn and save the session only if no
+           other turn saved it in between. Otherwise the turn is rerun on
+           the newer state; nothing has been sent yet, so this is safe."""
+
+        for attempt in range(SAVE_RETRIES + 1):
+            rev = self.load(user)
+            self.begin(user, message)
+            self.run_actions()
+            try:
+                self.save(rev)
+                break
+            except SessionConflict:
+                self.conflict(attempt)
+        else:
+            logging.warning('Gave up saving session for {}'.format(user))
+        return self.finish()
+
+    def begin(self, user, message):
         self.user, self.message = user, message
         self.resp = {'id': user}
-        self.run_actions()
-        self.set_context(self.user, self.context)
+        self.resp_array = []
+        return None
+
+    def conflict(self, attempt):
+        metrics.session_conflicts.inc()
+        logging.info('Session conflict for {} on attempt {}'.format(
+            self.user, attempt + 1))
+        return None
 
+    def finish(self):
         self.resp_array.append(self.resp)
         response = self.resp_array
         self.resp = None
         self.resp_array = []
         return response
 
-    @staticmethod
-    def set_context(key, value):
-        store = redis.StrictRedis()
-        store.set(key, value)
-        return None
+    def load(self, user):
+        """Restore the session state and return its rev."""
 
-    @staticmethod
-    def get_context(key):
-        store = redis.StrictRedis(decode_responses=True)
-        return store.get(key)
+        with metrics.timed('session_load'):
+            state = self.store.load(user)
+        return self.restore(state)
 
-    @staticmethod
-    def query_db(message):
-        db = ConnectDB('responses')
-        response = db.query_response(message)
-        db.close()
-        return response
+    def restore(self, state):
+        self.context = state.get('context')
+        self.location = state.get('location')
+        self.sector = state.get('sector')
+        self.page = state.get('page')
+        return state.get('rev')
+
+    def save(self, rev):
+        with metrics.timed('session_save'):
+            self.store.save(self.user, self.state(), rev=rev)
+        return None
+
+    def state(self):
+        return {'context': self.context,
+                'location': self.location,
+                'sector': self.sector,
+                'page': self.page}
 
     def run_actions(self):
-        if not self.context or self.message in self.actions:
-            self.init_branch()
-        elif self.context == 'REPORT_PAYLOAD_SECTOR':
-            if self.message == 'Cancel':
-                self.select_response()
-            else:
-                self.report_sectors()
+        step = self.next_step()
+        if step.step in ['call', 'page']:
+            self.call(step)
+        elif step.step == 'sectors':
+            self.report_sectors(step)
         else:
-            self.select_response()
+            self.reply(step.replies or [self.template()])
         return None
 
-    def init_branch(self):
-        self.context = None
-        if self.message not in self.actions:
-            self.resp.update(self.query_db(self.message))
-            return None
-        elif self.message in ['GET_STARTED_PAYLOAD', 'CONTACT_PAYLOAD']:
-            pass
-        else:
-            call = '_SECTOR' if self.message == 'REPORT_PAYLOAD' else '_CALL'
-            self.context = self.message + call
+    def conversation(self):
+        return self.graph if self.graph is not None \
+            else conversation_graph()
 
-        self.resp.update(self.query_db(self.message))
-        self.next_steps()
-        return None
+    def next_step(self):
+        """Move to the step the message leads to from the context."""
 
-    def next_steps(self):
-        if self.message == 'CONTACT_PAYLOAD':
-            first_message = dict(self.resp)
-            self.resp_array.append(first_message)
-            self.resp.update({
-                'title': ['My website', 'My Facebook page'],
-                'text': 'https://planbot.co https://fb.me/planbotco'})
-        else:
-            qr = self.resp['quickreplies']
-            if qr:
-                self.resp['quickreplies'] = qr.split('/')
+        step = self.conversation().transition(self.context, self.message)
+        if step.step == 'page' and not self.page:
+            step = step.outcomes['restart']
+        self.context = step.context
+        return step
+
+    def template(self):
+        return self.conversation().template(self.message)
+
+    def reply(self, replies):
+        for pos, message in enumerate(replies):
+            if pos:
+                self.resp_array.append(dict(self.resp))
+            self.resp.update(message)
+            if message.get('quickreplies'):
+                self.resp['quickreplies'] = list(message['quickreplies'])
         return None
 
-    def report_sectors(self):
-        self.set_context(str(self.user) + 'loc', self.message)
-        self.resp.update(self.query_db('REPORT_PAYLOAD_SECTOR'))
-        db = ConnectDB('reports')
-        sectors = [titlecase(sec) for sec in db.distinct_sectors(self.message)]
-        self.resp['quickreplies'] = sectors + ['Go back']
-        db.close()
-        self.context = 'REPORT_PAYLOAD_CALL'
+    def report_sectors(self, step):
+        self.location = self.message
+        with ConnectDB(step.action) as db:
+            sectors = db.distinct_sectors(self.message)
+        self.sector_reply(step, sectors)
         return None
 
-    def select_response(self):
-        if self.message.startswith(('Try again', 'More', 'Go back')):
-            self.message = self.context.replace('_CALL', '')
-            self.init_branch()
-        elif self.context.endswith(('CALL', 'SECTOR')) and \
-                not self.message == 'Cancel':
-            self.call()
-        else:
-            if self.message in ['Cancel', 'Thanks, bye!']:
-                self.context = None
-            self.resp.update(self.query_db(self.message))
+    def sector_reply(self, step, sectors):
+        self.reply(step.replies)
+        self.resp['quickreplies'] = [titlecase(sec) for sec in sectors] + \
+            ['Go back']
         return None
 
-    def call(self):
-        self.context = self.context.replace('_CALL', '')
-        action = self.actions[self.context]
+    def call(self, step):
         pb = Planbot()
-        if self.context == 'REPORT_PAYLOAD':
-            location = self.get_context(str(self.user) + 'loc')
-            result, options = pb.run_task(action=action,
-                                          query=location,
-                                          sector=self.message)
-        else:
-            result, options = pb.run_task(action=action, query=self.message)
+        result, options = pb.run_task(**self.task_args(step))
+        self.answered(step, pb, result, options)
+        return None
+
+    def task_args(self, step):
+        """Return the Planbot.run_task arguments for a call or page step."""
 
-        self.process_call(result=result, options=options)
+        if step.step == 'page':
+            return {'action': step.action, 'query': self.location,
+                    'sector': self.sector, 'after': json.loads(self.page),
+                    'deadline': self.deadline}
+        elif step.action == 'reports':
+            self.sector = self.message
+            return {'action': step.action, 'query': self.location,
+                    'sector': self.message, 'deadline': self.deadline}
+        return {'action': step.action, 'query': self.message,
+                'deadline': self.deadline}
+
+    def answered(self, step, pb, result, options):
+        # a cursor means another page of reports follows this one
+        self.page = json.dumps(pb.cursor) if pb.cursor else None
+
+        self.process_call(step, result=result, options=options)
         return None
 
-    def process_call(self, result=None, options=None):
+    def process_call(self, step, result=None, options=None):
         if result:
-            self.format_result(result)
-            first_message = dict(self.resp)
-            self.resp_array.append(first_message)
+            outcome = step.outcomes['more'] if self.page \
+                else step.outcomes['result']
+            self.format_result(step.action, result)
+            self.resp_array.append(dict(self.resp))
             if self.resp.get('title'):
                 del self.resp['title']
-            self.resp.update(self.query_db('Success'))
-            branch = self.actions[self.context].replace('_', ' ')
-            self.resp['quickreplies'] = ['More ' + branch, 'Thanks, bye!']
+            self.reply(outcome.replies)
         elif options:
-            self.format_options(options)
+            outcome = step.outcomes['options']
+            self.reply(outcome.replies)
+            self.resp['text'] += self.format_text(options=options)
             self.resp['quickreplies'] = options + ['Cancel']
-            self.context += '_CALL'
         else:
-            self.resp.update(self.query_db('Failure'))
-            self.resp['quickreplies'] = self.resp['quickreplies'].split('/')
+            outcome = step.outcomes['failure']
+            self.reply(outcome.replies)
+        self.context = outcome.context
         return None
 
-    def format_result(self, result):
-        if self.context in ['DEFINE_PAYLOAD', 'USE_PAYLOAD']:
+    def format_result(self, action, result):
+        if action in ['definitions', 'use_classes']:
             if len(result) == 16:
                 self.resp['text'] = self.format_text(uses=result)
             else:
                 self.resp['text'] = self.format_text(pair=result)
             self.resp['quickreplies'] = None
             return None
-        elif self.context == 'REPORT_PAYLOAD':
+        elif action == 'reports':
             result = self.format_text(reports=result)
 
         self.resp['title'] = result[0]
@@ -167,11 +203,6 @@ class Engine:
         self.resp['quickreplies'] = None
         return None
 
-    def format_options(self, options):
-        msg = self.query_db('options')['text']
-        self.resp['text'] = msg + self.format_text(options=options)
-        return None
-
     @staticmethod
     def format_text(pair=None, options=None, uses=None, reports=None):
         if pair:
@@ -181,6 +212,70 @@ class Engine:
         elif uses:
             return '\n'.join(sorted(uses))
         elif reports:
-            titles = reports[0][:10]
-            urls = ' '.join(reports[1][:10])
+            titles = reports[0]
+            urls = ' '.join(reports[1])
             return titles, urls
+
+
+class AsyncEngine(Engine):
+    """Engine for coroutines, used by the asyncio gateway. The session
+       store, database and Planbot are awaited; the conversation itself
+       runs through the same steps as Engine."""
+
+    def __init__(self, store=None, graph=None):
+        super().__init__(store=store if store is not None
+                         else default_async_store(), graph=graph)
+
+    async def response(self, user=None, message=None, deadline=None):
+        self.deadline = deadline
+        with metrics.span('engine.turn'):
+            return await self.turn(user, message)
+
+    async def turn(self, user, message):
+        for attempt in range(SAVE_RETRIES + 1):
+            rev = await self.load(user)
+            self.begin(user, message)
+            await self.run_actions()
+            try:
+                await self.save(rev)
+                break
+            except SessionConflict:
+                self.conflict(attempt)
+        else:
+            logging.warning('Gave up saving session for {}'.format(user))
+        return self.finish()
+
+    async def load(self, user):
+        with metrics.timed('session_load'):
+            state = await self.store.load(user)
+        return self.restore(state)
+
+    async def save(self, rev):
+        with metrics.timed('session_save'):
+            await self.store.save(self.user, self.state(), rev=rev)
+        return None
+
+    async def run_actions(self):
+        step = self.next_step()
+        if step.step in ['call', 'page']:
+            await self.call(step)
+        elif step.step == 'sectors':
+            await self.report_sectors(step)
+        else:
+            self.reply(step.replies or [self.template()])
+        return None
+
+    async def report_sectors(self, step):
+        from asyncdb import AsyncConnectDB
+
+        self.location = self.message
+        async with AsyncConnectDB(step.action) as db:
+            sectors = await db.distinct_sectors(self.message)
+        self.sector_reply(step, sectors)
+        return None
+
+    async def call(self, step):
+        pb = AsyncPlanbot()
+        result, options = await pb.run_task(**self.task_args(step))
+        self.answered(step, pb, result, options)
+        return None
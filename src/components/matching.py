@@ -0,0 +1,106 @@
+import math
+
+import Levenshtein
+import numpy
+
+
+def normalise(matrix):
+    """Scale rows (or a single vector) to unit length, leaving zero
+       vectors untouched so they score 0 against everything."""
+
+    norms = numpy.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+class EmbeddingIndex():
+    """Normalised vectors for every key in a table. A query is embedded
+       once and scored against all keys with a single matrix product."""
+
+    def __init__(self, keys, embed):
+        self.keys = list(keys)
+        self.embed = embed
+        vectors = [embed(key) for key in self.keys]
+        self.matrix = normalise(numpy.array(vectors, dtype=numpy.float32))
+
+    def top(self, query, n=3, threshold=0.5):
+        """Return up to n keys scoring above threshold, best first."""
+
+        return self.top_many([query], n=n, threshold=threshold)[0]
+
+    def top_many(self, queries, n=3, threshold=0.5):
+        """Return top(query) for each query, scored in one matrix product."""
+
+        if not self.keys:
+            return [[] for _ in queries]
+
+        vectors = [self.embed(query) for query in queries]
+        vectors = normalise(numpy.array(vectors, dtype=numpy.float32))
+        scores = vectors.dot(self.matrix.T)
+        n = min(n, len(self.keys))
+        best = numpy.argpartition(-scores, n - 1, axis=1)[:, :n]
+
+        results = []
+        for row, cols in zip(scores, best):
+            cols = cols[numpy.argsort(-row[cols], kind='mergesort')]
+            results.append([self.keys[i] for i in cols if row[i] > threshold])
+        return results
+
+
+class FuzzyIndex():
+    """BK-tree over the keys of a table using Levenshtein distance. Finds
+       the key with the best Levenshtein ratio above a threshold without
+       comparing against every key."""
+
+    def __init__(self, keys):
+        self.keys = list(keys)
+        self.root = None
+        for pos, key in enumerate(self.keys):
+            self.add(key, pos)
+
+    def add(self, key, pos):
+        node = (key, pos, {})
+        if self.root is None:
+            self.root = node
+            return None
+
+        parent = self.root
+        while True:
+            dist = Levenshtein.distance(key, parent[0])
+            child = parent[2].get(dist)
+            if child is None:
+                parent[2][dist] = node
+                return None
+            parent = child
+
+    def search(self, query, radius):
+        """Yield (key, position) for every key within radius edits."""
+
+        stack = [self.root] if self.root else []
+        while stack:
+            key, pos, children = stack.pop()
+            dist = Levenshtein.distance(query, key)
+            if dist <= radius:
+                yield key, pos
+            for edge, child in children.items():
+                if dist - radius <= edge <= dist + radius:
+                    stack.append(child)
+
+    def best(self, query, threshold=0.75):
+        """Return the key with the highest ratio above threshold, or None.
+           The ratio counts a substitution as two edits, so a ratio above
+           t needs fewer than len(query) * 2 * (1 - t) / t plain edits."""
+
+        limit = 2 * (1 - threshold) * len(query) / threshold
+        radius = int(math.ceil(limit)) - 1
+        if radius < 0:
+            return None
+
+        best = best_ratio = best_pos = None
+        for key, pos in self.search(query, radius):
+            ratio = Levenshtein.ratio(query, key)
+            if best is None or ratio > best_ratio or \
+                    (ratio == best_ratio and pos < best_pos):
+                best, best_ratio, best_pos = key, ratio, pos
+
+        return best if best is not None and best_ratio > threshold else None
@@ -0,0 +1,151 @@
+"""
+Messenger webhook parsing and Send API message building, shared by the
+Bottle app in facebook.py and the asyncio gateway in gateway.py.
+"""
+
+import logging
+
+nlp_entities = {
+    'greetings': 'GET_STARTED_PAYLOAD',
+    'thanks': 'Thanks, bye!',
+    'bye': 'Thanks, bye!'
+}
+
+
+def parse_response(data):
+    """Return a (sender id, event) pair for every message and postback in
+       a webhook batch, in the order received. Receipts and echoes of the
+       page's own messages are skipped."""
+
+    events = []
+    if data.get('object') != 'page':
+        logging.info('Received Different Event')
+        return events
+
+    for entry in data.get('entry', []):
+        for event in entry.get('messaging', []):
+            message = event.get('message')
+            if message and message.get('is_echo'):
+                continue
+            if message or event.get('postback'):
+                events.append((event['sender']['id'], event))
+    return events
+
+
+def event_text(event):
+    """Return the text of a message or the payload of a postback."""
+
+    if event.get('message'):
+        text = parse_text(event['message'])
+        logging.info('parsed text: {}'.format(text))
+    else:
+        text = event['postback']['payload']
+    logging.info('Message received: {}'.format(text))
+    return text
+
+
+def pinned_location(message):
+    """Return the coordinates of a pinned location message, or None."""
+
+    if message.get('attachments'):
+        attachment = message['attachments'][0]
+        if attachment.get('title') == 'Pinned Location':
+            # the Send API nests coordinates in the attachment payload
+            return attachment.get('payload', attachment)['coordinates']
+    return None
+
+
+def parse_text(message):
+    coordinates = pinned_location(message)
+    if coordinates:
+        text = geo_convert(longitude=coordinates['long'],
+                           latitude=coordinates['lat'])
+    elif message.get('attachments'):
+        text = 'NO_PAYLOAD'
+    else:
+        if message.get('nlp'):
+            text = find_entity(message)
+        else:
+            text = message.get('text', 'NO_PAYLOAD')
+
+    return text
+
+
+def find_entity(message):
+    logging.info(message)
+    entities = message['nlp']['entities']
+    entity = {ent: entities[ent][0]['confidence'] for ent in entities
+              if ent in nlp_entities}
+    logging.info('found entities: {}'.format(entity))
+    if entity:
+        match = sorted(entity, key=entity.get, reverse=True)[0]
+        text = nlp_entities[match]
+    else:
+        try:
+            text = message['text']
+        except KeyError:
+            text = 'NO_PAYLOAD'
+
+    logging.info('find_entity: {}'.format(text))
+    return text
+
+
+def build_message(response):
+    """Return the Send API message for an Engine response."""
+
+    text = response['text']
+
+    # check for urls
+    if text.startswith('http'):
+        urls = text.split()
+        title = response['title']
+        titles = [title] if not isinstance(title, list) else title
+        return template(titles, urls)
+
+    # check for quickreplies
+    if response.get('quickreplies'):
+        return {'text': text,
+                'quick_replies': format_qr(response['quickreplies'])}
+    return {'text': text}
+
+
+def format_qr(quickreplies):
+    return [{
+        'title': qr,
+        'content_type': 'text',
+        'payload': 'empty'}
+            for qr in quickreplies]
+
+
+def template(titles, urls):
+    button_titles = ['Download' if url.endswith('pdf') else 'View'
+                     for url in urls]
+
+    elements = [{
+        'title': titles[i],
+        'default_action': {
+            'type': 'web_url',
+            'url': urls[i]},
+        'buttons': [{
+            'type': 'web_url',
+            'url': urls[i],
+            'title': button_titles[i]}]}
+             for i in range(len(titles))]
+
+    return {
+        "attachment": {
+            "type": "template",
+            "payload": {
+                "template_type": "generic",
+                "elements": elements}}}
+
+
+def geo_convert(longitude=None, latitude=None):
+    from postcodes import nearest_district
+
+    text = nearest_district(longitude, latitude)
+    if not text:
+        logging.info('Invalid coordinates: long={}; lat={}'.format(
+            longitude, latitude))
+        text = 'NO_PAYLOAD'
+    return text
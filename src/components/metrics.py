@@ -0,0 +1,355 @@
+"""
+In-process latency metrics and trace spans, exposed in the Prometheus text
+format on /metrics by every Bottle app and, with PLANBOT_METRICS_PORT set,
+by each Celery worker process.
+
+A span times one step of a request and nests under the span that was
+current when it started, so a Messenger turn is a tree of webhook, engine,
+session, database, Celery and Graph API spans. Trace context follows work
+onto worker threads through bind() and into Celery tasks through a message
+header. The current span is kept in a context variable, so every thread and
+every asyncio task has a trace of its own. When a root span takes longer
+than PLANBOT_TRACE_SLOW seconds its whole tree is logged under the
+planbot.trace logger.
+"""
+
+import functools
+import json
+import logging
+import os
+import random
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+SLOW = float(os.environ.get('PLANBOT_TRACE_SLOW', 1.0))
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+           2.5, 5.0, 10.0)
+HEADER = 'planbot_trace'
+
+registry = OrderedDict()
+trace_log = logging.getLogger('planbot.trace')
+
+# a span started elsewhere, in another thread or process
+Context = namedtuple('Context', 'trace_id span_id')
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n') \
+        .replace('"', '\\"')
+
+
+def label_text(names, values, extra=''):
+    pairs = ['{}="{}"'.format(n, escape(v)) for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter():
+    """A monotonically increasing count per label set."""
+
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, '') for name in self.labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self.values.get(
+            tuple(labels.get(name, '') for name in self.labels), 0)
+
+    def samples(self):
+        with self.lock:
+            items = sorted(self.values.items())
+        for key, value in items:
+            yield self.name + label_text(self.labels, key), value
+
+
+class Histogram():
+    """Observations counted into cumulative buckets per label set."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self.buckets = tuple(buckets)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.labels)
+        with self.lock:
+            counts, total = self.values.get(
+                key, ([0] * (len(self.buckets) + 1), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[-1] += 1
+            self.values[key] = (counts, total + value)
+
+    def count(self, **labels):
+        key = tuple(labels.get(name, '') for name in self.labels)
+        counts, total = self.values.get(key, ([0], 0.0))
+        return sum(counts)
+
+    def samples(self):
+        with self.lock:
+            items = sorted((key, (list(counts), total))
+                           for key, (counts, total) in self.values.items())
+        for key, (counts, total) in items:
+            cumulative = 0
+            bounds = [repr(b) for b in self.buckets] + ['+Inf']
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                yield self.name + '_bucket' + label_text(
+                    self.labels, key, 'le="{}"'.format(bound)), cumulative
+            yield self.name + '_sum' + label_text(self.labels, key), total
+            yield self.name + '_count' + label_text(self.labels, key), \
+                cumulative
+
+
+def register(metric):
+    return registry.setdefault(metric.name, metric)
+
+
+stage_seconds = register(Histogram(
+    'planbot_stage_seconds', 'Time spent in each stage of a request.',
+    ['stage', 'action']))
+http_seconds = register(Histogram(
+    'planbot_http_request_seconds', 'Time to handle each HTTP route.',
+    ['app', 'route', 'status']))
+cache_requests = register(Counter(
+    'planbot_cache_requests_total', 'Cache lookups by cache and result.',
+    ['cache', 'result']))
+fuzzy_fallbacks = register(Counter(
+    'planbot_fuzzy_fallbacks_total',
+    'Semantic matches that fell back to spell checking.', ['table']))
+celery_failures = register(Counter(
+    'planbot_celery_failures_total',
+    'Celery results that timed out or failed.', ['task', 'reason']))
+inline_suggestions = register(Counter(
+    'planbot_inline_suggestions_total',
+    'Suggestions made in process because Celery was slow or failed.',
+    ['table']))
+answers = register(Counter(
+    'planbot_answers_total', 'Lookups answered, by the path that answered.',
+    ['action', 'source']))
+graph_dropped = register(Counter(
+    'planbot_graph_dropped_total',
+    'Graph API requests dropped because the send queue was full.',
+    ['kind']))
+session_conflicts = register(Counter(
+    'planbot_session_conflicts_total',
+    'Turns rerun because another turn saved the session first.'))
+
+
+def render():
+    """Return every registered metric in the Prometheus text format."""
+
+    lines = []
+    for metric in registry.values():
+        lines.append('# HELP {} {}'.format(metric.name, metric.help))
+        lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+        for name, value in metric.samples():
+            lines.append('{} {}'.format(name, value))
+    return '\n'.join(lines) + '\n'
+
+
+# the spans open in this thread or task, innermost last
+_spans = ContextVar('planbot_spans', default=())
+
+
+class Span():
+    """One timed step of a trace."""
+
+    def __init__(self, name, parent=None, labels=None):
+        self.name = name
+        self.labels = labels or {}
+        self.span_id = '{:016x}'.format(random.getrandbits(64))
+        self.trace_id = parent.trace_id if parent else \
+            '{:032x}'.format(random.getrandbits(128))
+        self.parent_id = parent.span_id if parent else None
+        # spans are only collected into a tree within one thread or task
+        self.root = not isinstance(parent, Span)
+        if not self.root:
+            parent.children.append(self)
+        self.children = []
+        self.start = time.time()
+        self.duration = None
+
+    def context(self):
+        return Context(self.trace_id, self.span_id)
+
+    def tree(self):
+        ms = None if self.duration is None else \
+            round(self.duration * 1000, 2)
+        node = OrderedDict([('name', self.name), ('ms', ms)])
+        node.update(self.labels)
+        if self.children:
+            node['children'] = [child.tree() for child in self.children]
+        return node
+
+
+def start_span(name, parent=None, **labels):
+    """Start a span under parent, or under the current span, and make it
+       current. Every start_span must be matched by finish_span."""
+
+    s = Span(name, parent if parent is not None else current(), labels)
+    _spans.set(_spans.get() + (s,))
+    return s
+
+
+def finish_span(s):
+    s.duration = time.time() - s.start
+    spans = _spans.get()
+    if s in spans:
+        _spans.set(spans[:spans.index(s)])
+    if s.root and s.duration >= SLOW:
+        trace_log.info('slow trace {} parent={} {}'.format(
+            s.trace_id, s.parent_id, json.dumps(s.tree())))
+    return s.duration
+
+
+@contextmanager
+def span(name, **labels):
+    s = start_span(name, **labels)
+    try:
+        yield s
+    finally:
+        finish_span(s)
+
+
+@contextmanager
+def timed(stage, action=''):
+    """Time a stage in a span and in planbot_stage_seconds."""
+
+    labels = {'action': action} if action else {}
+    with span(stage, **labels) as s:
+        try:
+            yield s
+        finally:
+            stage_seconds.observe(time.time() - s.start, stage=stage,
+                                  action=action)
+
+
+def current():
+    """Return the current span or remote context, or None."""
+
+    spans = _spans.get()
+    return spans[-1] if spans else None
+
+
+def context():
+    """Return the current trace context to hand to other work."""
+
+    parent = current()
+    if parent is None:
+        return None
+    return Context(parent.trace_id, parent.span_id)
+
+
+@contextmanager
+def attach(ctx):
+    """Continue the trace of a context within this block."""
+
+    if ctx is None:
+        yield None
+        return
+    _spans.set(_spans.get() + (ctx,))
+    try:
+        yield ctx
+    finally:
+        spans = _spans.get()
+        if spans and spans[-1] is ctx:
+            _spans.set(spans[:-1])
+
+
+def bind(func):
+    """Wrap func to run in the trace current when bind was called."""
+
+    ctx = context()
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with attach(ctx):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+def encode(ctx):
+    return '{}-{}'.format(*ctx) if ctx else None
+
+
+def decode(value):
+    if not value or '-' not in value:
+        return None
+    return Context(*value.split('-', 1))
+
+
+def instrument(app, name):
+    """Time every route of a Bottle app under a span and add /metrics."""
+
+    from bottle import HTTPResponse, request, response
+
+    def plugin(callback):
+        @functools.wraps(callback)
+        def wrapper(*args, **kwargs):
+            route = request.route.rule if request.route else request.path
+            status = 500
+            start = time.time()
+            try:
+                with span('{} {}'.format(request.method, route), app=name):
+                    body = callback(*args, **kwargs)
+                status = response.status_code
+                return body
+            except HTTPResponse as resp:
+                status = resp.status_code
+                raise
+            finally:
+                http_seconds.observe(time.time() - start, app=name,
+                                     route=route, status=status)
+
+        return wrapper
+
+    @app.get('/metrics')
+    def metrics_view():
+        response.content_type = 'text/plain; version=0.0.4'
+        return render()
+
+    app.install(plugin)
+    return app
+
+
+def serve(port, host='0.0.0.0'):
+    """Serve /metrics from a daemon thread, for processes without a web
+       app of their own such as Celery workers."""
+
+    from wsgiref.simple_server import make_server, WSGIRequestHandler
+    from bottle import Bottle
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_message(self, *args):
+            return None
+
+    app = Bottle()
+
+    @app.get('/metrics')
+    def metrics_view():
+        return render()
+
+    server = make_server(host, port, app, handler_class=QuietHandler)
+    threading.Thread(target=server.serve_forever, name='planbot-metrics',
+                     daemon=True).start()
+    return server
@@ -0,0 +1,253 @@
+#!/usr/bin/python3
+"""
+Compile planbot's reference tables into a single versioned binary pack that
+processes open with mmap, so every web and Celery process on a host shares
+one page-cache copy and can answer lookups without Postgres:
+
+    $ python3 pack.py build data/planbot.SQL /var/lib/planbot/planbot.pack
+
+Set PLANBOT_PACK to the pack path to serve reads from it.
+
+Layout, little-endian: the magic b'PBPK', a uint32 format number and a
+uint32 header length, then a JSON header describing each table, then
+8-byte aligned sections. Each column of a table is a uint32 offsets array
+of rows + 1 entries into a utf-8 blob, with a uint8 array flagging nulls
+where the column has any. Rows are sorted by the utf-8 bytes of their key.
+"""
+
+import bisect
+import hashlib
+import json
+import mmap
+import os
+import re
+import struct
+import sys
+
+import numpy
+
+from titles import titlecase
+
+MAGIC = b'PBPK'
+FORMAT = 1
+PREAMBLE = struct.Struct('<4sII')
+
+# tables compiled into the pack, with the column each is keyed on
+TABLES = {
+    'definitions': ['key', 'value'],
+    'use_classes': ['key', 'value'],
+    'projects': ['key', 'value'],
+    'documents': ['key', 'value'],
+    'local_plans': ['key', 'value'],
+    'responses': ['context', 'response', 'quickreplies']}
+
+COPY = re.compile(r'^COPY (\w+) \(([^)]*)\) FROM stdin;$')
+ESCAPE = re.compile(r'\\(.)')
+ESCAPES = {'n': '\n', 't': '\t', 'r': '\r', 'b': '\b', 'f': '\f',
+           'v': '\v', '\\': '\\'}
+
+
+def read_dump(path):
+    """Return {table: (columns, rows)} for every COPY block in a
+       pg_dump plain-text file."""
+
+    tables = {}
+    with open(path, encoding='utf-8') as f:
+        lines = iter(f)
+        for line in lines:
+            match = COPY.match(line.rstrip('\n'))
+            if not match:
+                continue
+            columns = [c.strip() for c in match.group(2).split(',')]
+            rows = []
+            for line in lines:
+                line = line.rstrip('\n')
+                if line == '\\.':
+                    break
+                rows.append(tuple(
+                    None if field == '\\N' else ESCAPE.sub(
+                        lambda m: ESCAPES.get(m.group(1), m.group(1)), field)
+                    for field in line.split('\t')))
+            tables[match.group(1)] = (columns, rows)
+    return tables
+
+
+def build(source, path):
+    """Compile the tables of a pg_dump file into a pack at path and return
+       the pack's data version."""
+
+    dump = read_dump(source)
+    header = {'tables': {}, 'lists': {}}
+    sections = []
+    offset = [0]
+
+    def add(data):
+        start = offset[0]
+        sections.append(data)
+        offset[0] += len(data)
+        padding = -len(data) % 8
+        if padding:
+            sections.append(b'\0' * padding)
+            offset[0] += padding
+        return [start, len(data)]
+
+    def add_strings(strings):
+        encoded = [(s or '').encode('utf-8') for s in strings]
+        offsets = numpy.zeros(len(encoded) + 1, dtype='<u4')
+        offsets[1:] = numpy.cumsum([len(e) for e in encoded])
+        entry = {'offsets': add(offsets.tobytes()),
+                 'blob': add(b''.join(encoded))}
+        if any(s is None for s in strings):
+            nulls = numpy.array([s is None for s in strings], dtype='u1')
+            entry['nulls'] = add(nulls.tobytes())
+        return entry
+
+    for table, wanted in sorted(TABLES.items()):
+        if table not in dump:
+            continue
+        columns, rows = dump[table]
+        indexes = [columns.index(column) for column in wanted]
+        # keep the first row for a key, as a lookup by key would
+        unique = {}
+        for row in rows:
+            unique.setdefault(row[indexes[0]], [row[i] for i in indexes])
+        rows = sorted(unique.values(), key=lambda r: r[0].encode('utf-8'))
+
+        entry = {'rows': len(rows), 'columns': wanted, 'data': {}}
+        for pos, column in enumerate(wanted):
+            entry['data'][column] = add_strings([r[pos] for r in rows])
+        if table != 'responses':
+            titles = [titlecase(r[0]) for r in rows]
+            entry['data']['display'] = add_strings(titles)
+            header['lists']['titles:' + table] = add_strings(sorted(titles))
+        header['tables'][table] = entry
+
+    body = b''.join(sections)
+    header['version'] = hashlib.sha1(body).hexdigest()[:16]
+    encoded = json.dumps(header, sort_keys=True).encode('utf-8')
+    encoded += b' ' * (-(PREAMBLE.size + len(encoded)) % 8)
+
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(PREAMBLE.pack(MAGIC, FORMAT, len(encoded)))
+        f.write(encoded)
+        f.write(body)
+    os.replace(tmp, path)
+    return header['version']
+
+
+class Strings():
+    """Read-only sequence of strings stored in a pack section."""
+
+    def __init__(self, buf, base, entry):
+        start, length = entry['offsets']
+        self.offsets = numpy.frombuffer(buf, dtype='<u4',
+                                        count=length // 4,
+                                        offset=base + start)
+        self.blob = base + entry['blob'][0]
+        self.nulls = None
+        if 'nulls' in entry:
+            start, length = entry['nulls']
+            self.nulls = numpy.frombuffer(buf, dtype='u1', count=length,
+                                          offset=base + start)
+        self.buf = buf
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def raw(self, i):
+        return self.buf[self.blob + int(self.offsets[i]):
+                        self.blob + int(self.offsets[i + 1])]
+
+    def __getitem__(self, i):
+        if self.nulls is not None and self.nulls[i]:
+            return None
+        return self.raw(i).decode('utf-8')
+
+
+class RawKeys():
+    """Keys as bytes, for binary search without decoding."""
+
+    def __init__(self, strings):
+        self.strings = strings
+
+    def __len__(self):
+        return len(self.strings)
+
+    def __getitem__(self, i):
+        return self.strings.raw(i)
+
+
+class KnowledgePack():
+    """A compiled pack opened with mmap. Lookups binary search the sorted
+       keys in place and only decode the row they return."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, fmt, length = PREAMBLE.unpack_from(self.buf)
+        if magic != MAGIC or fmt != FORMAT:
+            raise Exception('Not a planbot pack: {}'.format(path))
+        header = json.loads(self.buf[PREAMBLE.size:
+                                     PREAMBLE.size + length].decode('utf-8'))
+        base = PREAMBLE.size + length
+
+        self.version = header['version']
+        self.tables = {}
+        for table, entry in header['tables'].items():
+            self.tables[table] = {
+                column: Strings(self.buf, base, data)
+                for column, data in entry['data'].items()}
+            self.tables[table]['columns'] = entry['columns']
+        self.lists = {name: Strings(self.buf, base, entry)
+                      for name, entry in header['lists'].items()}
+
+    def find(self, table, key):
+        """Return the row number of key in table, or None."""
+
+        keys = self.tables[table][self.tables[table]['columns'][0]]
+        target = key.encode('utf-8')
+        pos = bisect.bisect_left(RawKeys(keys), target)
+        if pos < len(keys) and keys.raw(pos) == target:
+            return pos
+        return None
+
+    def lookup(self, table, key):
+        """Return the row for key as a tuple, or None."""
+
+        pos = self.find(table, key)
+        if pos is None:
+            return None
+        data = self.tables[table]
+        return tuple(data[column][pos] for column in data['columns'])
+
+    def keys(self, table):
+        keys = self.tables[table][self.tables[table]['columns'][0]]
+        return [keys[i] for i in range(len(keys))]
+
+    def rows(self, table):
+        data = self.tables[table]
+        columns = [data[column] for column in data['columns']]
+        for i in range(len(columns[0])):
+            yield tuple(column[i] for column in columns)
+
+    def display(self, table, key):
+        """Return the titlecased display name for a key, or None."""
+
+        if 'display' not in self.tables[table]:
+            return None
+        pos = self.find(table, key)
+        return None if pos is None else self.tables[table]['display'][pos]
+
+    def titles(self, table):
+        """Return the sorted display names of every key in a table."""
+
+        titles = self.lists['titles:' + table]
+        return [titles[i] for i in range(len(titles))]
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 4 or sys.argv[1] != 'build':
+        sys.exit('usage: pack.py build <planbot.SQL> <output path>')
+    print('Built pack version {}'.format(build(sys.argv[2], sys.argv[3])))
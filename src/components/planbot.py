@@ -1,77 +1,152 @@
-from operator import itemgetter
+"""
+Planbot answers a query for one action, from an exact key match, keys
+containing the query or, failing both, a similarity search run as a Celery
+task in tasks.py. The Celery app, postcode index and their dependencies
+are imported on first use, so front ends that only serve exact matches
+never load them.
+
+A lookup waits on Celery only until its deadline, and its task expires
+then, so workers skip tasks nobody is waiting for. While Celery has lately
+been answering slower than a lookup can wait, and whenever a task fails
+or times out, the query is spell checked in process instead. The source
+attribute records which path answered.
+"""
+
 import logging
+import os
 import re
+import threading
+import time
 
-import spacy
-import Levenshtein
-import requests
-from celery import Celery
-
-from connectdb import ConnectDB
-
-# setup celery
-app = Celery('planbot',
-             broker='redis://',
-             backend='redis://')
+import metrics
+from connectdb import ConnectDB, display_name, known_version
 
-app.conf.update(result_expires=60,
-                worker_max_tasks_per_child=5)
+# reports per reply, as a Messenger list holds at most ten cards
+REPORT_PAGE = 10
+# seconds a lookup waits on a Celery result when it has no deadline
+RESULT_TIMEOUT = float(os.environ.get('PLANBOT_RESULT_TIMEOUT', 10))
+# weight of each new sample in the estimate of Celery's answer time, and
+# seconds between tasks still sent while lookups are answered in process
+LATENCY_WEIGHT = 0.2
+PROBE_INTERVAL = float(os.environ.get('PLANBOT_CELERY_PROBE', 5))
 
 # setup logging
 logging.basicConfig(level=logging.INFO)
 logging.getLogger("requests").setLevel(logging.WARNING)
 
-uncap_words = ['a', 'an', 'and', 'as', 'at', 'but', 'by', 'en', 'for', 'if',
-               'in', 'of', 'on', 'or', 'the', 'to', 'via']
 
+class CeleryLatency():
+    """Moving average of the seconds Celery takes to answer, queueing
+       included. Lookups skip Celery while the average is over their
+       budget, though one task per probe_interval is still sent so the
+       average follows the queue back down."""
 
-def get_result(task):
-    try:
-        return task.get()
-    except Exception as err:
-        logging.info('Result error: {}'.format(err))
+    def __init__(self, weight=LATENCY_WEIGHT, probe_interval=PROBE_INTERVAL):
+        self.weight = weight
+        self.probe_interval = probe_interval
+        self.estimate = None
+        self.probed = 0
+        self.lock = threading.Lock()
 
+    def observe(self, seconds):
+        with self.lock:
+            if self.estimate is None:
+                self.estimate = seconds
+            else:
+                self.estimate += self.weight * (seconds - self.estimate)
+        return None
 
-def titlecase(phrase):
-    if phrase == 'uk':
-        return phrase.upper()
+    def allows(self, budget):
+        """Whether to send a task that must answer within budget seconds."""
 
-    phrase = phrase.capitalize()
+        if budget <= 0:
+            return False
+        with self.lock:
+            if self.estimate is None or self.estimate <= budget:
+                return True
+            now = time.time()
+            if now - self.probed >= self.probe_interval:
+                self.probed = now
+                return True
+        return False
 
-    # don't capitalise certain words
-    for word in phrase.split()[1:]:
-        if word not in uncap_words:
-            phrase = phrase.replace(word, word.capitalize())
 
-    # uppercase acronyms and lowercase longer text in parentheses
-    for acr in re.compile(r'\(\w{1,5}\)').findall(phrase):
-        phrase = phrase.replace(acr, acr.upper())
-    for paren in re.compile(r'\([\w\s]{6,}\)').findall(phrase):
-        phrase = phrase.replace(paren, paren.lower())
+celery_latency = CeleryLatency()
 
-    return phrase
 
+def remaining(deadline):
+    """Return the seconds left before a deadline, or RESULT_TIMEOUT."""
 
-@app.task
-def semantic_analysis(query, keys):
-    def ratio_gen():
-        for key in keys:
-            yield key, nlp(query).similarity(nlp(key))
+    return RESULT_TIMEOUT if deadline is None else deadline - time.time()
 
-    entities = {key: ratio for key, ratio in ratio_gen() if ratio > 0.5}
-    entities = sorted(entities, key=entities.get, reverse=True)[:3]
 
-    return spell_check(query, keys) if not entities else entities
+def get_result(task, name='', timeout=None):
+    from celery.exceptions import TimeoutError
+
+    start = time.time()
+    try:
+        with metrics.timed('celery_wait', action=name):
+            res = task.get(timeout=timeout)
+        celery_latency.observe(time.time() - start)
+        return res
+    except Exception as err:
+        reason = 'timeout' if isinstance(err, TimeoutError) else 'error'
+        if reason == 'timeout':
+            celery_latency.observe(time.time() - start)
+        metrics.celery_failures.inc(task=name, reason=reason)
+        logging.info('Result error: {}'.format(err))
+
+
+async def get_result_async(task, name='', timeout=RESULT_TIMEOUT):
+    """Await a Celery result without holding a thread, as get_result."""
+
+    import asyncio
+    from celery.result import EagerResult
+    from results import result_waiter
+
+    start = time.time()
+    try:
+        with metrics.timed('celery_wait', action=name):
+            if isinstance(task, EagerResult):
+                res = task.get()
+                celery_latency.observe(time.time() - start)
+                return res
+            meta = await asyncio.wait_for(
+                result_waiter(task.backend).wait(task.id), timeout)
+        celery_latency.observe(time.time() - start)
+        if meta['status'] != 'SUCCESS':
+            raise RuntimeError('{}: {}'.format(meta['status'],
+                                               meta['result']))
+        return meta['result']
+    except Exception as err:
+        reason = 'timeout' if isinstance(err, asyncio.TimeoutError) \
+            else 'error'
+        if reason == 'timeout':
+            celery_latency.observe(time.time() - start)
+        metrics.celery_failures.inc(task=name, reason=reason)
+        logging.info('Result error: {}'.format(err))
 
 
-def spell_check(query, keys):
-    def ratio_gen():
-        for key in keys:
-            yield key, Levenshtein.ratio(query, key)
+def table_version(table, db=None):
+    """Return a table's data version, only querying it through db, or a
+       new connection, when no pack or query cache already knows it."""
 
-    entity = max(ratio_gen(), key=itemgetter(1))
+    version = known_version(table)
+    if version is None:
+        if db is not None:
+            return db.data_version()
+        with ConnectDB(table) as db:
+            return db.data_version()
+    return version
 
-    return [entity[0]] if entity[1] > 0.75 else []
+
+def spell_check_inline(query, table):
+    """Suggest keys for a query with tasks.spell_check, in process."""
+
+    from tasks import spell_check
+
+    metrics.inline_suggestions.inc(table=table)
+    return spell_check(query, table)
 
 
 class Planbot:
@@ -79,6 +154,11 @@ class Planbot:
     def __init__(self):
         self.action = self.query = self.sector = None
         self.result = self.options = None
+        # key of the last report returned when more reports follow
+        self.after = self.cursor = None
+        # time by which to answer, and the path that answered
+        self.deadline = self.source = None
+        self.sources = []
         self.db = None
         self.switch = {
             'definitions': self.get_direct,
@@ -87,84 +167,356 @@ class Planbot:
             'documents': self.get_options,
             'local_plans': self.get_local_plan,
             'reports': self.get_reports}
+        # tables whose lookups start with an exact key match
+        self.exact = ['definitions', 'local_plans']
 
-    def run_task(self, action=None, query=None, sector=None):
-        self.result = self.options = None
-        self.action = action
+    def run_task(self, action=None, query=None, sector=None, after=None,
+                 deadline=None):
+        self.result = self.options = self.cursor = self.source = None
+        self.action, self.after, self.deadline = action, after, deadline
         self.query = self.ready(query)
         self.sector = self.ready(sector) if sector else sector
 
-        self.db = ConnectDB(action)
-        self.switch[action]()
-        self.db.close()
+        with metrics.timed('planbot', action=action), \
+                ConnectDB(action) as self.db:
+            self.switch[action]()
+        self.answered()
         return self.result, self.options
 
+    def answered(self):
+        if self.source:
+            metrics.answers.inc(action=self.action, source=self.source)
+        return None
+
+    def run_batch(self, tasks, deadline=None):
+        """Answer a list of (action, query) pairs, returning (result,
+           options) pairs in the same order and setting sources to the
+           path that answered each. Exact matches are fetched with one
+           query per table and every miss is sent through a single
+           batched similarity pass."""
+
+        answers = [(None, None)] * len(tasks)
+        self.sources = [None] * len(tasks)
+        tables = {}
+        for pos, (action, query) in enumerate(tasks):
+            query = self.ready(query)
+            if action == 'local_plans':
+                query = self.find_council(query)
+            tables.setdefault(action, []).append((pos, query))
+
+        misses = []
+        for action, items in tables.items():
+            self.action = action
+            with ConnectDB(action) as self.db:
+                found = {}
+                if action in self.exact:
+                    found = dict(self.db.query_many([q for _, q in items]))
+
+                for pos, query in items:
+                    self.query, self.result, self.options = query, None, None
+                    self.source = None
+                    if action == 'use_classes' and 'list' in query:
+                        self.get_use_class()
+                    elif query in found:
+                        self.result = self.process((query, found[query]))
+                        self.source = 'exact'
+                    else:
+                        if action == 'local_plans':
+                            self.strip_council()
+                        if not self.match_keys():
+                            misses.append((pos, self.query, action))
+                            continue
+                    answers[pos] = (self.result, self.options)
+                    self.sources[pos] = self.source
+                    self.answered()
+
+        if misses:
+            suggested = self.suggest_many([(query, action)
+                                           for _, query, action in misses],
+                                          deadline)
+            for (pos, _, action), (keys, source) in zip(misses, suggested):
+                answers[pos] = (None, [display_name(action, k) for k in keys])
+                self.sources[pos] = source
+                metrics.answers.inc(action=action, source=source)
+
+        return answers
+
+    @staticmethod
+    def suggest_many(items, deadline=None):
+        """Return (suggestions, source) for each (query, table) pair. Pairs
+           the suggestion cache has no entry for are sent through a single
+           batch_semantic_analysis and their answers cached, or spell
+           checked in process if Celery is not expected to answer before
+           the deadline."""
+
+        from suggestions import suggestion_cache
+
+        cache = suggestion_cache()
+        tables = {}
+        for pos, (query, table) in enumerate(items):
+            tables.setdefault(table, []).append(pos)
+
+        found = [None] * len(items)
+        sources = ['cache'] * len(items)
+        versions = {}
+        if cache:
+            for table, positions in tables.items():
+                versions[table] = table_version(table)
+                hits = cache.get_many(table, versions[table],
+                                      [items[pos][0] for pos in positions])
+                for pos, keys in zip(positions, hits):
+                    found[pos] = keys
+
+        missing = [pos for pos, keys in enumerate(found) if keys is None]
+        res = None
+        budget = remaining(deadline)
+        if missing and celery_latency.allows(budget):
+            from tasks import batch_semantic_analysis
+
+            res = get_result(batch_semantic_analysis.apply_async(
+                ([items[pos] for pos in missing],), expires=budget),
+                'batch_semantic_analysis', timeout=budget)
+        if missing and res is None:
+            for pos in missing:
+                found[pos] = spell_check_inline(*items[pos])
+                sources[pos] = 'spell_check'
+        elif missing:
+            for pos, keys in zip(missing, res):
+                found[pos] = keys
+                sources[pos] = 'semantic'
+            if cache:
+                answered = set(missing)
+                for table, positions in tables.items():
+                    cache.put_many(table, versions[table], [
+                        (items[pos][0], found[pos]) for pos in positions
+                        if pos in answered])
+
+        return [(keys or [], source) for keys, source in zip(found, sources)]
+
     def get_direct(self):
         res = self.db.query_spec(self.query, spec='EQL')
         if res:
             self.result = self.process(res)
+            self.source = 'exact'
         else:
             if self.action == 'local_plans':
-                for word in ['borough', 'council', 'district', 'london']:
-                    self.query = self.query.replace(word, '')
+                self.strip_council()
             self.get_options()
         return None
 
     def get_options(self):
+        if not self.match_keys():
+            self.options = [display_name(self.action, k)
+                            for k in self.suggest()]
+        return None
+
+    def suggest(self):
+        """Return semantic_analysis's suggestions for the query, from the
+           suggestion cache when it has an entry and otherwise from Celery,
+           caching the answer. If Celery is not expected to answer before
+           the deadline, or fails or times out, the query is spell checked
+           in process instead and nothing is cached."""
+
+        from suggestions import suggestion_cache
+
+        cache = suggestion_cache()
+        version = table_version(self.action, self.db) if cache else None
+        keys = cache.get(self.action, version, self.query) if cache else None
+        if keys is not None:
+            self.source = 'cache'
+            return keys
+
+        budget = remaining(self.deadline)
+        if celery_latency.allows(budget):
+            from tasks import semantic_analysis
+
+            keys = get_result(semantic_analysis.apply_async(
+                (self.query, self.action), expires=budget),
+                'semantic_analysis', timeout=budget)
+        if keys is None:
+            self.source = 'spell_check'
+            return spell_check_inline(self.query, self.action)
+
+        self.source = 'semantic'
+        if cache:
+            cache.put(self.action, version, self.query, keys)
+        return keys
+
+    def match_keys(self):
+        """Look for keys containing the query, setting the result for a
+           single match or options for several. Returns False if none."""
+
         res = [k[0] for k in self.db.query_spec(self.query, spec='LIKE')]
         if len(res) == 1:
             res = self.db.query_spec(res[0], spec='EQL')
             self.result = self.process(res)
-        elif not res:
-            keys = self.db.query_keys()
-            res = get_result(semantic_analysis.delay(self.query, keys))
-            self.options = [titlecase(k) for k in res]
-        else:
-            self.options = [titlecase(k) for k in res]
-        return None
+        elif res:
+            self.options = [display_name(self.action, k) for k in res]
+        if res:
+            self.source = 'substring'
+        return bool(res)
 
     def get_use_class(self):
         if 'list' in self.query:
-            keys = self.db.query_keys()
-            self.result = sorted([titlecase(key) for key in keys])
+            self.result = self.db.query_titles()
+            self.source = 'exact'
         else:
             self.get_options()
             return None
 
     def get_local_plan(self):
-        def find_lpa(postcode):
-            api = 'https://api.postcodes.io/postcodes/'
-            res = requests.get(api + postcode).json()
-            if res.get('result'):
-                return res['result']['admin_district'].lower()
-
-        if re.compile(r'[A-Z]+\d+[A-Z]?\s?\d[A-Z]+', re.I).search(self.query):
-            council = find_lpa(self.query)
+        self.query = self.find_council(self.query)
+        self.get_direct()
+        return None
+
+    def strip_council(self):
+        for word in ['borough', 'council', 'district', 'london']:
+            self.query = self.query.replace(word, '')
+        return None
+
+    @staticmethod
+    def find_council(query):
+        """Swap a postcode for the name of its council."""
+
+        if re.compile(r'[A-Z]+\d+[A-Z]?\s?\d[A-Z]+', re.I).search(query):
+            from postcodes import find_district
+
+            council = find_district(query)
             if not council:
-                logging.info('No council found for {}'.format(self.query))
+                logging.info('No council found for {}'.format(query))
             else:
-                self.query = council
+                return council.lower()
+        return query
 
-        self.get_direct()
+    def get_reports(self):
+        # fetch one extra report to learn whether another page follows
+        res = self.db.query_reports(loc=self.query, sec=self.sector,
+                                    limit=REPORT_PAGE + 1, after=self.after)
+        self.page_reports(res)
         return None
 
-    def get_reports(self):
-        res = self.db.query_reports(loc=self.query, sec=self.sector)
+    def page_reports(self, res):
+        if len(res) > REPORT_PAGE:
+            res = res[:REPORT_PAGE]
+            title, url, date = res[-1]
+            self.cursor = (date, title, url)
         if res:
             titles = [r[0] for r in res]
             links = [r[1] for r in res]
             self.result = (titles, links)
+            self.source = 'exact'
         return None
 
     @staticmethod
     def ready(phrase):
         return phrase.replace('...', '').lower()
 
-    @staticmethod
-    def process(result):
-        return titlecase(result[0]), result[1]
+    def process(self, result):
+        return display_name(self.action, result[0]), result[1]
+
+
+class AsyncPlanbot(Planbot):
+    """Planbot for coroutines. Tables are read through AsyncConnectDB,
+       and suggestions through AsyncSuggestionCache and Celery results
+       awaited with get_result_async; the matching itself is Planbot's."""
+
+    async def run_task(self, action=None, query=None, sector=None,
+                       after=None, deadline=None):
+        from asyncdb import AsyncConnectDB
+
+        self.result = self.options = self.cursor = self.source = None
+        self.action, self.after, self.deadline = action, after, deadline
+        self.query = self.ready(query)
+        self.sector = self.ready(sector) if sector else sector
+
+        with metrics.timed('planbot', action=action):
+            async with AsyncConnectDB(action) as self.db:
+                await self.switch[action]()
+        self.answered()
+        return self.result, self.options
+
+    async def get_direct(self):
+        res = await self.db.query_spec(self.query, spec='EQL')
+        if res:
+            self.result = self.process(res)
+            self.source = 'exact'
+        else:
+            if self.action == 'local_plans':
+                self.strip_council()
+            await self.get_options()
+        return None
+
+    async def get_options(self):
+        if not await self.match_keys():
+            keys = await self.suggest()
+            self.options = [display_name(self.action, k) for k in keys]
+        return None
+
+    async def suggest(self):
+        import asyncio
+        from suggestions import async_suggestion_cache
+
+        cache = async_suggestion_cache()
+        version = known_version(self.action) if cache else None
+        if cache and version is None:
+            version = await self.db.data_version()
+        keys = await cache.get(self.action, version, self.query) \
+            if cache else None
+        if keys is not None:
+            self.source = 'cache'
+            return keys
+
+        budget = remaining(self.deadline)
+        if celery_latency.allows(budget):
+            from tasks import semantic_analysis
+
+            keys = await get_result_async(
+                semantic_analysis.apply_async((self.query, self.action),
+                                              expires=budget),
+                'semantic_analysis', timeout=budget)
+        if keys is None:
+            # the first spell check of a table loads its keys
+            self.source = 'spell_check'
+            return await asyncio.get_event_loop().run_in_executor(
+                None, spell_check_inline, self.query, self.action)
+
+        self.source = 'semantic'
+        if cache:
+            await cache.put(self.action, version, self.query, keys)
+        return keys
+
+    async def match_keys(self):
+        res = await self.db.query_spec(self.query, spec='LIKE')
+        res = [k[0] for k in res]
+        if len(res) == 1:
+            res = await self.db.query_spec(res[0], spec='EQL')
+            self.result = self.process(res)
+        elif res:
+            self.options = [display_name(self.action, k) for k in res]
+        if res:
+            self.source = 'substring'
+        return bool(res)
 
+    async def get_use_class(self):
+        if 'list' in self.query:
+            self.result = await self.db.query_titles()
+            self.source = 'exact'
+        else:
+            await self.get_options()
+        return None
 
-if __name__ == '__main__':
-    nlp = spacy.load('en_vectors_glove_md')
-    app.start()
+    async def get_local_plan(self):
+        import asyncio
+
+        # postcodes may be looked up remotely, so off the event loop
+        self.query = await asyncio.get_event_loop().run_in_executor(
+            None, self.find_council, self.query)
+        await self.get_direct()
+        return None
+
+    async def get_reports(self):
+        res = await self.db.query_reports(loc=self.query, sec=self.sector,
+                                          limit=REPORT_PAGE + 1,
+                                          after=self.after)
+        self.page_reports(res)
+        return None
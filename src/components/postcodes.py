@@ -0,0 +1,246 @@
+#!/usr/bin/python3
+"""
+Postcode to local authority lookups served from a compiled local index,
+with Postcodes.io as an optional cached fallback.
+
+The index is built from an ONS postcode directory (NSPL or ONSPD) CSV and
+written as a directory of numpy arrays that are memory-mapped on load:
+
+    $ python3 postcodes.py build NSPL_MAY_2017_UK.csv /var/lib/planbot/pc \
+          --names LA_UA_names_and_codes.csv
+
+Set PLANBOT_POSTCODES to the output directory to use it.
+"""
+
+import argparse
+import csv
+import functools
+import json
+import logging
+import math
+import os
+
+import numpy
+import requests
+
+import metrics
+
+INDEX_PATH = os.environ.get('PLANBOT_POSTCODES')
+REMOTE = os.environ.get('PLANBOT_POSTCODES_REMOTE', '1') == '1'
+REMOTE_TIMEOUT = float(os.environ.get('PLANBOT_POSTCODES_TIMEOUT', 3))
+API = 'https://api.postcodes.io/postcodes'
+
+# grid cells are CELL degrees square; nearest matches must be within
+# MAX_DISTANCE metres of the point
+CELL = 0.01
+MAX_DISTANCE = 1000
+EARTH_RADIUS = 6371000
+
+
+def normalise(postcode):
+    return postcode.replace(' ', '').upper()
+
+
+def cell_ids(lat, lon):
+    row = numpy.floor(numpy.asarray(lat) / CELL).astype(numpy.int64) + 9000
+    col = numpy.floor(numpy.asarray(lon) / CELL).astype(numpy.int64) + 18000
+    return row * 100000 + col
+
+
+class PostcodeIndex():
+    """Sorted, memory-mapped arrays of postcodes, their districts and
+       coordinates, plus a grid of coordinates for nearest lookups."""
+
+    files = ['postcodes', 'districts', 'lat', 'lon', 'cells', 'grid']
+
+    def __init__(self, path):
+        for name in self.files:
+            setattr(self, name, numpy.load(
+                os.path.join(path, name + '.npy'), mmap_mode='r'))
+        with open(os.path.join(path, 'names.json'), encoding='utf-8') as f:
+            self.names = json.load(f)
+
+    def district(self, postcode):
+        """Return the admin district of a postcode, or None."""
+
+        key = normalise(postcode).encode('ascii', 'ignore')
+        pos = int(numpy.searchsorted(self.postcodes, key))
+        if pos < len(self.postcodes) and self.postcodes[pos] == key:
+            return self.names[self.districts[pos]]
+        return None
+
+    def nearest(self, longitude, latitude, max_distance=MAX_DISTANCE):
+        """Return the admin district of the postcode nearest to a point,
+           or None if there is none within max_distance metres."""
+
+        # cells are narrowest east to west, so size the search by width
+        width = EARTH_RADIUS * math.radians(CELL) * \
+            math.cos(math.radians(min(abs(latitude), 89)))
+        reach = int(math.ceil(max_distance / width))
+        centre = int(cell_ids(latitude, longitude))
+        candidates = []
+        for drow in range(-reach, reach + 1):
+            for dcol in range(-reach, reach + 1):
+                cell = centre + drow * 100000 + dcol
+                lo = numpy.searchsorted(self.cells, cell)
+                hi = numpy.searchsorted(self.cells, cell, side='right')
+                candidates.extend(self.grid[lo:hi])
+
+        if not candidates:
+            return None
+
+        rows = numpy.array(candidates)
+        lat = numpy.radians(self.lat[rows])
+        dlat = lat - math.radians(latitude)
+        dlon = (numpy.radians(self.lon[rows]) - math.radians(longitude)) * \
+            numpy.cos((lat + math.radians(latitude)) / 2)
+        distance = EARTH_RADIUS * numpy.hypot(dlat, dlon)
+
+        best = int(numpy.argmin(distance))
+        if distance[best] > max_distance:
+            return None
+        return self.names[self.districts[rows[best]]]
+
+
+def build(source, path, names=None, postcode_column='pcds',
+          district_column='laua', lat_column='lat', lon_column='long'):
+    """Compile a postcode directory CSV into an index at path. District
+       codes are replaced with names from a (code, name) CSV if given.
+       Terminated postcodes and those without coordinates are skipped."""
+
+    code_names = {}
+    if names:
+        with open(names, encoding='utf-8-sig') as f:
+            for row in csv.reader(f):
+                if len(row) >= 2:
+                    code_names[row[0]] = row[1]
+
+    rows = []
+    with open(source, encoding='utf-8-sig') as f:
+        for row in csv.DictReader(f):
+            if row.get('doterm') or not row.get(district_column):
+                continue
+            lat, lon = float(row[lat_column]), float(row[lon_column])
+            # the directory marks missing coordinates with lat 99.999999
+            if lat > 90:
+                continue
+            code = row[district_column]
+            rows.append((normalise(row[postcode_column]).encode('ascii'),
+                         code_names.get(code, code), lat, lon))
+    rows.sort()
+
+    district_names = sorted({row[1] for row in rows})
+    numbers = {name: i for i, name in enumerate(district_names)}
+    lat = numpy.array([row[2] for row in rows], dtype=numpy.float32)
+    lon = numpy.array([row[3] for row in rows], dtype=numpy.float32)
+    cells = cell_ids(lat, lon)
+    grid = numpy.argsort(cells, kind='mergesort').astype(numpy.int32)
+
+    os.makedirs(path, exist_ok=True)
+    arrays = {
+        'postcodes': numpy.array([row[0] for row in rows], dtype='S7'),
+        'districts': numpy.array([numbers[row[1]] for row in rows],
+                                 dtype=numpy.uint16),
+        'lat': lat,
+        'lon': lon,
+        'cells': cells[grid],
+        'grid': grid}
+    for name, array in arrays.items():
+        numpy.save(os.path.join(path, name + '.npy'), array)
+    with open(os.path.join(path, 'names.json'), 'w', encoding='utf-8') as f:
+        json.dump(district_names, f)
+
+    return len(rows)
+
+
+def remote_district(postcode):
+    try:
+        return fetch_district(postcode)
+    except (requests.RequestException, ValueError) as err:
+        logging.info('Postcode lookup failed: {}'.format(err))
+        return None
+
+
+def remote_nearest(longitude, latitude):
+    try:
+        return fetch_nearest(longitude, latitude)
+    except (requests.RequestException, ValueError) as err:
+        logging.info('Postcode lookup failed: {}'.format(err))
+        return None
+
+
+def fetch(url, params=None):
+    """GET a Postcodes.io url. Failed requests raise rather than return,
+       so the caches below only keep answers Postcodes.io actually gave;
+       a 404 is an answer, meaning no such postcode."""
+
+    resp = requests.get(url, params=params, timeout=REMOTE_TIMEOUT)
+    if resp.status_code != 404:
+        resp.raise_for_status()
+    return resp.json()
+
+
+@functools.lru_cache(maxsize=4096)
+def fetch_district(postcode):
+    with metrics.timed('postcodes', action='district'):
+        res = fetch('{}/{}'.format(API, postcode))
+    if res.get('result'):
+        return res['result']['admin_district']
+    return None
+
+
+@functools.lru_cache(maxsize=4096)
+def fetch_nearest(longitude, latitude):
+    with metrics.timed('postcodes', action='nearest'):
+        res = fetch(API, params={'lon': longitude, 'lat': latitude})
+    if res.get('result'):
+        return res['result'][0]['admin_district']
+    return None
+
+
+index = None
+
+
+def postcode_index():
+    """Return the local index named by PLANBOT_POSTCODES, if any."""
+
+    global index
+    if index is None and INDEX_PATH:
+        index = PostcodeIndex(INDEX_PATH)
+    return index
+
+
+def find_district(postcode):
+    """Return the admin district for a postcode, or None."""
+
+    local = postcode_index()
+    district = local.district(postcode) if local else None
+    if district is None and REMOTE:
+        district = remote_district(normalise(postcode))
+    return district
+
+
+def nearest_district(longitude, latitude):
+    """Return the admin district nearest to a point, or None."""
+
+    local = postcode_index()
+    district = local.nearest(longitude, latitude) if local else None
+    if district is None and REMOTE:
+        # ~10m of rounding lets nearby pins share a cache entry
+        district = remote_nearest(round(longitude, 4), round(latitude, 4))
+    return district
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('command', choices=['build'])
+    parser.add_argument('source', help='ONS postcode directory CSV')
+    parser.add_argument('path', help='output directory')
+    parser.add_argument('--names', help='CSV of district codes and names')
+    parser.add_argument('--postcode-column', default='pcds')
+    parser.add_argument('--district-column', default='laua')
+    args = parser.parse_args()
+    count = build(args.source, args.path, names=args.names,
+                  postcode_column=args.postcode_column,
+                  district_column=args.district_column)
+    print('Indexed {} postcodes'.format(count))
@@ -0,0 +1,85 @@
+"""
+Awaits Celery task results from the asyncio gateway. The Redis result
+backend publishes each result on a channel named after its key, so every
+waiting coroutine in the process shares one pubsub connection rather than
+blocking a thread, or holding a connection, per task.
+"""
+
+import asyncio
+import logging
+
+_waiters = {}
+
+
+class ResultWaiter():
+    """Resolves futures for task results from a single Redis pubsub
+       subscription, subscribing to each task's channel while anything
+       is waiting on it."""
+
+    def __init__(self, backend):
+        import redis.asyncio
+
+        self.backend = backend
+        self.redis = redis.asyncio.StrictRedis.from_url(backend.url)
+        self.pubsub = self.redis.pubsub()
+        self.waiting = {}
+        self.reader = None
+        # the pubsub connection is opened by the first subscribe
+        self.lock = asyncio.Lock()
+
+    async def wait(self, task_id):
+        """Return the task's result meta once it is in a ready state."""
+
+        key = self.backend.get_key_for_task(task_id)
+        future = asyncio.get_event_loop().create_future()
+        futures = self.waiting.setdefault(key, [])
+        futures.append(future)
+        try:
+            if len(futures) == 1:
+                async with self.lock:
+                    await self.pubsub.subscribe(key)
+            if self.reader is None or self.reader.done():
+                self.reader = asyncio.ensure_future(self.read())
+            # the result may have been stored before we subscribed
+            meta = self.ready(await self.redis.get(key))
+            return meta if meta is not None else await future
+        finally:
+            futures.remove(future)
+            if not futures:
+                del self.waiting[key]
+                async with self.lock:
+                    await self.pubsub.unsubscribe(key)
+
+    def ready(self, value):
+        from celery import states
+
+        if value is None:
+            return None
+        meta = self.backend.decode_result(value)
+        return meta if meta['status'] in states.READY_STATES else None
+
+    async def read(self):
+        while self.waiting:
+            try:
+                message = await self.pubsub.get_message(
+                    ignore_subscribe_messages=True, timeout=1.0)
+            except Exception as err:
+                logging.info('Result subscription failed: {}'.format(err))
+                await asyncio.sleep(1)
+                continue
+            if message is None or message['type'] != 'message':
+                continue
+            meta = self.ready(message['data'])
+            for future in self.waiting.get(message['channel'], []):
+                if meta is not None and not future.done():
+                    future.set_result(meta)
+        self.reader = None
+
+
+def result_waiter(backend):
+    """Return the running loop's waiter for a result backend."""
+
+    key = (asyncio.get_event_loop(), backend.url)
+    if key not in _waiters:
+        _waiters[key] = ResultWaiter(backend)
+    return _waiters[key]
@@ -0,0 +1,190 @@
+import os
+import threading
+import time
+
+REDIS_URL = os.environ.get('PLANBOT_REDIS_URL', 'redis://')
+SESSION_TTL = int(os.environ.get('PLANBOT_SESSION_TTL', 7 * 24 * 60 * 60))
+SESSION_STORE = os.environ.get('PLANBOT_SESSION_STORE', 'redis')
+
+# pass as rev to save without checking for concurrent writes
+UNCHECKED = object()
+
+# replace a session if its rev is still the one the caller loaded,
+# returning the new rev, or nil if another write got there first
+SAVE_SCRIPT = '''
+local rev = redis.call('HGET', KEYS[1], 'rev')
+if ARGV[1] ~= '*' and (rev or '') ~= ARGV[1] then
+    return false
+end
+local next = (tonumber(rev) or 0) + 1
+redis.call('DEL', KEYS[1])
+redis.call('HMSET', KEYS[1], 'rev', next, unpack(ARGV, 3))
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return next
+'''
+
+pools = {}
+async_pools = {}
+memory_store = None
+
+
+class SessionConflict(Exception):
+    """Raised when a session changed between a turn's load and save."""
+
+
+def redis_pool(url=REDIS_URL):
+    """Return the shared connection pool for a Redis url."""
+
+    import redis
+
+    if url not in pools:
+        pools[url] = redis.ConnectionPool.from_url(url,
+                                                   decode_responses=True)
+    return pools[url]
+
+
+def async_redis_pool(url=REDIS_URL):
+    """Return the shared redis.asyncio connection pool for a Redis url."""
+
+    import redis.asyncio
+
+    if url not in async_pools:
+        async_pools[url] = redis.asyncio.ConnectionPool.from_url(
+            url, decode_responses=True)
+    return async_pools[url]
+
+
+def save_args(state, rev, ttl):
+    """Return the SAVE_SCRIPT arguments for a session state."""
+
+    args = ['*' if rev is UNCHECKED else rev or '', ttl]
+    for field, value in state.items():
+        if value is not None and field != 'rev':
+            args.extend([field, value])
+    return args
+
+
+class RedisSessionStore():
+    """Conversation state kept in a single Redis hash per user. A turn
+       costs one round trip to load and one scripted round trip to save,
+       and idle sessions expire after ttl seconds. Every save bumps the
+       hash's rev field, so a save can check that no other turn wrote
+       the session since it was loaded."""
+
+    prefix = 'planbot:session:'
+
+    def __init__(self, url=REDIS_URL, ttl=SESSION_TTL):
+        import redis
+
+        self.redis = redis.StrictRedis(connection_pool=redis_pool(url))
+        self.save_script = self.redis.register_script(SAVE_SCRIPT)
+        self.ttl = ttl
+
+    def load(self, user):
+        """Return the stored state for a user as a dict of strings,
+           including its rev if it has been saved before."""
+
+        return self.redis.hgetall(self.prefix + str(user))
+
+    def save(self, user, state, rev=UNCHECKED):
+        """Replace the state for a user, dropping None values, and return
+           the new rev. Raises SessionConflict unless the stored rev is
+           still rev, or None for a session never saved."""
+
+        new_rev = self.save_script(keys=[self.prefix + str(user)],
+                                   args=save_args(state, rev, self.ttl))
+        if new_rev is None:
+            raise SessionConflict(user)
+        return str(new_rev)
+
+
+class AsyncRedisSessionStore():
+    """RedisSessionStore for coroutines, sharing one redis.asyncio pool
+       per url."""
+
+    prefix = RedisSessionStore.prefix
+
+    def __init__(self, url=REDIS_URL, ttl=SESSION_TTL):
+        import redis.asyncio
+
+        self.redis = redis.asyncio.StrictRedis(
+            connection_pool=async_redis_pool(url))
+        self.save_script = self.redis.register_script(SAVE_SCRIPT)
+        self.ttl = ttl
+
+    async def load(self, user):
+        return await self.redis.hgetall(self.prefix + str(user))
+
+    async def save(self, user, state, rev=UNCHECKED):
+        new_rev = await self.save_script(keys=[self.prefix + str(user)],
+                                         args=save_args(state, rev, self.ttl))
+        if new_rev is None:
+            raise SessionConflict(user)
+        return str(new_rev)
+
+
+class MemorySessionStore():
+    """In-process stand-in for RedisSessionStore, for tests and local
+       runs without Redis."""
+
+    def __init__(self, ttl=SESSION_TTL):
+        self.ttl = ttl
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def load(self, user):
+        with self.lock:
+            return self.current(user)
+
+    def current(self, user):
+        state, expires = self.sessions.get(str(user), ({}, None))
+        if expires is not None and expires < time.time():
+            del self.sessions[str(user)]
+            return {}
+        return dict(state)
+
+    def save(self, user, state, rev=UNCHECKED):
+        fields = {k: str(v) for k, v in state.items()
+                  if v is not None and k != 'rev'}
+        with self.lock:
+            stored = self.current(user).get('rev')
+            if rev is not UNCHECKED and stored != rev:
+                raise SessionConflict(user)
+            fields['rev'] = str(int(stored or 0) + 1)
+            expires = time.time() + self.ttl
+            self.sessions[str(user)] = (fields, expires)
+        return fields['rev']
+
+
+class AsyncSessionStore():
+    """Awaitable wrapper around an in-process store such as
+       MemorySessionStore, whose calls never block for long."""
+
+    def __init__(self, store):
+        self.store = store
+
+    async def load(self, user):
+        return self.store.load(user)
+
+    async def save(self, user, state, rev=UNCHECKED):
+        return self.store.save(user, state, rev=rev)
+
+
+def default_store():
+    """Return the session store selected by PLANBOT_SESSION_STORE."""
+
+    global memory_store
+    if SESSION_STORE == 'memory':
+        if memory_store is None:
+            memory_store = MemorySessionStore()
+        return memory_store
+    return RedisSessionStore()
+
+
+def default_async_store():
+    """Return the session store selected by PLANBOT_SESSION_STORE, for
+       AsyncEngine."""
+
+    if SESSION_STORE == 'memory':
+        return AsyncSessionStore(default_store())
+    return AsyncRedisSessionStore()
@@ -0,0 +1,38 @@
+"""
+Substring search over a table's keys in pure Python, kept apart from
+matching.py so that database lookups never import numpy or Levenshtein.
+"""
+
+
+def trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class SubstringIndex():
+    """Trigram inverted index over the keys of a table. search() returns
+       the same keys, in the same order, as LIKE '%phrase%' without
+       scanning every key."""
+
+    def __init__(self, keys):
+        self.keys = list(keys)
+        self.postings = {}
+        for pos, key in enumerate(self.keys):
+            for gram in trigrams(key):
+                self.postings.setdefault(gram, []).append(pos)
+
+    def search(self, phrase):
+        grams = trigrams(phrase)
+        if not grams:
+            candidates = range(len(self.keys))
+        else:
+            postings = sorted((self.postings.get(gram, []) for gram in grams),
+                              key=len)
+            matches = set(postings[0])
+            for positions in postings[1:]:
+                if not matches:
+                    break
+                matches.intersection_update(positions)
+            candidates = sorted(matches)
+
+        return [self.keys[pos] for pos in candidates
+                if phrase in self.keys[pos]]
@@ -0,0 +1,204 @@
+"""
+Shared cache of the suggestions semantic_analysis makes for a query, so a
+misspelling seen by any front end goes through the similarity search once
+per data version rather than on every request.
+
+Entries are kept in Redis at PLANBOT_REDIS_URL, keyed by table, data
+version and normalised query, for PLANBOT_SUGGEST_TTL seconds. Queries
+with no suggestions are cached too, for PLANBOT_SUGGEST_NEGATIVE_TTL
+seconds. Once more than PLANBOT_SUGGEST_CACHE entries are stored the
+oldest are evicted; set it to 0 to turn the cache off. If Redis cannot be
+reached, lookups skip the cache for RETRY seconds and go straight to
+Celery.
+"""
+
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+import redis
+
+import metrics
+from session import REDIS_URL, async_redis_pool, redis_pool
+
+SIZE = int(os.environ.get('PLANBOT_SUGGEST_CACHE', 100000))
+TTL = int(os.environ.get('PLANBOT_SUGGEST_TTL', 24 * 60 * 60))
+NEGATIVE_TTL = int(os.environ.get('PLANBOT_SUGGEST_NEGATIVE_TTL', 60 * 60))
+RETRY = 30
+
+# store an entry and record it in the index, dropping index members whose
+# entries have expired and then the oldest entries past the size cap
+PUT_SCRIPT = '''
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+redis.call('ZADD', KEYS[2], ARGV[3], KEYS[1])
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf',
+           tostring(tonumber(ARGV[3]) - tonumber(ARGV[5])))
+local excess = redis.call('ZCARD', KEYS[2]) - tonumber(ARGV[4])
+if excess > 0 then
+    local oldest = redis.call('ZRANGE', KEYS[2], 0, excess - 1)
+    redis.call('DEL', unpack(oldest))
+    redis.call('ZREMRANGEBYRANK', KEYS[2], 0, excess - 1)
+end
+return excess
+'''
+
+
+def normalise(query):
+    """Lower case query and collapse punctuation and runs of spaces, so
+       near-identical misspellings share an entry."""
+
+    return ' '.join(re.sub(r'[^\w\s]', ' ', query.lower()).split())
+
+
+class SuggestionCache():
+    """Suggestion lists in Redis, one string key per entry plus a sorted
+       set of entry keys by age that bounds the cache at maxsize."""
+
+    prefix = 'planbot:suggest:'
+
+    def __init__(self, url=REDIS_URL, maxsize=SIZE, ttl=TTL,
+                 negative_ttl=NEGATIVE_TTL):
+        self.redis = redis.StrictRedis(connection_pool=redis_pool(url))
+        self.put_script = self.redis.register_script(PUT_SCRIPT)
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.index = self.prefix + 'index'
+        self.retry_at = 0
+        self.lock = threading.Lock()
+
+    def key(self, table, version, query):
+        return '{}{}:{}:{}'.format(self.prefix, table, version,
+                                   normalise(query))
+
+    def available(self):
+        return time.time() >= self.retry_at
+
+    def failed(self, err):
+        logging.info('Suggestion cache unavailable: {}'.format(err))
+        with self.lock:
+            self.retry_at = time.time() + RETRY
+
+    def get_many(self, table, version, queries):
+        """Return the cached suggestions for each query, or None where
+           there is no entry."""
+
+        if not queries or not self.available():
+            return [None] * len(queries)
+        try:
+            values = self.redis.mget([self.key(table, version, q)
+                                      for q in queries])
+        except redis.RedisError as err:
+            self.failed(err)
+            return [None] * len(queries)
+        return self.decode(values)
+
+    def decode(self, values):
+        found = [None if value is None else json.loads(value)
+                 for value in values]
+        for value in found:
+            metrics.cache_requests.inc(
+                cache='suggestions', result='miss' if value is None else
+                'hit' if value else 'negative_hit')
+        return found
+
+    def get(self, table, version, query):
+        return self.get_many(table, version, [query])[0]
+
+    def put_many(self, table, version, items):
+        """Store a list of suggestions for each (query, suggestions)
+           pair. Empty lists are kept for the shorter negative_ttl."""
+
+        if not items or not self.available():
+            return None
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            for keys, args in self.entries(table, version, items):
+                self.put_script(keys=keys, args=args, client=pipe)
+            pipe.execute()
+        except redis.RedisError as err:
+            self.failed(err)
+        return None
+
+    def entries(self, table, version, items):
+        """Yield the PUT_SCRIPT keys and args for each item."""
+
+        now = time.time()
+        for query, suggestions in items:
+            ttl = self.ttl if suggestions else self.negative_ttl
+            yield ([self.key(table, version, query), self.index],
+                   [json.dumps(suggestions), ttl, now, self.maxsize,
+                    max(self.ttl, self.negative_ttl)])
+
+    def put(self, table, version, query, suggestions):
+        return self.put_many(table, version, [(query, suggestions)])
+
+
+class AsyncSuggestionCache(SuggestionCache):
+    """SuggestionCache for coroutines, over the shared redis.asyncio
+       pool."""
+
+    def __init__(self, url=REDIS_URL, **kwargs):
+        import redis.asyncio
+
+        super().__init__(url, **kwargs)
+        self.redis = redis.asyncio.StrictRedis(
+            connection_pool=async_redis_pool(url))
+        self.put_script = self.redis.register_script(PUT_SCRIPT)
+
+    async def get_many(self, table, version, queries):
+        if not queries or not self.available():
+            return [None] * len(queries)
+        try:
+            values = await self.redis.mget([self.key(table, version, q)
+                                            for q in queries])
+        except redis.RedisError as err:
+            self.failed(err)
+            return [None] * len(queries)
+        return self.decode(values)
+
+    async def get(self, table, version, query):
+        return (await self.get_many(table, version, [query]))[0]
+
+    async def put_many(self, table, version, items):
+        if not items or not self.available():
+            return None
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            for keys, args in self.entries(table, version, items):
+                await self.put_script(keys=keys, args=args, client=pipe)
+            await pipe.execute()
+        except redis.RedisError as err:
+            self.failed(err)
+        return None
+
+    async def put(self, table, version, query, suggestions):
+        return await self.put_many(table, version, [(query, suggestions)])
+
+
+_cache = _async_cache = None
+
+
+def suggestion_cache():
+    """Return this process's suggestion cache, or None if it is off."""
+
+    global _cache
+    if SIZE <= 0:
+        return None
+    if _cache is None:
+        _cache = SuggestionCache()
+    return _cache
+
+
+def async_suggestion_cache():
+    """Return this process's AsyncSuggestionCache, or None if it is off."""
+
+    global _async_cache
+    if SIZE <= 0:
+        return None
+    if _async_cache is None:
+        _async_cache = AsyncSuggestionCache()
+    return _async_cache
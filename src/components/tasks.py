@@ -0,0 +1,167 @@
+#!/usr/bin/python3
+"""
+Planbot's Celery app and the similarity tasks it runs. Only worker
+processes need the word vectors and indexes loaded here; web front ends
+import this module on the first lookup that falls through to a task.
+Run a worker with:
+
+    $ python3 tasks.py worker -l info
+"""
+
+import logging
+import os
+
+from billiard.process import current_process
+from celery import Celery
+from celery.signals import (before_task_publish, task_postrun, task_prerun,
+                            worker_init, worker_process_init)
+
+import metrics
+from connectdb import ConnectDB, close_pool
+from matching import EmbeddingIndex, FuzzyIndex
+from vectors import load_vectors
+
+# path to a vector table written by vectors.py, full or pruned, else the
+# full spaCy model
+VECTORS = os.environ.get('PLANBOT_VECTORS')
+# recycle a worker child once its resident memory passes this many KiB;
+# off by default without a vector table, as the full spaCy model alone is
+# larger than the default
+MAX_MEMORY = int(os.environ.get('PLANBOT_WORKER_MAX_MEMORY',
+                                400000 if VECTORS else 0))
+# worker processes serve /metrics on this port plus their pool index
+METRICS_PORT = int(os.environ.get('PLANBOT_METRICS_PORT', 0))
+
+# setup celery
+app = Celery('planbot',
+             broker='redis://',
+             backend='redis://')
+
+app.conf.update(result_expires=60)
+if MAX_MEMORY:
+    app.conf.worker_max_memory_per_child = MAX_MEMORY
+
+# tables searched by semantic_analysis, indexed once per worker
+index_tables = ['definitions', 'use_classes', 'projects', 'documents',
+                'local_plans']
+model = None
+keys = {}
+indexes = {}
+fuzzy_indexes = {}
+
+
+def embed(text):
+    return model.embed(text)
+
+
+def table_keys(table):
+    if table not in keys:
+        with ConnectDB(table) as db:
+            keys[table] = db.query_keys()
+    return keys[table]
+
+
+def embedding_index(table):
+    if table not in indexes:
+        indexes[table] = EmbeddingIndex(table_keys(table), embed)
+    return indexes[table]
+
+
+def fuzzy_index(table):
+    if table not in fuzzy_indexes:
+        fuzzy_indexes[table] = FuzzyIndex(table_keys(table))
+    return fuzzy_indexes[table]
+
+
+@worker_init.connect
+def warm(**kwargs):
+    """Load vectors and build every index in the parent worker process,
+       before the pool forks, so children start warm and share the pages.
+       Celery only reports the worker ready once this returns."""
+
+    global model
+    model = load_vectors(VECTORS)
+    for table in index_tables:
+        embedding_index(table)
+        fuzzy_index(table)
+    # children open their own database connections
+    close_pool()
+    logging.info('Worker warm: {} tables indexed'.format(len(indexes)))
+
+
+@worker_process_init.connect
+def serve_metrics(**kwargs):
+    if METRICS_PORT:
+        port = METRICS_PORT + getattr(current_process(), 'index', 0)
+        metrics.serve(port)
+        logging.info('Serving worker metrics on port {}'.format(port))
+
+
+@before_task_publish.connect
+def propagate_trace(headers=None, **kwargs):
+    """Carry the caller's trace into the task message."""
+
+    ctx = metrics.context()
+    if ctx is not None and headers is not None:
+        headers[metrics.HEADER] = metrics.encode(ctx)
+
+
+@task_prerun.connect
+def start_task_span(task=None, **kwargs):
+    parent = metrics.decode(task.request.get(metrics.HEADER))
+    task.request.planbot_span = metrics.start_span(
+        'task ' + task.name.split('.')[-1], parent=parent)
+
+
+@task_postrun.connect
+def finish_task_span(task=None, **kwargs):
+    span = getattr(task.request, 'planbot_span', None)
+    if span is not None:
+        metrics.finish_span(span)
+
+
+# tasks keep the names they had when they were defined in planbot.py
+@app.task(name='planbot.semantic_analysis')
+def semantic_analysis(query, table):
+    index = embedding_index(table)
+    with metrics.timed('semantic', action=table):
+        entities = index.top(query, n=3, threshold=0.5)
+
+    if not entities:
+        metrics.fuzzy_fallbacks.inc(table=table)
+        return spell_check(query, table)
+    return entities
+
+
+@app.task(name='planbot.batch_semantic_analysis')
+def batch_semantic_analysis(items):
+    """Run semantic_analysis over a list of (query, table) pairs, scoring
+       all the queries for a table in one matrix product."""
+
+    tables = {}
+    for pos, (query, table) in enumerate(items):
+        tables.setdefault(table, []).append(pos)
+
+    results = [None] * len(items)
+    for table, positions in tables.items():
+        queries = [items[pos][0] for pos in positions]
+        with metrics.timed('semantic', action=table):
+            matches = embedding_index(table).top_many(queries, n=3,
+                                                      threshold=0.5)
+        for pos, query, entities in zip(positions, queries, matches):
+            if not entities:
+                metrics.fuzzy_fallbacks.inc(table=table)
+            results[pos] = entities or spell_check(query, table)
+
+    return results
+
+
+def spell_check(query, table):
+    with metrics.timed('spell_check', action=table):
+        entity = fuzzy_index(table).best(query, threshold=0.75)
+
+    return [entity] if entity else []
+
+
+if __name__ == '__main__':
+    app.start()
@@ -0,0 +1,24 @@
+import re
+
+uncap_words = ['a', 'an', 'and', 'as', 'at', 'but', 'by', 'en', 'for', 'if',
+               'in', 'of', 'on', 'or', 'the', 'to', 'via']
+
+
+def titlecase(phrase):
+    if phrase == 'uk':
+        return phrase.upper()
+
+    phrase = phrase.capitalize()
+
+    # don't capitalise certain words
+    for word in phrase.split()[1:]:
+        if word not in uncap_words:
+            phrase = phrase.replace(word, word.capitalize())
+
+    # uppercase acronyms and lowercase longer text in parentheses
+    for acr in re.compile(r'\(\w{1,5}\)').findall(phrase):
+        phrase = phrase.replace(acr, acr.upper())
+    for paren in re.compile(r'\([\w\s]{6,}\)').findall(phrase):
+        phrase = phrase.replace(paren, paren.lower())
+
+    return phrase
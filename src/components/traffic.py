@@ -0,0 +1,115 @@
+"""
+Records incoming Messenger webhooks for replay by benchmarks/loadgen.py.
+With PLANBOT_RECORD set to a file path, every webhook body is anonymised and
+appended to it as one JSON line. Bodies are anonymised before they are
+written, so no user ids, names, phone numbers or exact locations reach the
+file:
+
+* sender, recipient and page ids become keyed HMAC pseudonyms, stable for
+  one PLANBOT_RECORD_SALT so a user's turns still group into a conversation
+* email addresses and phone numbers in message text are masked
+* full postcodes in message text are cut to their outward code, e.g. SW1A
+* coordinates are rounded to about a kilometre and map urls dropped
+* Messenger's NLP entities keep only their names and confidences, as
+  their values repeat what was said
+* message ids and sequence numbers are dropped
+"""
+
+import copy
+import hashlib
+import hmac
+import json
+import os
+import re
+import threading
+import time
+
+RECORD_PATH = os.environ.get('PLANBOT_RECORD')
+# without a salt, pseudonyms only hold for the life of the process
+SALT = os.environ.get('PLANBOT_RECORD_SALT') or os.urandom(16).hex()
+COORDINATE_PLACES = 2
+
+EMAIL = re.compile(r'[\w.+-]+@[\w-]+\.[\w.-]+')
+PHONE = re.compile(r'\+?\d[\d ()-]{6,}\d')
+POSTCODE = re.compile(r'\b([A-Z]{1,2}\d[A-Z\d]?) ?\d[A-Z]{2}\b', re.I)
+DROPPED = ['mid', 'seq', 'url']
+
+
+def pseudonym(value, salt=SALT):
+    digest = hmac.new(salt.encode('utf-8'), str(value).encode('utf-8'),
+                      hashlib.sha256)
+    return 'anon-' + digest.hexdigest()[:16]
+
+
+def scrub(text):
+    text = EMAIL.sub('<email>', text)
+    text = POSTCODE.sub(r'\1', text)
+    return PHONE.sub('<phone>', text)
+
+
+def anonymise_message(message, salt):
+    for key in DROPPED:
+        message.pop(key, None)
+    if isinstance(message.get('text'), str):
+        message['text'] = scrub(message['text'])
+    nlp = message.get('nlp')
+    if isinstance(nlp, dict):
+        entities = nlp.get('entities') or {}
+        message['nlp'] = {'entities': {
+            name: [{'confidence': found.get('confidence', 0)}
+                   for found in values if isinstance(found, dict)]
+            for name, values in entities.items()
+            if isinstance(values, list)}}
+
+    for attachment in message.get('attachments') or []:
+        attachment.pop('url', None)
+        if attachment.get('title') not in (None, 'Pinned Location'):
+            # shared locations are titled with the sender's name
+            attachment['title'] = 'Location'
+        payload = attachment.get('payload') or {}
+        coordinates = payload.get('coordinates') or \
+            attachment.get('coordinates') or {}
+        for axis in ['lat', 'long']:
+            if axis in coordinates:
+                coordinates[axis] = round(float(coordinates[axis]),
+                                          COORDINATE_PLACES)
+        for key in list(payload):
+            if key != 'coordinates':
+                del payload[key]
+    return message
+
+
+def anonymise(body, salt=SALT):
+    """Return an anonymised copy of a Messenger webhook body."""
+
+    body = copy.deepcopy(body)
+    for entry in body.get('entry') or []:
+        if 'id' in entry:
+            entry['id'] = pseudonym(entry['id'], salt)
+        for event in entry.get('messaging') or []:
+            for party in ['sender', 'recipient']:
+                if isinstance(event.get(party), dict) and \
+                        'id' in event[party]:
+                    event[party]['id'] = pseudonym(event[party]['id'], salt)
+            if isinstance(event.get('message'), dict):
+                anonymise_message(event['message'], salt)
+    return body
+
+
+class Recorder():
+    """Append anonymised webhook bodies to a JSON lines file."""
+
+    def __init__(self, path, salt=SALT):
+        self.path = path
+        self.salt = salt
+        self.lock = threading.Lock()
+
+    def record(self, body):
+        line = json.dumps({'time': round(time.time(), 3),
+                           'body': anonymise(body, self.salt)})
+        with self.lock, open(self.path, 'a', encoding='utf-8') as f:
+            f.write(line + '\n')
+        return None
+
+
+recorder = Recorder(RECORD_PATH) if RECORD_PATH else None
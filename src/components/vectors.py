@@ -0,0 +1,382 @@
+#!/usr/bin/python3
+"""
+Word vectors for semantic matching, stored as plain numpy files that worker
+processes map read-only so a node keeps one page-cache copy however many
+workers it runs.
+
+A table at <path> is two files: <path>.words.npy, the vocabulary as sorted
+fixed-width utf-8 strings, and <path>.vectors.npy with one row per word in
+the same order. Exported tables add <path>.ranks.npy, each word's frequency
+rank, and int8 tables add <path>.scales.npy, the scale of each row. Export
+one from a spaCy model, then prune it to the words planbot's keys use plus
+the most frequent general vocabulary, and compare how the pruned table
+matches against the full one:
+
+    $ python3 vectors.py export en_vectors_glove_md /var/lib/planbot/glove
+    $ python3 vectors.py prune /var/lib/planbot/glove \\
+          /var/lib/planbot/glove-small data/planbot.SQL --dtype int8
+    $ python3 vectors.py compare /var/lib/planbot/glove \\
+          /var/lib/planbot/glove-small data/planbot.SQL
+"""
+
+import argparse
+import json
+import os
+import re
+import sys
+
+import numpy
+
+WORD_WIDTH = 32
+TOKEN = re.compile(r'\w+|[^\w\s]')
+DTYPES = ['float32', 'float16', 'int8']
+# words of general vocabulary kept by prune, most frequent first
+GENERAL = 50000
+# tables semantic_analysis searches, as in tasks.index_tables
+TABLES = ['definitions', 'use_classes', 'projects', 'documents',
+          'local_plans']
+# ways users phrase a lookup, so compare's default queries carry general
+# vocabulary that planbot's keys do not use
+PHRASINGS = ['{}', 'what is {}', 'what does {} mean', 'do i need {}',
+             'tell me about {}', 'rules for {} please',
+             'can you explain {} to me']
+
+
+class VectorTable():
+    """Memory-mapped word vectors. A text is embedded as the sum of its
+       token vectors, which has the same direction as spaCy's averaged
+       Doc.vector and so gives the same cosine similarities."""
+
+    def __init__(self, path):
+        self.path = path
+        self.words = numpy.load(path + '.words.npy', mmap_mode='r')
+        self.vectors = numpy.load(path + '.vectors.npy', mmap_mode='r')
+        self.scales = optional(path + '.scales.npy')
+        self.width = self.vectors.shape[1]
+
+    def row(self, word):
+        """Return the row index for a word, or None if out of vocabulary."""
+
+        key = word.encode('utf-8')
+        if len(key) > WORD_WIDTH:
+            return None
+        pos = int(numpy.searchsorted(self.words, key))
+        if pos < len(self.words) and self.words[pos] == key:
+            return pos
+        return None
+
+    def vector(self, word):
+        row = self.row(word)
+        if row is None and word != word.lower():
+            row = self.row(word.lower())
+        if row is None:
+            return None
+        # int8 rows are stored divided by their scale
+        if self.scales is not None:
+            return self.vectors[row] * self.scales[row]
+        # float16 rows are widened as embed adds them up
+        return self.vectors[row]
+
+    def known(self, word):
+        return self.vector(word) is not None
+
+    def embed(self, text):
+        total = numpy.zeros(self.width, dtype=numpy.float32)
+        for token in TOKEN.findall(text):
+            vector = self.vector(token)
+            if vector is not None:
+                total += vector
+        return total
+
+
+class SpacyVectors():
+    """Vectors taken from a full spaCy model, loaded into this process."""
+
+    def __init__(self, name='en_vectors_glove_md'):
+        import spacy
+        self.nlp = spacy.load(name)
+
+    def known(self, word):
+        return self.nlp.vocab[word].has_vector
+
+    def embed(self, text):
+        return self.nlp(text).vector
+
+
+def optional(path):
+    return numpy.load(path, mmap_mode='r') if os.path.exists(path) else None
+
+
+def load_vectors(path=None):
+    """Open a vector table at path, or load the full spaCy model."""
+
+    return VectorTable(path) if path else SpacyVectors()
+
+
+def open_vectors(source):
+    """Open the vector table at source, or load the spaCy model it names."""
+
+    if os.path.exists(source + '.words.npy'):
+        return VectorTable(source)
+    return SpacyVectors(source)
+
+
+def quantize(vectors, dtype='float32'):
+    """Return vectors stored as dtype, with the scale of each row for int8
+       or None. An int8 row is scaled so its largest component is 127."""
+
+    vectors = numpy.asarray(vectors, dtype=numpy.float32)
+    if dtype != 'int8':
+        return vectors.astype(dtype), None
+
+    scales = numpy.abs(vectors).max(axis=1) / 127
+    scales[scales == 0] = 1
+    rows = numpy.round(vectors / scales[:, None]).astype(numpy.int8)
+    return rows, scales.astype(numpy.float32)
+
+
+def write_table(path, words, vectors, ranks=None, scales=None):
+    """Write words and their vectors as a table that VectorTable opens."""
+
+    order = sorted(range(len(words)), key=lambda i: words[i].encode('utf-8'))
+    encoded = numpy.array([words[i].encode('utf-8') for i in order],
+                          dtype='S{}'.format(WORD_WIDTH))
+    numpy.save(path + '.words.npy', encoded)
+    numpy.save(path + '.vectors.npy', numpy.asarray(vectors)[order])
+    if ranks is not None:
+        numpy.save(path + '.ranks.npy',
+                   numpy.asarray(ranks, dtype=numpy.int32)[order])
+    if scales is not None:
+        numpy.save(path + '.scales.npy', numpy.asarray(scales)[order])
+    return None
+
+
+def export(name, path):
+    """Write every in-vocabulary word vector of a spaCy model to path,
+       ranking words by the model's probability estimate."""
+
+    nlp = SpacyVectors(name).nlp
+    words, vectors, probs, seen = [], [], [], set()
+    for lex in nlp.vocab:
+        word = lex.orth_
+        if not lex.has_vector or word in seen or \
+                len(word.encode('utf-8')) > WORD_WIDTH:
+            continue
+        seen.add(word)
+        words.append(word)
+        vectors.append(numpy.asarray(lex.vector, dtype=numpy.float32))
+        probs.append(lex.prob)
+
+    # a stable sort keeps the model's own order among equal estimates
+    order = numpy.argsort(-numpy.array(probs), kind='mergesort')
+    ranks = numpy.empty(len(words), dtype=numpy.int32)
+    ranks[order] = numpy.arange(len(words))
+    write_table(path, words, numpy.vstack(vectors), ranks=ranks)
+    return len(words)
+
+
+def corpus(dump, tables=TABLES):
+    """Return {table: keys} for the tables semantic_analysis searches,
+       read from a pg_dump of the planbot database."""
+
+    from pack import read_dump
+
+    data = read_dump(dump)
+    return {table: [row[0] for row in data[table][1]] for table in tables}
+
+
+def vocabulary(texts):
+    """Return every token of texts, and its lower case form."""
+
+    words = set()
+    for text in texts:
+        for token in TOKEN.findall(text):
+            words.update([token, token.lower()])
+    return words
+
+
+def prune(source, path, dump, general=GENERAL, dtype='float16'):
+    """Write to path the rows of the table at source for every word used
+       in planbot's keys, plus its general most frequent words, stored as
+       dtype. Return the number of words written."""
+
+    table = VectorTable(source)
+    ranks = optional(source + '.ranks.npy')
+    if general and ranks is None:
+        raise ValueError('{} has no ranks; export it again or pass '
+                         '--general 0'.format(source))
+
+    rows = {table.row(word) for word in vocabulary(
+        key for keys in corpus(dump).values() for key in keys)}
+    rows.discard(None)
+    if general:
+        rows.update(numpy.flatnonzero(numpy.asarray(ranks) < general)
+                    .tolist())
+
+    rows = sorted(rows)
+    words = [table.words[row].decode('utf-8') for row in rows]
+    vectors = numpy.asarray(table.vectors[rows], dtype=numpy.float32)
+    if table.scales is not None:
+        vectors *= numpy.asarray(table.scales[rows])[:, None]
+    vectors, scales = quantize(vectors, dtype)
+    write_table(path, words, vectors,
+                ranks=ranks[rows] if ranks is not None else None,
+                scales=scales)
+    return len(words)
+
+
+def variants(key):
+    """Return a key phrased as each of PHRASINGS, and with each of its
+       words left out in turn, as stand-ins for queries that only partly
+       match a key."""
+
+    words = key.split()
+    dropped = [' '.join(words[:i] + words[i + 1:])
+               for i in range(len(words))] if len(words) > 1 else []
+    return [phrasing.format(key) for phrasing in PHRASINGS] + dropped
+
+
+def recorded_queries(path, tables=TABLES):
+    """Return a (table, text) pair per table for every typed message in a
+       file recorded with PLANBOT_RECORD. Which table a message was meant
+       for depends on the conversation, so each is matched against all."""
+
+    from messenger import parse_response
+
+    texts = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            for _, event in parse_response(json.loads(line)['body']):
+                message = event.get('message') or {}
+                if message.get('text') and not message.get('quick_reply'):
+                    texts.append(message['text'])
+    return [(table, text) for text in texts for table in tables]
+
+
+def oov_rate(model, texts):
+    """Return the share of tokens in texts that model has no vector for."""
+
+    tokens = [token for text in texts for token in TOKEN.findall(text)]
+    missing = sum(not model.known(token) and not model.known(token.lower())
+                  for token in tokens)
+    return missing / len(tokens) if tokens else 0
+
+
+def table_size(source):
+    """Return the bytes on disk of the table at source, or None."""
+
+    paths = [source + suffix for suffix in
+             ['.words.npy', '.vectors.npy', '.ranks.npy', '.scales.npy']]
+    if not os.path.exists(paths[0]):
+        return None
+    return sum(os.path.getsize(p) for p in paths if os.path.exists(p))
+
+
+def compare(full, pruned, dump, queries=None, n=3, threshold=0.5):
+    """Match queries against each table's keys with both vector sources,
+       as semantic_analysis does, and return per-table agreement of the
+       pruned source with the full one, and the share of query tokens
+       each has no vector for. Queries are (table, query) pairs, by
+       default every key's variants."""
+
+    from matching import EmbeddingIndex
+
+    keys = corpus(dump)
+    if queries is None:
+        queries = [(table, query) for table in TABLES
+                   for key in keys[table] for query in variants(key)]
+
+    grouped = {}
+    for table, query in queries:
+        grouped.setdefault(table, []).append(query)
+
+    models = [open_vectors(full), open_vectors(pruned)]
+    report = {}
+    for table, texts in grouped.items():
+        found = [EmbeddingIndex(keys[table], model.embed)
+                 .top_many(texts, n=n, threshold=threshold)
+                 for model in models]
+        top = overlap = 0
+        for expected, got in zip(*found):
+            top += expected[:1] == got[:1]
+            overlap += len(set(expected) & set(got)) / \
+                max(len(expected), len(got), 1) if expected or got else 1
+        report[table] = {'queries': len(texts),
+                         'oov_full': oov_rate(models[0], texts),
+                         'oov_pruned': oov_rate(models[1], texts),
+                         'top_1': top / len(texts),
+                         'top_{}'.format(n): overlap / len(texts)}
+    return report
+
+
+def read_queries(path):
+    """Read (table, query) pairs from tab separated lines."""
+
+    with open(path, encoding='utf-8') as f:
+        return [tuple(line.rstrip('\n').split('\t', 1)) for line in f
+                if '\t' in line]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    commands = parser.add_subparsers(dest='command')
+
+    export_parser = commands.add_parser(
+        'export', help='write a spaCy model\'s vectors as a table')
+    export_parser.add_argument('model')
+    export_parser.add_argument('path')
+
+    prune_parser = commands.add_parser(
+        'prune', help='write the part of a table planbot uses')
+    prune_parser.add_argument('source')
+    prune_parser.add_argument('path')
+    prune_parser.add_argument('dump', help='pg_dump of the planbot database')
+    prune_parser.add_argument('--general', type=int, default=GENERAL,
+                              help='most frequent words to keep as well')
+    prune_parser.add_argument('--dtype', choices=DTYPES, default='float16')
+
+    compare_parser = commands.add_parser(
+        'compare', help='report how a pruned table matches against a '
+                        'full one')
+    compare_parser.add_argument('full', help='table or spaCy model')
+    compare_parser.add_argument('pruned')
+    compare_parser.add_argument('dump', help='pg_dump of the planbot '
+                                             'database')
+    compare_parser.add_argument('--queries', help='tab separated table and '
+                                                  'query per line')
+    compare_parser.add_argument('--recording', help='webhooks recorded with '
+                                                    'PLANBOT_RECORD')
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        print('Exported {} words'.format(export(args.model, args.path)))
+    elif args.command == 'prune':
+        count = prune(args.source, args.path, args.dump,
+                      general=args.general, dtype=args.dtype)
+        print('Wrote {} words, {:.1f} MiB'.format(
+            count, table_size(args.path) / 2 ** 20))
+    elif args.command == 'compare':
+        queries = read_queries(args.queries) if args.queries else None
+        if args.recording:
+            queries = (queries or []) + recorded_queries(args.recording)
+        report = compare(args.full, args.pruned, args.dump, queries)
+        print('{:14} {:>8} {:>9} {:>10} {:>8} {:>8}'.format(
+            'table', 'queries', 'oov full', 'oov pruned', 'top 1', 'top 3'))
+        for table, row in sorted(report.items()):
+            print('{:14} {:>8} {:>9.1%} {:>10.1%} {:>8.1%} {:>8.1%}'.format(
+                table, row['queries'], row['oov_full'], row['oov_pruned'],
+                row['top_1'], row['top_3']))
+        for source in [args.full, args.pruned]:
+            size = table_size(source)
+            if size is not None:
+                print('{}: {:.1f} MiB'.format(source, size / 2 ** 20))
+    else:
+        parser.print_help()
+        return 2
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,64 @@
+import logging
+import queue
+import threading
+from concurrent.futures import Future
+
+import metrics
+
+
+class KeyedWorkerPool():
+    """Fixed set of worker threads fed by bounded queues. Jobs submitted
+       under the same key run one at a time in submission order, while
+       jobs under different keys can run in parallel. A submit to a full
+       queue waits up to timeout seconds for room."""
+
+    def __init__(self, workers=8, maxsize=1000, name='planbot-worker',
+                 timeout=0):
+        self.queues = [queue.Queue(maxsize) for _ in range(workers)]
+        self.timeout = timeout
+        for i, jobs in enumerate(self.queues):
+            thread = threading.Thread(target=self.run, args=(jobs,),
+                                      name='{}-{}'.format(name, i),
+                                      daemon=True)
+            thread.start()
+
+    def submit(self, key, func, *args, **kwargs):
+        """Queue func(*args, **kwargs) behind earlier jobs for key, to run
+           in the current trace, and return a Future for its result.
+           Raises queue.Full if that worker's queue stays at capacity."""
+
+        return self.submit_within(self.timeout, key, func, *args, **kwargs)
+
+    def submit_within(self, timeout, key, func, *args, **kwargs):
+        """As submit, waiting up to timeout seconds for room rather than
+           the pool's timeout."""
+
+        jobs = self.queues[hash(key) % len(self.queues)]
+        future = Future()
+        jobs.put((future, metrics.bind(func), args, kwargs),
+                 block=timeout > 0, timeout=timeout or None)
+        return future
+
+    def depth(self):
+        """Return the number of jobs waiting to start."""
+
+        return sum(jobs.qsize() for jobs in self.queues)
+
+    def join(self):
+        """Block until every queued job has finished."""
+
+        for jobs in self.queues:
+            jobs.join()
+        return None
+
+    @staticmethod
+    def run(jobs):
+        while True:
+            future, func, args, kwargs = jobs.get()
+            try:
+                future.set_result(func(*args, **kwargs))
+            except Exception as err:
+                logging.exception('Job failed: {}'.format(func.__name__))
+                future.set_exception(err)
+            finally:
+                jobs.task_done()
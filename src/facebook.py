@@ -1,21 +1,43 @@
 #!/usr/bin/python3
 """
 Planbot's Facebook application. Handles requests and responses through the
-Facebook Graph API. Converts location data to postcode with Postcodes.io API.
+Facebook Graph API. Webhooks are parsed and replies built in messenger.py,
+which converts location data to a local authority with a local postcode
+index, falling back to the Postcodes.io API.
+Every messaging event in a webhook batch is run as a turn on a worker pool:
+turns for one user run in order, turns for different users in parallel.
+The webhook returns once its events are queued, not when they are answered.
+Outgoing messages are queued on a background dispatcher so the webhook can
+return without waiting on the Graph API. With PLANBOT_RECORD set, incoming
+webhooks are anonymised and recorded for replay (see traffic.py).
 """
 
 import os
 import logging
+import queue
+import time
 
-import requests
 from bottle import Bottle, request, debug
 
 from engine import Engine
+from dispatcher import Dispatcher
+from messenger import build_message, event_text, parse_response
+from traffic import recorder
+from workers import KeyedWorkerPool
+import metrics
 
 # set environmental variables
 FB_PAGE_TOKEN = os.environ.get('FB_PAGE_TOKEN')
 FB_VERIFY_TOKEN = os.environ.get('FB_VERIFY_TOKEN')
 
+# turn workers, events each may queue, seconds a turn's lookups have from
+# the webhook's arrival, and seconds a webhook waits in all for room in the
+# queues, so Facebook never sees a slow webhook and retries it
+TURN_WORKERS = int(os.environ.get('FB_TURN_WORKERS', 8))
+TURN_QUEUE = int(os.environ.get('FB_TURN_QUEUE', 100))
+TURN_TIMEOUT = float(os.environ.get('FB_TURN_TIMEOUT', 15))
+WEBHOOK_TIMEOUT = float(os.environ.get('FB_WEBHOOK_TIMEOUT', 2))
+
 # setup Bottle Server
 debug(True)
 app = application = Bottle()
@@ -23,11 +45,8 @@ app = application = Bottle()
 # setup logging
 logging.basicConfig(level=logging.INFO)
 
-nlp_entities = {
-    'greetings': 'GET_STARTED_PAYLOAD',
-    'thanks': 'Thanks, bye!',
-    'bye': 'Thanks, bye!'
-}
+dispatcher = Dispatcher(token=FB_PAGE_TOKEN)
+turns = KeyedWorkerPool(TURN_WORKERS, maxsize=TURN_QUEUE, name='planbot-turns')
 
 
 @app.get('/facebook')
@@ -42,164 +61,41 @@ def messenger_webhook():
 
 @app.post('/facebook')
 def messenger_post():
-    responses, fb_id = parse_response(request.json)
-    logging.info('responses: {}'.format(responses))
-    if responses:
-        text = responses[0]
-    else:
-        text = 'NO_PAYLOAD'
+    if recorder:
+        recorder.record(request.json)
 
+    received = time.time()
+    deadline = received + TURN_TIMEOUT
+    for fb_id, event in parse_response(request.json):
+        try:
+            turns.submit_within(
+                max(received + WEBHOOK_TIMEOUT - time.time(), 0), fb_id,
+                run_turn, fb_id, event, deadline)
+        except queue.Full:
+            logging.warning('Turn queue full, dropped event from {}'.format(
+                fb_id))
+    return None
+
+
+def run_turn(fb_id, event, deadline=None):
+    text = event_text(event)
     bot = Engine()
-    for response in bot.response(user=fb_id, message=text):
+    for response in bot.response(user=fb_id, message=text,
+                                 deadline=deadline):
         logging.info(response)
         sender_action(fb_id)
         send(response)
-
     return None
 
 
-def parse_response(data):
-    responses = []
-    fb_id = None
-    if data['object'] == 'page':
-        for entry in data['entry']:
-            messages = entry['messaging']
-            if messages[0]:
-                message = messages[0]
-                fb_id = message['sender']['id']
-                if message.get('message'):
-                    text = parse_text(message['message'])
-                    logging.info('parsed text: {}'.format(text))
-                elif message.get('postback'):
-                    text = message['postback']['payload']
-
-                logging.info('Message received: {}'.format(text))
-                responses.append(text)
-    else:
-        return 'Received Different Event'
-    return responses, fb_id
-
-
-def parse_text(message):
-    if message.get('attachments'):
-        attachment = message['attachments'][0]
-        if attachment['title'] == 'Pinned Location':
-            long = attachment['coordinates']['long']
-            lat = attachment['coordinates']['lat']
-            text = geo_convert(longitude=long, latitude=lat)
-        else:
-            text = 'NO_PAYLOAD'
-    else:
-        if message.get('nlp'):
-            text = find_entity(message)
-        else:
-            text = message['message']['text']
-
-    return text
-
-
-def find_entity(message):
-    logging.info(message)
-    entities = message['nlp']['entities']
-    entity = {ent: entities[ent][0]['confidence'] for ent in entities
-              if ent in nlp_entities}
-    logging.info('found entities: {}'.format(entity))
-    if entity:
-        match = sorted(entity, key=entity.get, reverse=True)[0]
-        text = nlp_entities[match]
-    else:
-        try:
-            text = message['text']
-        except KeyError:
-            text = 'NO_PAYLOAD'
-
-    logging.info('find_entity: {}'.format(text))
-    return text
-
-
 def sender_action(sender_id):
-    data = {'recipient': {'id': sender_id}, 'sender_action': 'typing_on'}
-    qs = 'access_token=' + FB_PAGE_TOKEN
-    resp = requests.post('https://graph.facebook.com/v2.9/me/messages?' + qs,
-                         json=data)
-
-    return resp.content
+    dispatcher.typing(sender_id)
+    return None
 
 
 def send(response):
-    fb_id = response['id']
-    text = response['text']
-    quickreplies = cards = None
-
-    # check for quickreplies
-    if response.get('quickreplies'):
-        quickreplies = format_qr(response['quickreplies'])
-
-    # check for urls
-    if text.startswith('http'):
-        urls = text.split()
-        title = response['title']
-        titles = [title] if not isinstance(title, list) else title
-        cards = template(titles, urls)
-
-    fb_message(fb_id, text, quickreplies, cards)
+    dispatcher.message(response['id'], build_message(response))
     return None
 
 
-def fb_message(sender_id, text, quickreplies, cards):
-    data = {'recipient': {'id': sender_id}}
-
-    data['message'] = cards if cards \
-        else{'text': text, 'quick_replies': quickreplies} if quickreplies \
-        else {'text': text}
-
-    # logging.info('response = {}'.format(data))
-
-    qs = 'access_token=' + FB_PAGE_TOKEN
-    resp = requests.post('https://graph.facebook.com/v2.9/me/messages?' + qs,
-                         json=data)
-
-    return resp.content
-
-
-def format_qr(quickreplies):
-    return [{
-        'title': qr,
-        'content_type': 'text',
-        'payload': 'empty'}
-            for qr in quickreplies]
-
-
-def template(titles, urls):
-    button_titles = ['Download' if url.endswith('pdf') else 'View'
-                     for url in urls]
-
-    elements = [{
-        'title': titles[i],
-        'default_action': {
-            'type': 'web_url',
-            'url': urls[i]},
-        'buttons': [{
-            'type': 'web_url',
-            'url': urls[i],
-            'title': button_titles[i]}]}
-             for i in range(len(titles))]
-
-    return {
-        "attachment": {
-            "type": "template",
-            "payload": {
-                "template_type": "generic",
-                "elements": elements}}}
-
-
-def geo_convert(longitude=None, latitude=None):
-    url = 'https://api.postcodes.io/postcodes?lon={}&lat={}'
-    res = requests.get(url).json()
-    try:
-        text = res['result'][0]['admin_district']
-    except KeyError:
-        logging.info('Invalid coordinates: long={}; lat={}'.format(
-            longitude, latitude))
-        text = 'NO_PAYLOAD'
-    return text
+metrics.instrument(app, 'facebook')
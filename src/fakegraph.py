@@ -0,0 +1,97 @@
+#!/usr/bin/python3
+"""
+Local stand-in for the Facebook Graph API send endpoint. Records every
+request it receives and can be told to fail or slow down, for testing the
+Messenger dispatcher without touching Facebook. Point the bot at it with:
+
+    FB_GRAPH_URL=http://localhost:8081/v2.9/me/messages
+
+It also accepts Slack's response_url posts on /slack/<hook>, so slash
+command answers can be sent to http://localhost:8081/slack/<anything>.
+
+GET /received lists what was sent and DELETE /received clears it.
+"""
+
+import json
+import os
+import random
+import threading
+import time
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import make_server, WSGIRequestHandler, WSGIServer
+
+from bottle import Bottle, request, response
+
+# fraction of requests answered with FAIL_STATUS, and added latency
+FAIL_RATE = float(os.environ.get('FAKE_GRAPH_FAIL_RATE', 0))
+FAIL_STATUS = int(os.environ.get('FAKE_GRAPH_FAIL_STATUS', 503))
+LATENCY = float(os.environ.get('FAKE_GRAPH_LATENCY', 0))
+
+app = application = Bottle()
+received = []
+settings = {'fail_rate': FAIL_RATE, 'fail_status': FAIL_STATUS,
+            'latency': LATENCY}
+
+
+@app.post('/<version>/me/messages')
+def messages(version):
+    response.headers['Content-Type'] = 'application/json'
+    time.sleep(settings['latency'])
+
+    if random.random() < settings['fail_rate']:
+        response.status = settings['fail_status']
+        return json.dumps({'error': {'message': 'Injected failure'}})
+
+    data = request.json
+    received.append(data)
+    return json.dumps({'recipient_id': data['recipient']['id'],
+                       'message_id': 'mid.{}'.format(len(received))})
+
+
+@app.post('/slack/<hook:path>')
+def slack_response(hook):
+    time.sleep(settings['latency'])
+
+    if random.random() < settings['fail_rate']:
+        response.status = settings['fail_status']
+        return 'Injected failure'
+
+    received.append({'hook': hook, 'slack': request.json})
+    return 'ok'
+
+
+@app.get('/received')
+def list_received():
+    response.headers['Content-Type'] = 'application/json'
+    return json.dumps(received)
+
+
+@app.delete('/received')
+def clear_received():
+    del received[:]
+    return None
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+class ThreadingServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+    # the default backlog of 5 drops connections under load
+    request_queue_size = 128
+
+
+def serve(host='localhost', port=0):
+    """Run the fake in a background thread and return its base url."""
+
+    server = make_server(host, port, app, server_class=ThreadingServer,
+                         handler_class=QuietHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return 'http://{}:{}'.format(host, server.server_port)
+
+
+if __name__ == '__main__':
+    app.run(port=8081)
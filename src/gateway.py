@@ -0,0 +1,401 @@
+#!/usr/bin/python3
+"""
+Planbot's asyncio gateway: the Messenger, Slack and API front ends served
+by one process on one event loop. Turns and lookups await the session
+store, database, Celery results and outbound HTTP instead of holding a
+thread each, and share one pool of each per process, so a single gateway
+keeps many conversations in flight. Turns for one Messenger user still
+run in the order they arrived. Run it with:
+
+    $ python3 gateway.py --port 8080
+
+or under gunicorn with --worker-class aiohttp.GunicornWebWorker and the
+gateway:make_app factory. Table exports and /batch stream or batch their
+reads through ConnectDB, so they are served by api.py's Bottle app on a
+small thread pool. facebook.py, slack.py and api.py remain WSGI apps in
+their own right.
+"""
+
+import argparse
+import asyncio
+import io
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote
+
+import aiohttp
+from aiohttp import web
+
+import api
+import metrics
+import slack
+from asyncdb import AsyncConnectDB, close_pools
+from asyncdispatcher import AsyncDispatcher
+from connectdb import known_version
+from conversation import conversation_graph
+from dispatcher import GRAPH_URL
+from engine import AsyncEngine
+from messenger import build_message, event_text, parse_response, \
+    pinned_location
+from planbot import AsyncPlanbot
+from session import default_async_store
+from traffic import recorder
+
+FB_PAGE_TOKEN = os.environ.get('FB_PAGE_TOKEN')
+FB_VERIFY_TOKEN = os.environ.get('FB_VERIFY_TOKEN')
+
+# turns running at once, turns that may wait to start, and seconds a
+# turn's lookups have
+MAX_TURNS = int(os.environ.get('PLANBOT_GATEWAY_TURNS', 500))
+MAX_WAITING = int(os.environ.get('PLANBOT_GATEWAY_QUEUE', 10000))
+TURN_TIMEOUT = float(os.environ.get('FB_TURN_TIMEOUT', 15))
+# connections held open to the Graph API and Slack
+HTTP_LIMIT = int(os.environ.get('PLANBOT_GATEWAY_HTTP_LIMIT', 100))
+# threads serving exports and batches through api.py
+BRIDGE_WORKERS = int(os.environ.get('PLANBOT_GATEWAY_BRIDGE_WORKERS', 4))
+
+logging.basicConfig(level=logging.INFO)
+
+
+class Gateway():
+    """Shared state of a gateway: one HTTP session for the Graph API and
+       Slack, one session store, and a lock per Messenger user."""
+
+    def __init__(self, graph_url=GRAPH_URL, max_turns=MAX_TURNS,
+                 max_waiting=MAX_WAITING):
+        self.graph_url = graph_url
+        self.max_turns = max_turns
+        self.max_waiting = max_waiting
+        self.http = self.dispatcher = self.store = self.running = None
+        self.bridge = ThreadPoolExecutor(BRIDGE_WORKERS,
+                                         thread_name_prefix='planbot-bridge')
+        # lock and number of turns started or waiting, per user
+        self.users = {}
+        self.waiting = 0
+        # turns still running, held so they are not garbage collected
+        self.turns = set()
+
+    async def start(self, app):
+        self.http = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=HTTP_LIMIT))
+        self.dispatcher = AsyncDispatcher(self.http, token=FB_PAGE_TOKEN,
+                                          url=self.graph_url)
+        self.store = default_async_store()
+        self.running = asyncio.Semaphore(self.max_turns)
+        # compile the conversation graph before the first turn needs it
+        await asyncio.get_event_loop().run_in_executor(None,
+                                                       conversation_graph)
+
+    async def stop(self, app):
+        if self.turns:
+            await asyncio.wait(self.turns, timeout=TURN_TIMEOUT)
+        await self.dispatcher.join()
+        await self.http.close()
+        await close_pools()
+        self.bridge.shutdown(wait=False)
+
+    async def messenger_webhook(self, request):
+        if request.query.get('hub.verify_token') == FB_VERIFY_TOKEN:
+            return web.Response(text=request.query.get('hub.challenge', ''))
+        return web.Response(text='Invalid Request or Verification Token')
+
+    async def messenger_post(self, request):
+        body = await request.json()
+        if recorder:
+            recorder.record(body)
+
+        deadline = time.time() + TURN_TIMEOUT
+        for fb_id, event in parse_response(body):
+            if self.waiting >= self.max_waiting:
+                logging.warning('Turn queue full, dropped event from '
+                                '{}'.format(fb_id))
+                continue
+            # answer Facebook now; the turn replies through the dispatcher
+            task = asyncio.ensure_future(self.run_turn(fb_id, event, deadline))
+            self.turns.add(task)
+            task.add_done_callback(self.turns.discard)
+        return web.Response()
+
+    async def run_turn(self, fb_id, event, deadline=None):
+        """Run a turn once the user's earlier turns have finished. Locks
+           are granted in the order turns were started."""
+
+        lock, count = self.users.get(fb_id) or (asyncio.Lock(), 0)
+        self.users[fb_id] = (lock, count + 1)
+        self.waiting += 1
+        try:
+            async with lock, self.running:
+                await self.turn(fb_id, event, deadline)
+        except Exception:
+            logging.exception('Turn failed for {}'.format(fb_id))
+        finally:
+            self.waiting -= 1
+            lock, count = self.users[fb_id]
+            if count == 1:
+                del self.users[fb_id]
+            else:
+                self.users[fb_id] = (lock, count - 1)
+        return None
+
+    async def turn(self, fb_id, event, deadline=None):
+        if pinned_location(event.get('message') or {}):
+            # postcode lookups may fall back to a remote API
+            text = await asyncio.get_event_loop().run_in_executor(
+                None, event_text, event)
+        else:
+            text = event_text(event)
+
+        bot = AsyncEngine(store=self.store)
+        for response in await bot.response(user=fb_id, message=text,
+                                           deadline=deadline):
+            logging.info(response)
+            self.dispatcher.typing(fb_id)
+            self.dispatcher.message(response['id'], build_message(response))
+        return None
+
+    async def slack_code_exchange(self, request):
+        code = request.query.get('code')
+        if not code:
+            return web.Response(text='Invalid request type')
+
+        data = {'client_id': slack.CLIENT_ID,
+                'client_secret': slack.CLIENT_SECRET,
+                'code': code}
+        async with self.http.post('https://slack.com/api/oauth.access',
+                                  data=data) as resp:
+            content = await resp.json(content_type=None)
+        return web.Response(text='Install successful' if content['ok']
+                            else 'Install unsuccessful')
+
+    async def slack_post(self, request):
+        data = await request.post()
+        if not data.get('token') == slack.VERIFY_TOKEN:
+            return web.Response()
+
+        cmd = data['command'].strip('/')
+        resp = await run_command(cmd, data['text'],
+                                 time.time() + slack.DEADLINE)
+        with metrics.timed('slack_send'):
+            async with self.http.post(data['response_url'], json=resp,
+                                      timeout=aiohttp.ClientTimeout(
+                                          total=10)) as res:
+                await res.read()
+        return web.Response()
+
+    async def api_lookup(self, request):
+        after = request.query.get('after')
+        limit = request.query.get('limit')
+        params, key = api.request_key(request.match_info['path'], after,
+                                      limit)
+        table = api.switch.get(key[0])
+        entry = api.cache.get(key, None)
+        if entry is None or not api.fresh(entry, table):
+            metrics.cache_requests.inc(cache='api', result='miss')
+            version = await data_version(table)
+            entry = api.cache_response(key, version,
+                                       await answer(params, after, limit))
+        else:
+            metrics.cache_requests.inc(cache='api', result='hit')
+
+        headers = api.entry_headers(entry)
+        if api.etag_matches(entry.etag, request.headers.get('If-None-Match')):
+            return web.Response(status=304, headers=headers)
+        return web.Response(text=entry.body, content_type='application/json',
+                            headers=headers)
+
+    async def bridged(self, request):
+        """Serve a request from api.py's Bottle app on the bridge pool,
+           streaming its body back a chunk at a time."""
+
+        loop = asyncio.get_event_loop()
+        environ = wsgi_environ(request, await request.read())
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started.update(status=status, headers=headers)
+
+        def call():
+            result = api.app(environ, start_response)
+            return result, iter(result)
+
+        result, chunks = await loop.run_in_executor(self.bridge, call)
+        status, reason = started['status'].split(' ', 1)
+        resp = web.StreamResponse(status=int(status), reason=reason)
+        for name, value in started['headers']:
+            resp.headers.add(name, value)
+        await resp.prepare(request)
+        try:
+            while True:
+                chunk = await loop.run_in_executor(self.bridge, next, chunks,
+                                                   None)
+                if chunk is None:
+                    break
+                await resp.write(chunk)
+        finally:
+            if hasattr(result, 'close'):
+                await loop.run_in_executor(self.bridge, result.close)
+        await resp.write_eof()
+        return resp
+
+    async def metrics_view(self, request):
+        return web.Response(body=metrics.render().encode('utf-8'),
+                            headers={'Content-Type':
+                                     'text/plain; version=0.0.4'})
+
+    @web.middleware
+    async def instrument(self, request, handler):
+        """Time every route under a span, as metrics.instrument does for
+           the Bottle apps. Bridged routes are timed by api.py itself."""
+
+        if handler == self.bridged:
+            return await handler(request)
+
+        route = request.match_info.route.resource
+        route = route.canonical if route else request.path
+        front = request.path.split('/')[1]
+        name = front if front in ['facebook', 'slack'] else 'api'
+        status = 500
+        start = time.time()
+        try:
+            with metrics.span('{} {}'.format(request.method, route),
+                              app=name):
+                resp = await handler(request)
+            status = resp.status
+            return resp
+        except web.HTTPException as err:
+            status = err.status
+            raise
+        finally:
+            metrics.http_seconds.observe(time.time() - start, app=name,
+                                         route=route, status=status)
+
+
+async def run_command(cmd, text, deadline=None):
+    resp = slack.ephemeral()
+
+    if not text:
+        resp['text'] = 'No query! Type \'/{} help\' for more'.format(cmd)
+    elif text == 'help':
+        async with AsyncConnectDB('responses') as db:
+            resp['text'] = (await db.query_response(cmd + '-help'))['text']
+    else:
+        pb = AsyncPlanbot()
+        result, options = await pb.run_task(action=slack.switch[cmd],
+                                            query=text, deadline=deadline)
+        resp['text'] = slack.format_text(result=result, options=options)
+
+    return resp
+
+
+async def answer(params, after=None, limit=None):
+    if len(params) == 1:
+        return await return_all_data(params[0], after=after, limit=limit)
+    elif len(params) == 2:
+        return await answer_query(params)
+    return {'success': False, 'error': 'Invalid number of parameters'}
+
+
+async def data_version(table):
+    if not table:
+        return None
+
+    version = known_version(table)
+    if version is None:
+        async with AsyncConnectDB(table) as db:
+            version = await db.data_version()
+    return version
+
+
+async def return_all_data(action, after=None, limit=None):
+    paged = after is not None or limit is not None
+    try:
+        size = min(max(int(limit or api.MAX_PAGE), 1), api.MAX_PAGE)
+    except ValueError:
+        return {'success': False,
+                'error': 'Invalid limit \'{}\''.format(limit)}
+    if action not in api.switch:
+        return {'success': False,
+                'error': 'Action \'{}\' not found'.format(action)}
+
+    async with AsyncConnectDB(api.switch[action]) as db:
+        if paged:
+            res = [row[0] for row in await db.query_page(after, size)]
+        else:
+            res = await db.query_keys()
+
+    resp = {'success': True, 'result': res}
+    if paged and len(res) == size:
+        resp['next'] = res[-1]
+    return resp
+
+
+async def answer_query(params):
+    action, param = params
+    if action not in api.switch:
+        return {'success': False,
+                'error': 'Action \'{}\' not found'.format(action)}
+
+    pb = AsyncPlanbot()
+    result, options = await pb.run_task(action=api.switch[action],
+                                        query=param,
+                                        deadline=time.time() + api.DEADLINE)
+    return api.format_answer(param, result, options, pb.source)
+
+
+def wsgi_environ(request, body):
+    host, _, port = request.host.partition(':')
+    environ = {
+        'REQUEST_METHOD': request.method,
+        'SCRIPT_NAME': '',
+        'PATH_INFO': unquote(request.rel_url.raw_path, encoding='latin-1'),
+        'QUERY_STRING': request.query_string,
+        'SERVER_NAME': host,
+        'SERVER_PORT': port or '80',
+        'SERVER_PROTOCOL': 'HTTP/{}.{}'.format(*request.version),
+        'CONTENT_TYPE': request.headers.get('Content-Type', ''),
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': request.scheme,
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False}
+    for name, value in request.headers.items():
+        key = 'HTTP_' + name.upper().replace('-', '_')
+        if key not in ['HTTP_CONTENT_TYPE', 'HTTP_CONTENT_LENGTH']:
+            environ[key] = value
+    return environ
+
+
+def make_app(gateway=None):
+    """Return the gateway's aiohttp application."""
+
+    gateway = gateway or Gateway()
+    app = web.Application(middlewares=[gateway.instrument])
+    app.on_startup.append(gateway.start)
+    app.on_cleanup.append(gateway.stop)
+    app.router.add_get('/metrics', gateway.metrics_view)
+    app.router.add_get('/facebook', gateway.messenger_webhook)
+    app.router.add_post('/facebook', gateway.messenger_post)
+    app.router.add_get('/slack', gateway.slack_code_exchange)
+    app.router.add_post('/slack', gateway.slack_post)
+    app.router.add_get('/export/{action}', gateway.bridged)
+    app.router.add_post('/batch', gateway.bridged)
+    app.router.add_get('/{path:.+}', gateway.api_lookup)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8080)
+    args = parser.parse_args()
+    web.run_app(make_app(), host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,20 +1,42 @@
 import os
 import json
 import logging
+import queue
+import threading
+import time
+from collections import deque
 
 import requests
 from bottle import Bottle, request, response, debug
 
 from planbot import Planbot
 from connectdb import ConnectDB
+from workers import KeyedWorkerPool
+import metrics
 
 CLIENT_ID = os.environ.get('CLIENT_ID')
 CLIENT_SECRET = os.environ.get('CLIENT_SECRET')
 VERIFY_TOKEN = os.environ.get('VERIFY_TOKEN')
 
+# acknowledge commands at once and answer via response_url from a pool
+DEFERRED = os.environ.get('SLACK_DEFERRED') == '1'
+WORKERS = int(os.environ.get('SLACK_WORKERS', 8))
+QUEUE_SIZE = int(os.environ.get('SLACK_QUEUE_SIZE', 50))
+# seconds from receiving a command to answering it; Slack gives up on an
+# inline answer after three, while a deferred answer's response_url lasts
+# for minutes
+DEADLINE = float(os.environ.get('SLACK_DEADLINE', 2.5))
+DEFERRED_DEADLINE = float(os.environ.get('SLACK_DEFERRED_DEADLINE', 60))
+
 debug = True
 app = application = Bottle()
 
+pool = KeyedWorkerPool(WORKERS, maxsize=QUEUE_SIZE, name='planbot-slack') \
+    if DEFERRED else None
+# updated from request and worker threads, under stats_lock
+stats = {'completed': 0, 'rejected': 0, 'seconds': deque(maxlen=1000)}
+stats_lock = threading.Lock()
+
 
 @app.get('/slack')
 def code_exchange():
@@ -45,27 +67,79 @@ def slack_post():
         text = data['text']
         url = data['response_url']
 
-    resp = {}
-    resp['response_type'] = 'ephemeral'  # or 'in_channel' for all users
+    if not DEFERRED:
+        send(url, run_command(cmd, text, time.time() + DEADLINE))
+        return None
+
+    response.headers['Content-Type'] = 'application/json'
+    try:
+        pool.submit(data.get('user_id'), deferred_command, cmd, text, url,
+                    time.time())
+    except queue.Full:
+        with stats_lock:
+            stats['rejected'] += 1
+        logging.info('Slack queue full, rejected /{} {}'.format(cmd, text))
+        return json.dumps(ephemeral('Sorry, I\'m busy right now! '
+                                    'Please try again in a moment.'))
+
+    logging.info('Slack queue depth: {}'.format(pool.depth()))
+    return json.dumps(ephemeral('Looking that up...'))
+
+
+@app.get('/slack/stats')
+def slack_stats():
+    response.headers['Content-Type'] = 'application/json'
+    with stats_lock:
+        completed, rejected = stats['completed'], stats['rejected']
+        seconds = sorted(stats['seconds'])
+
+    def percentile(p):
+        return seconds[int(p * (len(seconds) - 1))] if seconds else None
+
+    return json.dumps({
+        'queue_depth': pool.depth() if pool else 0,
+        'completed': completed,
+        'rejected': rejected,
+        'p50_seconds': percentile(0.5),
+        'p95_seconds': percentile(0.95)})
+
+
+def deferred_command(cmd, text, url, received):
+    send(url, run_command(cmd, text, received + DEFERRED_DEADLINE))
+    elapsed = time.time() - received
+    with stats_lock:
+        stats['completed'] += 1
+        stats['seconds'].append(elapsed)
+    logging.info('Slack /{} answered in {:.3f}s'.format(cmd, elapsed))
+    return None
 
-    pb = Planbot()
-    result = options = None
+
+def run_command(cmd, text, deadline=None):
+    resp = ephemeral()
 
     if not text:
         resp['text'] = 'No query! Type \'/{} help\' for more'.format(cmd)
-    if text == 'help':
+    elif text == 'help':
         resp['text'] = help_text(cmd)
     else:
-        result, options = pb.run_task(action=switch[cmd], query=text)
+        pb = Planbot()
+        result, options = pb.run_task(action=switch[cmd], query=text,
+                                      deadline=deadline)
         resp['text'] = format_text(result=result, options=options)
 
-    send(url, resp)
-    return None
+    return resp
+
+
+def ephemeral(text=None):
+    resp = {'response_type': 'ephemeral'}  # or 'in_channel' for all users
+    if text:
+        resp['text'] = text
+    return resp
 
 
 def send(url, resp):
-    response.headers['Content-Type'] = 'application/json'
-    res = requests.post(url, json=resp)
+    with metrics.timed('slack_send'):
+        res = requests.post(url, json=resp, timeout=10)
     return res.content
 
 
@@ -80,9 +154,8 @@ def format_text(result=None, options=None):
 
 
 def help_text(cmd):
-    db = ConnectDB('responses')
-    text = db.query_response(cmd + '-help')
-    db.close()
+    with ConnectDB('responses') as db:
+        text = db.query_response(cmd + '-help')
     return text['text']
 
 
@@ -93,6 +166,8 @@ switch = {
     'doc': 'documents',
     'lp': 'local_plans'}
 
+metrics.instrument(app, 'slack')
+
 
 if __name__ == '__main__':
     app.run()